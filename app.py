@@ -1,91 +1,167 @@
+import os
 import tkinter as tk
 import service_discovery
 from network import Addr
 import chat_manager
+import async_chat_manager
+import session
 from screen.connect_screen import ConnectionScreen
-from screen.chat_screen import ChatScreen
-from typing import Dict
+from screen.chat_screen import ChatScreen, DEFAULT_SCROLLBACK
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
 import sys
 
+if TYPE_CHECKING:
+    from history import HistoryStore
+
 
 class App:
-    def __init__(self, local_addr: Addr, multicast_addr: Addr) -> None:
+    def __init__(
+        self,
+        local_addr: Addr,
+        multicast_addr: Addr,
+        use_async: bool = False,
+        scrollback: int = DEFAULT_SCROLLBACK,
+        history_dir: Optional[str] = None,
+        history_key: Optional[str] = None,
+    ) -> None:
+        self.local_addr = local_addr
+        self.multicast_addr = multicast_addr
+        self.scrollback = scrollback
+        self.history_dir = history_dir
+        self.history_key = history_key
+        self.history: Optional["HistoryStore"] = None
+
+        # the listener comes first, peers connecting while the window and
+        # the rest start up wait in its backlog rather than being refused
+        self.use_async = use_async
+        self.chat_manager: Union[
+            chat_manager.ChatManager, async_chat_manager.AsyncChatManager
+        ]
+        if use_async:
+            self.chat_manager = async_chat_manager.AsyncChatManager(
+                host_addr=local_addr,
+                chat_recv_observer=self,
+                session_close_observer=self,
+            )
+        else:
+            self.chat_manager = chat_manager.ChatManager(
+                host_addr=local_addr,
+                chat_recv_observer=self,
+                session_close_observer=self,
+            )
+
         self.root = tk.Tk()
         self.connect_screen = ConnectionScreen(self.root, self)
         self.all_chatscreens: Dict[Addr, ChatScreen] = {}
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        # runs once the window is up, nothing here is needed to show it
+        if self.history_dir:
+            from history import HistoryStore, default_key_path
+
+            # messages both ways are kept encrypted on disk, the key elsewhere
+            self.history = HistoryStore(
+                self.history_dir,
+                self.history_key or default_key_path(self.history_dir),
+            )
 
         self.service_discovery_client = service_discovery.ServiceDiscoveryClient(
-            local_addr=local_addr, multicast_addr=multicast_addr
+            local_addr=self.local_addr, multicast_addr=self.multicast_addr
         )
 
         self.service_discovery_server = service_discovery.ServiceDiscoveryServer(
-            local_addr=local_addr, multicast_addr=multicast_addr
-        )
-
-        self.chat_manager = chat_manager.ChatManager(
-            host_addr=local_addr, chat_recv_observer=self, session_close_observer=self
+            local_addr=self.local_addr,
+            multicast_addr=self.multicast_addr,
+            peer_observer=self,
         )
 
         self.run_service_discovery_task()
         self.run_chat_manager_task()
+        # the first handshake would pay for these otherwise
+        session.preload()
 
     def loop(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            if self.history:
+                self.history.close()
 
     def on_connect(self, addr: Addr):
         # triggered by connect screen
         if addr not in self.all_chatscreens.keys():
             self.chat_manager.start_new_connection(addr)
-            self.all_chatscreens[addr] = ChatScreen(
-                tk.Toplevel(self.root),
-                addr,
-                chat_sent_observer=self,
-                chat_close_observer=self,
-            )
+            self.all_chatscreens[addr] = self._open_chat_screen(addr)
 
-    def on_chat_message_sent(self, addr: Addr, message: str):
-        self.chat_manager.send_message(addr, message=message.encode())
+    def on_chat_message_sent(self, addr: Addr, message: str) -> bool:
+        # only what was queued is recorded as sent
+        sent = self.chat_manager.send_message(addr, message=message.encode())
+        if sent and self.history:
+            self.history.log(addr).append(True, message.encode())
+        return sent
 
     def on_chat(self, addr: Addr, message: bytes):
         if addr not in self.all_chatscreens.keys():
-            self.all_chatscreens[addr] = ChatScreen(
-                tk.Toplevel(self.root),
-                addr,
-                chat_sent_observer=self,
-                chat_close_observer=self,
-            )
+            self.all_chatscreens[addr] = self._open_chat_screen(addr)
 
+        # recorded after the screen opened, it is shown as new, not as history
+        if self.history:
+            self.history.log(addr).append(False, message)
         self.all_chatscreens[addr].recv_message(message=message.decode())
 
+    def _open_chat_screen(self, addr: Addr) -> ChatScreen:
+        return ChatScreen(
+            tk.Toplevel(self.root),
+            addr,
+            chat_sent_observer=self,
+            chat_close_observer=self,
+            scrollback=self.scrollback,
+            history=self.history.log(addr) if self.history else None,
+        )
+
     def on_chat_closes(self, addr: Addr):
         if addr in self.all_chatscreens.keys():
             self.all_chatscreens.pop(addr)
 
         self.chat_manager.close_conn(addr)
 
+    def on_peers_changed(self, added: List[Addr], removed: List[Addr]):
+        self.connect_screen.update_peers(added, removed)
+
     def on_session_close(self, addr: Addr):
         print(f"on session close {addr}")
-        if addr in self.all_chatscreens.keys():
-            self.all_chatscreens[addr].close()
-            self.all_chatscreens.pop(addr)
+        # popped first, closing the window reports back through on_chat_closes
+        chat_screen = self.all_chatscreens.pop(addr, None)
+        if chat_screen is not None:
+            chat_screen.close()
 
     def run_service_discovery_task(self):
         def poll():
-            self.service_discovery_server.poll(timeout=0.01)
-            self.connect_screen.update_active_ip(
-                self.service_discovery_server.retrieve_active_address()
-            )
-            self.root.after(500, poll)
+            self.service_discovery_server.poll(timeout=0)
+            self.root.after(100, poll)
 
         poll()
 
         def publish_for_service_discovery():
             self.service_discovery_client.publish()
-            self.root.after(3000, publish_for_service_discovery)
+            interval = self.service_discovery_client.next_interval(
+                len(self.service_discovery_server.last_seen)
+            )
+            self.root.after(int(interval * 1000), publish_for_service_discovery)
 
         publish_for_service_discovery()
 
     def run_chat_manager_task(self):
+        if self.use_async:
+            # network runs on its own thread, only hand over queued events
+            def dispatch():
+                self.chat_manager.run(0)
+                self.root.after(10, dispatch)
+
+            dispatch()
+            return
+
         def poll():
             self.chat_manager.run(0.1)
             self.root.after(100, poll)
@@ -95,12 +171,34 @@ class App:
 
 def main():
     if len(sys.argv) < 2:
-        print("usage: python app.py <port>")
+        print(
+            "usage: python app.py <port> [--async] [--scrollback=<messages>]"
+            " [--history=<dir>] [--history-key=<file>]"
+        )
 
     local_addr = Addr(host="127.0.0.1", port=int(sys.argv[1]))
     multicast_addr = Addr(host="224.0.0.1", port=5005)
 
-    app = App(local_addr=local_addr, multicast_addr=multicast_addr)
+    scrollback = DEFAULT_SCROLLBACK
+    history_dir = os.path.expanduser(f"~/.zerotrust_chat/{local_addr.port}/history")
+    history_key = None
+    for arg in sys.argv[2:]:
+        if arg.startswith("--scrollback="):
+            scrollback = int(arg.split("=", 1)[1])
+        if arg.startswith("--history="):
+            # an empty dir turns history off
+            history_dir = arg.split("=", 1)[1]
+        if arg.startswith("--history-key="):
+            history_key = arg.split("=", 1)[1]
+
+    app = App(
+        local_addr=local_addr,
+        multicast_addr=multicast_addr,
+        use_async="--async" in sys.argv[2:],
+        scrollback=scrollback,
+        history_dir=history_dir,
+        history_key=history_key,
+    )
     app.loop()
 
 
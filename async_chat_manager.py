@@ -0,0 +1,259 @@
+import asyncio
+import queue
+import threading
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional, Union
+
+import network
+import session
+from network import Addr
+from state.base import ReponseStatus
+
+if TYPE_CHECKING:
+    from crypto.key_pool import KeyPool
+
+
+class ChatEvent(NamedTuple):
+    addr: Addr
+    message: bytes
+
+
+class SessionCloseEvent(NamedTuple):
+    addr: Addr
+
+
+Event = Union[ChatEvent, SessionCloseEvent]
+
+
+class _ChatProtocol(asyncio.Protocol):
+    def __init__(
+        self, manager: "AsyncChatManager", dest_addr: Optional[Addr] = None
+    ) -> None:
+        self.manager = manager
+        self.dest_addr = dest_addr
+        self.buffer = network.FrameBuffer()
+        self.transport: Optional[asyncio.Transport] = None
+        self.addr: Optional[Addr] = None
+        self.session: Optional[session.BaseSession] = None
+        self.hello = b""
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+        host, port = transport.get_extra_info("peername")[:2]
+        self.addr = self.dest_addr or Addr(host=host, port=port)
+
+        if self.dest_addr is None:
+            self.session = session.ServerSession(
+                self.addr, chat_observer=self.manager, key_pool=self.manager.key_pool
+            )
+        else:
+            client_session = session.ClientSession(
+                addr=self.dest_addr,
+                chat_observer=self.manager,
+                listen_port=self.manager.listen_port,
+            )
+            self.hello = client_session.hello()
+            self.session = client_session
+
+        if not self.manager._register_peer(self.addr, self):
+            # the peer got through to us first and its connection is kept
+            transport.close()
+            return
+
+        if self.hello:
+            # start the key exchange handshake
+            self.write(self.hello)
+
+    def data_received(self, data: bytes) -> None:
+        assert self.session is not None and self.transport is not None
+        try:
+            self.buffer.feed(data)
+            for record in self.buffer.frames():
+                response = self.session.on_message_recv(record)
+
+                if response.status == ReponseStatus.DISCONNECT:
+                    self.transport.close()
+                    return
+
+                if response.status == ReponseStatus.REPLY_NEEDED:
+                    self.write(response.message)
+
+                if self.session.addr != self.addr:
+                    # the hello named the peer's listening address
+                    self.manager._unregister(self.addr, self)
+                    self.addr = self.session.addr
+                    if not self.manager._register_peer(self.addr, self):
+                        self.transport.close()
+                        return
+
+        except Exception as e:
+            print(f"conn exception: {e}")
+            self.transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        print(f"connection close: {self.addr}")
+        assert self.addr is not None and self.session is not None
+        if self.manager.addr_conn_mapping.get(self.addr, None) is not self:
+            # lost to another connection to the same peer, never reported open
+            self.session.release()
+            return
+        self.manager._unregister(self.addr, self)
+        self.session.close_session(self.addr, self.manager)
+
+    def write(self, data: bytes) -> int:
+        assert self.transport is not None
+        self.transport.write(network.pack_frame(data))
+        return len(data)
+
+
+class AsyncChatManager:
+    # runs the chat network on its own asyncio loop thread, the public methods
+    # are safe to call from the gui thread and events are handed back through
+    # a queue drained by run()
+    def __init__(
+        self,
+        host_addr: Addr,
+        chat_recv_observer: session.ProtocolContextChatObserver,
+        session_close_observer: session.SessionCloseObserver,
+        key_pool: Optional["KeyPool"] = None,
+    ) -> None:
+        self.chat_recv_observer: session.ProtocolContextChatObserver = (
+            chat_recv_observer
+        )
+        self.session_close_observer: session.SessionCloseObserver = (
+            session_close_observer
+        )
+        self.key_pool: Optional["KeyPool"] = key_pool
+        self.addr_conn_mapping: Dict[Addr, _ChatProtocol] = {}
+        self.events: "queue.SimpleQueue[Event]" = queue.SimpleQueue()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="chat-manager", daemon=True
+        )
+        self.thread.start()
+
+        self.server = asyncio.run_coroutine_threadsafe(
+            self._create_tcp_server(host_addr), self.loop
+        ).result()
+        self.listen_port: int = self.server.sockets[0].getsockname()[1]
+
+    def close_conn(self, addr: Addr):
+        self.loop.call_soon_threadsafe(self._close_conn, addr)
+
+    def run(self, timeout: Optional[float] = None):
+        # dispatch pending events on the calling thread, waiting at most
+        # timeout for the first one
+        try:
+            event = self.events.get(timeout=timeout)
+            while True:
+                self._dispatch(event)
+                event = self.events.get_nowait()
+        except queue.Empty:
+            pass
+
+    def on_chat(self, addr: Addr, message: bytes):
+        self.events.put(ChatEvent(addr=addr, message=message))
+
+    def on_session_close(self, addr: Addr):
+        self.events.put(SessionCloseEvent(addr=addr))
+
+    def send_message(self, dest_addr: Addr, message: bytes) -> bool:
+        # waits for the loop thread, only it knows whether the message was
+        # queued
+        async def send() -> bool:
+            return self._send_message(dest_addr, message)
+
+        return asyncio.run_coroutine_threadsafe(send(), self.loop).result()
+
+    def start_new_connection(self, dest_addr: Addr) -> None:
+        asyncio.run_coroutine_threadsafe(self._connect(dest_addr), self.loop)
+
+    def stop(self) -> None:
+        async def shutdown():
+            self.server.close()
+            for conn in list(self.addr_conn_mapping.values()):
+                if conn.transport is not None:
+                    conn.transport.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _dispatch(self, event: Event):
+        if isinstance(event, ChatEvent):
+            self.chat_recv_observer.on_chat(event.addr, event.message)
+        else:
+            self.session_close_observer.on_session_close(event.addr)
+
+    def _register(self, addr: Addr, conn: _ChatProtocol):
+        self.addr_conn_mapping[addr] = conn
+
+    def _register_peer(self, addr: Addr, conn: _ChatProtocol) -> bool:
+        # called once a connection knows its peer's address, returns False
+        # when it has to go. one connection per peer is kept
+        existing = self.addr_conn_mapping.get(addr, None)
+        if existing is None:
+            self._register(addr, conn)
+            return True
+
+        assert existing.session is not None and conn.transport is not None
+        if existing.dest_addr is None and conn.dest_addr is None:
+            # the listen port in a hello is only a claim, anyone can make it.
+            # an established inbound session is kept while it lives
+            if existing.session.established:
+                return False
+        elif existing.dest_addr is None or conn.dest_addr is None:
+            # both sides dialled, keep the connection opened by the lower
+            # address. each end sees the same pair so both keep the same one
+            local_host = conn.transport.get_extra_info("sockname")[0]
+            keep_dialled = (local_host, self.listen_port) < (addr.host, addr.port)
+            if keep_dialled == (existing.dest_addr is not None):
+                return False
+        else:
+            return False
+
+        self._register(addr, conn)
+        if existing.transport is not None:
+            existing.transport.close()
+        return True
+
+    def _unregister(self, addr: Addr, conn: _ChatProtocol):
+        if self.addr_conn_mapping.get(addr, None) is conn:
+            del self.addr_conn_mapping[addr]
+
+    def _close_conn(self, addr: Addr):
+        conn = self.addr_conn_mapping.get(addr, None)
+        if conn and conn.transport is not None:
+            conn.transport.close()
+
+    def _send_message(self, dest_addr: Addr, message: bytes) -> bool:
+        conn = self.addr_conn_mapping.get(dest_addr, None)
+        if conn and conn.session is not None:
+            try:
+                conn.session.send_message(message, conn.write)
+                return True
+            except Exception as e:
+                print(f"send exception: {e}")
+        return False
+
+    async def _connect(self, dest_addr: Addr):
+        if dest_addr in self.addr_conn_mapping:
+            return
+        try:
+            await self.loop.create_connection(
+                lambda: _ChatProtocol(self, dest_addr=dest_addr),
+                dest_addr.host,
+                dest_addr.port,
+            )
+        except OSError as e:
+            print(f"connect exception: {e}")
+            # the window opened for it is closed like for any other session
+            self.events.put(SessionCloseEvent(addr=dest_addr))
+
+    async def _create_tcp_server(self, addr: Addr) -> asyncio.AbstractServer:
+        return await self.loop.create_server(
+            lambda: _ChatProtocol(self), addr.host, addr.port, reuse_port=True
+        )
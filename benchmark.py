@@ -0,0 +1,543 @@
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import chat_manager
+import gossip_discovery
+import service_discovery
+import session
+from crypto import aes
+from group import Group
+from network import Addr
+from state.base import (
+    CipherSuite,
+    DEFAULT_CIPHER_SUITES,
+    DEFAULT_WIRE_FORMATS,
+    HandshakeMode,
+    ReponseStatus,
+)
+from state.chat import create_cipher
+from state.resumption import TicketCache
+
+PAYLOAD_SIZES = (64, 1024, 16 * 1024, 64 * 1024)
+BENCHMARKS = (
+    "handshake",
+    "cipher",
+    "message",
+    "group",
+    "latency",
+    "discovery",
+    "startup",
+)
+RESULTS_VERSION = 1
+
+
+class Result(NamedTuple):
+    name: str
+    value: float
+    unit: str
+    # whether a bigger value is an improvement, rates are and latencies not
+    higher_is_better: bool = True
+
+
+class Collector:
+    def __init__(self) -> None:
+        self.chats: List[bytes] = []
+
+    def on_chat(self, addr: Addr, message: bytes):
+        self.chats.append(message)
+
+
+def measure(run_once: Callable[[], int], duration: float, repeat: int) -> float:
+    # best rate out of a few runs of at least duration seconds each, the best
+    # run is the one least disturbed by whatever else the machine was doing
+    best = 0.0
+    for _ in range(repeat):
+        count = 0
+        started = time.perf_counter()
+        deadline = started + duration
+        while True:
+            count += run_once()
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        best = max(best, count / (now - started))
+    return best
+
+
+def percentile(samples: Sequence[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def handshake(
+    modes: Sequence[str],
+    cipher_suite: str = CipherSuite.AES_256_GCM,
+    wire_format: str = DEFAULT_WIRE_FORMATS[0],
+    server_tickets: Optional[TicketCache] = None,
+    client_tickets: Optional[TicketCache] = None,
+) -> Tuple[session.ClientSession, session.ServerSession, Collector]:
+    # drives both ends in memory, no sockets involved
+    collector = Collector()
+    addr = Addr(host="127.0.0.1", port=1)
+    server = session.ServerSession(
+        addr,
+        collector,
+        modes=modes,
+        cipher_suites=(cipher_suite,),
+        wire_formats=(wire_format,),
+        tickets=server_tickets,
+    )
+    client = session.ClientSession(
+        addr,
+        collector,
+        modes=modes,
+        cipher_suites=(cipher_suite,),
+        wire_formats=(wire_format,),
+        tickets=client_tickets,
+    )
+
+    to_server = [client.hello()]
+    while to_server:
+        response = server.on_message_recv(to_server.pop())
+        if response.status == ReponseStatus.DISCONNECT:
+            raise RuntimeError(f"handshake failed: {response.message!r}")
+        if response.status != ReponseStatus.REPLY_NEEDED:
+            continue
+        reply = client.on_message_recv(response.message)
+        if reply.status == ReponseStatus.DISCONNECT:
+            raise RuntimeError(f"handshake failed: {reply.message!r}")
+        if reply.status == ReponseStatus.REPLY_NEEDED:
+            to_server.append(reply.message)
+
+    return client, server, collector
+
+
+def bench_handshake(duration: float, repeat: int) -> List[Result]:
+    results: List[Result] = []
+    for mode in (HandshakeMode.X25519, HandshakeMode.RSA, HandshakeMode.RESUME):
+        modes: Tuple[str, ...] = (mode,)
+        server_tickets, client_tickets = TicketCache(), TicketCache()
+        if mode == HandshakeMode.RESUME:
+            # every resumption leaves the ticket the next one uses
+            modes = (HandshakeMode.RESUME, HandshakeMode.X25519)
+            handshake(
+                modes, server_tickets=server_tickets, client_tickets=client_tickets
+            )
+
+        def run_once() -> int:
+            handshake(
+                modes, server_tickets=server_tickets, client_tickets=client_tickets
+            )
+            return 1
+
+        rate = measure(run_once, duration, repeat)
+        results.append(Result(f"handshake.{mode}", rate, "handshakes/s"))
+    return results
+
+
+def bench_cipher(duration: float, repeat: int) -> List[Result]:
+    results: List[Result] = []
+    secret = aes.generate_key()
+    for cipher_suite in DEFAULT_CIPHER_SUITES:
+        for size in PAYLOAD_SIZES:
+            sender = create_cipher(cipher_suite, secret, True)
+            receiver = create_cipher(cipher_suite, secret, False)
+            payload = os.urandom(size)
+
+            def run_once() -> int:
+                for _ in range(100):
+                    receiver.decrypt(sender.encrypt(payload))
+                return 100
+
+            rate = measure(run_once, duration, repeat)
+            results.append(
+                Result(f"cipher.{cipher_suite}.{size}", rate, "round trips/s")
+            )
+    return results
+
+
+def bench_message(duration: float, repeat: int) -> List[Result]:
+    # a chat record through the state machine, codec and cipher of both ends
+    results: List[Result] = []
+    for cipher_suite in DEFAULT_CIPHER_SUITES:
+        for wire_format in DEFAULT_WIRE_FORMATS:
+            client, server, collector = handshake(
+                (HandshakeMode.X25519,), cipher_suite, wire_format
+            )
+            for size in PAYLOAD_SIZES:
+                payload = os.urandom(size)
+                records: List[bytes] = []
+
+                def run_once() -> int:
+                    for _ in range(100):
+                        client.send_message(payload, records.append)
+                        server.on_message_recv(records.pop())
+                    collector.chats.clear()
+                    return 100
+
+                rate = measure(run_once, duration, repeat)
+                results.append(
+                    Result(
+                        f"message.{cipher_suite}.{wire_format}.{size}",
+                        rate,
+                        "messages/s",
+                    )
+                )
+    return results
+
+
+def bench_group(duration: float, repeat: int) -> List[Result]:
+    # one message to every member, sent over each pairwise session against
+    # sealed once under the group key and framed once per wire format
+    results: List[Result] = []
+    payload = os.urandom(1024)
+    for size in (8, 32):
+        sessions = [handshake((HandshakeMode.X25519,))[0] for _ in range(size)]
+        group = Group("bench", members=[Addr(host="127.0.0.1", port=1)])
+        records: List[bytes] = []
+
+        def run_pairwise() -> int:
+            for client in sessions:
+                client.send_message(payload, records.append)
+            records.clear()
+            return 1
+
+        def run_group() -> int:
+            sealed = group.seal(payload)
+            frames: Dict[Optional[str], bytes] = {}
+            for client in sessions:
+                if client.wire_format not in frames:
+                    frames[client.wire_format] = client.encode_group_post(
+                        group.group_id, sealed
+                    )
+                records.append(frames[client.wire_format])
+            records.clear()
+            return 1
+
+        for name, run_once in (("pairwise", run_pairwise), ("fanout", run_group)):
+            rate = measure(run_once, duration, repeat)
+            results.append(Result(f"group.{name}.{size}", rate, "messages/s"))
+    return results
+
+
+class Echo:
+    def __init__(self) -> None:
+        self.manager: Optional[chat_manager.ChatManager] = None
+        self.chats: List[bytes] = []
+
+    def on_chat(self, addr: Addr, message: bytes):
+        if self.manager is not None:
+            self.manager.send_message(addr, message)
+        else:
+            self.chats.append(message)
+
+    def on_session_close(self, addr: Addr):
+        pass
+
+
+def bench_latency(duration: float, repeat: int) -> List[Result]:
+    # round trips between two chat managers over loopback, both polled from
+    # this thread so the numbers include every layer but no scheduling noise
+    results: List[Result] = []
+    for size in (64, 16 * 1024):
+        pinger, echoer = Echo(), Echo()
+        a = chat_manager.ChatManager(Addr(host="127.0.0.1", port=0), pinger, pinger)
+        b = chat_manager.ChatManager(Addr(host="127.0.0.1", port=0), echoer, echoer)
+        echoer.manager = b
+        dest = Addr(host="127.0.0.1", port=b.listen_port)
+        samples: List[float] = []
+        payload = os.urandom(size)
+        try:
+            a.start_new_connection(dest)
+            deadline = time.monotonic() + 5
+            sent = False
+            while not pinger.chats:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("loopback session did not come up")
+                a.run(0)
+                b.run(0)
+                if not sent and dest in a.addr_conn_mapping:
+                    try:
+                        sent = a.send_message(dest, payload)
+                    except RuntimeError:
+                        # mapped as soon as it dials, sending fails until
+                        # the handshake is through
+                        pass
+
+            stop = time.perf_counter() + duration * repeat
+            while time.perf_counter() < stop:
+                pinger.chats.clear()
+                started = time.perf_counter()
+                a.send_message(dest, payload)
+                while not pinger.chats:
+                    a.run(0)
+                    b.run(0)
+                samples.append(time.perf_counter() - started)
+        finally:
+            a.stop()
+            b.stop()
+
+        for q in (0.5, 0.9, 0.99):
+            results.append(
+                Result(
+                    f"latency.{size}.p{int(q * 100)}",
+                    percentile(samples, q) * 1000,
+                    "ms",
+                    higher_is_better=False,
+                )
+            )
+    return results
+
+
+def bench_discovery(duration: float, repeat: int) -> List[Result]:
+    # how fast a burst of datagrams already in the socket buffer is handled,
+    # sending them is not part of the measurement
+    results: List[Result] = []
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    local_addr = Addr(host="127.0.0.1", port=_free_udp_port())
+    burst = 500
+
+    announcer = service_discovery.ServiceDiscoveryServer(
+        local_addr=local_addr, multicast_addr=Addr(host="224.0.0.1", port=0)
+    )
+    announce_port = announcer.sock.getsockname()[1]
+    announcements = [f"127.0.0.1:{10000 + i}".encode() for i in range(burst)]
+
+    gossip = gossip_discovery.GossipDiscovery(local_addr=local_addr)
+    members = [
+        Addr(host="127.0.0.1", port=20000 + i)
+        for i in range(gossip_discovery.MAX_ENTRIES)
+    ]
+    heartbeats = iter(range(1, sys.maxsize))
+
+    def run_announcements() -> float:
+        for message in announcements:
+            sender.sendto(message, ("127.0.0.1", announce_port))
+        started = time.perf_counter()
+        announcer.poll(timeout=0)
+        return time.perf_counter() - started
+
+    def run_digests() -> float:
+        # full digests with fresh heartbeats, every entry gets merged
+        for _ in range(burst):
+            heartbeat = next(heartbeats)
+            digest = gossip_discovery.encode_digest(
+                (member, heartbeat) for member in members
+            )
+            sender.sendto(digest, (local_addr.host, local_addr.port))
+        started = time.perf_counter()
+        gossip.poll(timeout=0)
+        return time.perf_counter() - started
+
+    bursts: Tuple[Tuple[str, Callable[[], float]], ...] = (
+        ("discovery.multicast", run_announcements),
+        ("discovery.gossip", run_digests),
+    )
+    try:
+        for name, run_burst in bursts:
+            best = 0.0
+            for _ in range(repeat):
+                busy = 0.0
+                handled = 0
+                stop = time.perf_counter() + duration
+                while time.perf_counter() < stop:
+                    busy += run_burst()
+                    handled += burst
+                best = max(best, handled / busy)
+            results.append(Result(name, best, "datagrams/s"))
+    finally:
+        sender.close()
+        announcer.sock.close()
+        gossip.sock.close()
+    return results
+
+
+def bench_startup(duration: float, repeat: int) -> List[Result]:
+    # a fresh daemon process each run, timed from spawning it until its port
+    # accepts and until a handshake with it is through. duration is unused,
+    # one start is one sample
+    listening: List[float] = []
+    handshaken: List[float] = []
+    daemon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "daemon.py")
+    for _ in range(repeat):
+        port = _free_tcp_port()
+        dest = Addr(host="127.0.0.1", port=port)
+        client = Echo()
+        manager = chat_manager.ChatManager(
+            Addr(host="127.0.0.1", port=0), client, client
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    daemon_path,
+                    str(port),
+                    "--control",
+                    os.path.join(directory, "control.sock"),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                deadline = time.monotonic() + 10
+                while True:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("daemon did not start listening")
+                    try:
+                        socket.create_connection((dest.host, port)).close()
+                        break
+                    except ConnectionRefusedError:
+                        time.sleep(0.001)
+                listening.append(time.perf_counter() - started)
+
+                manager.start_new_connection(dest)
+                while True:
+                    conn_session = manager.addr_conn_mapping.get(dest)
+                    if conn_session is not None and conn_session.session.established:
+                        break
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("no handshake with the daemon")
+                    manager.run(0.001)
+                handshaken.append(time.perf_counter() - started)
+            finally:
+                manager.stop()
+                # an interrupt rather than a kill, the daemon stops its key
+                # pool on the way out
+                process.send_signal(signal.SIGINT)
+                process.wait()
+
+    return [
+        Result("startup.listening", min(listening) * 1000, "ms", False),
+        Result("startup.first_handshake", min(handshaken) * 1000, "ms", False),
+    ]
+
+
+def _free_tcp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def environment() -> Dict[str, Any]:
+    import cryptography
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "cryptography": cryptography.__version__,
+    }
+
+
+def compare(
+    results: Sequence[Result], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    # returns a line per result worse than the baseline by more than tolerance
+    regressions: List[str] = []
+    for result in results:
+        previous = baseline["results"].get(result.name)
+        if not previous or not previous["value"]:
+            continue
+
+        change = result.value / previous["value"] - 1
+        if not result.higher_is_better:
+            change = -change
+        if change < -tolerance:
+            regressions.append(
+                f"{result.name}: {result.value:.4g} {result.unit}"
+                f" vs {previous['value']:.4g} ({change:+.1%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zero trust chat benchmarks")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"any of {', '.join(BENCHMARKS)}, all of them by default",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=0.5, help="seconds per measurement"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per measurement, the best is kept"
+    )
+    parser.add_argument("--output", help="write the results as json to this path")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fraction a result may be worse than the baseline before failing",
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    runners: Dict[str, Callable[[float, int], List[Result]]] = {
+        "handshake": bench_handshake,
+        "cipher": bench_cipher,
+        "message": bench_message,
+        "group": bench_group,
+        "latency": bench_latency,
+        "discovery": bench_discovery,
+        "startup": bench_startup,
+    }
+
+    results: List[Result] = []
+    for name in args.benchmarks or BENCHMARKS:
+        for result in runners[name](args.duration, args.repeat):
+            print(f"{result.name:<48} {result.value:>14.4g} {result.unit}")
+            results.append(result)
+
+    report = {
+        "version": RESULTS_VERSION,
+        "created": time.time(),
+        "environment": environment(),
+        "results": {
+            result.name: {
+                "value": result.value,
+                "unit": result.unit,
+                "higher_is_better": result.higher_is_better,
+            }
+            for result in results
+        },
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != report["environment"]:
+            print("baseline was recorded in a different environment")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"regression {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,113 @@
 import network
-from typing import Optional, Tuple, Dict, NamedTuple
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Optional,
+    Tuple,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+)
+from collections import deque
+import errno
+import selectors
 import socket
+import time
+import weakref
+import metrics
 import session
 from state.base import ReponseStatus
-from network import Addr
+from network import Addr, format_addr, parse_addr
+from state.resumption import TicketCache
+from group import Group, GroupObserver, GroupRecordKind, new_group_id
+
+if TYPE_CHECKING:
+    from crypto.key_pool import KeyPool
+
+BYTES_RECEIVED = metrics.REGISTRY.counter(
+    "chat_bytes_received_total", "bytes read from peer connections"
+)
+BYTES_SENT = metrics.REGISTRY.counter(
+    "chat_bytes_sent_total", "bytes written to peer connections"
+)
+RECORDS_RECEIVED = metrics.REGISTRY.counter(
+    "chat_records_received_total", "records read from peer connections"
+)
+RECORDS_SENT = metrics.REGISTRY.counter(
+    "chat_records_sent_total", "records queued for peer connections"
+)
+CONNECTIONS_ACCEPTED = metrics.REGISTRY.counter(
+    "chat_connections_total", "connections opened", direction="inbound"
+)
+CONNECTIONS_DIALLED = metrics.REGISTRY.counter(
+    "chat_connections_total", "connections opened", direction="outbound"
+)
+CONNECTIONS_CLOSED = metrics.REGISTRY.counter(
+    "chat_connections_closed_total", "connections closed"
+)
+CONN_ERRORS = metrics.REGISTRY.counter(
+    "chat_errors_total", "failures by where they were caught", kind="conn"
+)
+CONNECT_ERRORS = metrics.REGISTRY.counter(
+    "chat_errors_total", "failures by where they were caught", kind="connect"
+)
+CONNECT_TIMEOUTS = metrics.REGISTRY.counter(
+    "chat_errors_total", "failures by where they were caught", kind="connect_timeout"
+)
+GROUP_ERRORS = metrics.REGISTRY.counter(
+    "chat_errors_total", "failures by where they were caught", kind="group"
+)
+POLL_SECONDS = metrics.REGISTRY.histogram(
+    "chat_poll_seconds", "time spent handling the events of one poll"
+)
+
+# managers not stopped yet, the gauges below add up all of them
+MANAGERS: "weakref.WeakSet[ChatManager]" = weakref.WeakSet()
+
+
+def _total(count: Callable[["ChatManager"], int]) -> Callable[[], float]:
+    return lambda: sum(count(manager) for manager in list(MANAGERS))
+
+
+metrics.REGISTRY.gauge(
+    "chat_sessions",
+    "sessions open to known peers",
+    fn=_total(lambda manager: manager._session_count()),
+)
+metrics.REGISTRY.gauge(
+    "chat_connections",
+    "sockets open to peers",
+    fn=_total(lambda manager: manager._conn_count()),
+)
+metrics.REGISTRY.gauge(
+    "chat_outbound_bytes",
+    "bytes waiting to be written, all connections",
+    fn=_total(lambda manager: manager._outbound_bytes()),
+)
+metrics.REGISTRY.gauge(
+    "chat_pending_connects",
+    "connects in flight",
+    fn=_total(lambda manager: manager._pending_count()),
+)
+metrics.REGISTRY.gauge(
+    "chat_queued_connects",
+    "connects waiting for a free slot",
+    fn=_total(lambda manager: manager._queued_count()),
+)
 
 
 class ConnSessionPair(NamedTuple):
     conn: socket.socket
-    session: session.ReceiverSender
+    session: session.BaseSession
+    buffer: network.FrameBuffer
+    outbound: network.OutboundQueue
+
+
+class PendingConnect(NamedTuple):
+    addr: Addr
+    deadline: float
 
 
 class ChatManager:
@@ -17,6 +116,19 @@ class ChatManager:
         host_addr: Addr,
         chat_recv_observer: session.ProtocolContextChatObserver,
         session_close_observer: session.SessionCloseObserver,
+        high_water_mark: int = 4 * 1024 * 1024,
+        session_open_observer: Optional[session.SessionOpenObserver] = None,
+        connect_timeout: float = 5.0,
+        max_pending_connects: int = 16,
+        key_pool: Optional["KeyPool"] = None,
+        coalesce_window: float = 0.0,
+        coalesce_bytes: int = 64 * 1024,
+        transfer_observer: Optional[session.TransferObserver] = None,
+        download_dir: Optional[str] = None,
+        transfer_window: int = 256 * 1024,
+        ticket_lifetime: float = 3600.0,
+        ticket_capacity: int = 1024,
+        group_observer: Optional[GroupObserver] = None,
     ) -> None:
         self.chat_recv_observer: session.ProtocolContextChatObserver = (
             chat_recv_observer
@@ -24,82 +136,389 @@ class ChatManager:
         self.session_close_observer: session.SessionCloseObserver = (
             session_close_observer
         )
+        self.session_open_observer: Optional[session.SessionOpenObserver] = (
+            session_open_observer
+        )
+        self.high_water_mark = high_water_mark
+        self.connect_timeout = connect_timeout
+        self.max_pending_connects = max_pending_connects
+        self.key_pool: Optional["KeyPool"] = key_pool
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        # sessions holding messages back for a batch record
+        self.coalescing: Dict[socket.socket, ConnSessionPair] = {}
+        self.transfer_observer: Optional[session.TransferObserver] = transfer_observer
+        self.download_dir = download_dir
+        # file chunks are only queued while less than this is waiting to be
+        # written, chat records never sit behind more than a window of file
+        self.transfer_window = transfer_window
+        # resumption tickets issued to peers and the ones they issued to us,
+        # a lifetime of 0 turns resumption off
+        self.server_tickets: Optional[TicketCache] = None
+        self.client_tickets: Optional[TicketCache] = None
+        if ticket_lifetime > 0:
+            self.server_tickets = TicketCache(ticket_capacity, ticket_lifetime)
+            self.client_tickets = TicketCache(ticket_capacity, ticket_lifetime)
+        self.group_observer: Optional[GroupObserver] = group_observer
+        # groups this node owns or was invited to, by id
+        self.groups: Dict[str, Group] = {}
+        # sessions by the peer's advertised address and by socket, inbound
+        # sessions only get an address once their hello says who they are
         self.addr_conn_mapping: Dict[Addr, ConnSessionPair] = {}
+        self.conn_session_mapping: Dict[socket.socket, ConnSessionPair] = {}
+        self.conn_addr_mapping: Dict[socket.socket, Addr] = {}
+        self.pending_connects: Dict[socket.socket, PendingConnect] = {}
+        # inbound connections claiming the address of an established session,
+        # held until that session closes or, for one we dialled, until their
+        # own key exchange is through
+        self.unconfirmed: Dict[socket.socket, ConnSessionPair] = {}
+        # set while a record from one of those is handled. it only gets to
+        # finish its key exchange, what it says is not passed on under the
+        # address it claims. files are refused, it has no download dir yet
+        self.receiving_unconfirmed = False
+        self.queued_connects: Deque[Addr] = deque()
         self.poller = network.Poller()
         self.server_socket = self._create_tcp_server(host_addr)
+        self.listen_port: int = self.server_socket.getsockname()[1]
+        MANAGERS.add(self)
 
     def close_conn(self, addr: Addr):
+        # a connect still waiting for a free slot is called off as well
+        if addr in self.queued_connects:
+            self.queued_connects.remove(addr)
         conn_session = self.addr_conn_mapping.get(addr, None)
         if conn_session:
-            conn, session = conn_session
-            session.close_session(addr, self.session_close_observer)
+            self._close_conn(conn_session.conn)
+
+    def set_coalescing(self, addr: Addr, window: float, max_bytes: int = 64 * 1024):
+        conn_session = self.addr_conn_mapping.get(addr, None)
+        if conn_session:
+            conn_session.session.set_coalescing(window, max_bytes)
+            self._flush(conn_session)
+
+    def retrieve_active_sessions(self) -> Iterable[Addr]:
+        return (addr for addr in self.addr_conn_mapping.keys())
+
+    def stop(self):
+        MANAGERS.discard(self)
+        self.queued_connects.clear()
+        for conn in list(self.conn_session_mapping.keys()):
             self._close_conn(conn)
-            del self.addr_conn_mapping[addr]
+        self._close_conn(self.server_socket)
 
     def run(self, timeout: Optional[float] = None):
-        conns = self.poller.poll(timeout=timeout)
-        for conn in conns:
+        if self.pending_connects:
+            # wake up in time to expire the oldest connect attempt
+            deadline = min(
+                pending.deadline for pending in self.pending_connects.values()
+            )
+            wait = max(deadline - time.monotonic(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        if self.coalescing:
+            # and to send the batches whose window runs out first
+            deadline = min(
+                conn_session.session.pending_deadline or 0
+                for conn_session in self.coalescing.values()
+            )
+            wait = max(deadline - time.monotonic(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        events = self.poller.poll_events(timeout=timeout)
+        started = time.perf_counter()
+        for conn, mask in events:
             if conn == self.server_socket:
-                conn_session, addr = self._accept_new_conn(conn)
-                self.addr_conn_mapping[addr] = conn_session
+                self._accept_new_conn(conn)
+            elif conn in self.pending_connects:
+                self._finish_connect(conn)
             else:
                 try:
-                    recv_data = conn.recv(1024)
+                    conn_session = self.conn_session_mapping[conn]
 
-                    if not recv_data:
-                        self._close_conn(conn)
-                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(conn_session)
 
-                    remote_host, remote_port = conn.getpeername()
-                    conn_session = self.addr_conn_mapping.get(
-                        Addr(host=remote_host, port=remote_port), None
-                    )
-                    assert conn_session is not None
-                    response = conn_session.session.on_message_recv(recv_data)
-
-                    if response.status == ReponseStatus.DISCONNECT:
-                        self._close_conn(conn)
-                        continue
-
-                    if response.status == ReponseStatus.REPLY_NEEDED:
-                        conn.send(response.message)
+                    if mask & selectors.EVENT_READ:
+                        self._recv(conn_session)
 
                 except Exception as e:
                     print(f"conn exception: {e}")
+                    CONN_ERRORS.inc()
                     self._close_conn(conn)
 
+        self._expire_connects()
+        self._flush_batches()
+        POLL_SECONDS.observe(time.perf_counter() - started)
+
     def on_chat(self, addr: Addr, message: bytes):
+        if self.receiving_unconfirmed:
+            print(f"message claiming to be from {format_addr(addr)} dropped")
+            return
         self.chat_recv_observer.on_chat(addr, message)
 
-    def send_message(self, dest_addr: Addr, message: bytes):
+    def send_message(self, dest_addr: Addr, message: bytes) -> bool:
+        # returns False without sending when the peer is unknown, still in
+        # its key exchange or its outbound queue is above the high water mark
         conn_session = self.addr_conn_mapping.get(dest_addr, None)
-        if conn_session:
-            conn_session.session.send_message(
-                message, lambda data: conn_session.conn.send(data)
-            )
+        if (
+            not conn_session
+            or not conn_session.session.established
+            or conn_session.outbound.is_full()
+        ):
+            return False
+
+        # anything already queued is waiting for EVENT_WRITE, join that flush
+        flush_now = not conn_session.outbound
+        conn_session.session.send_message(
+            message, lambda data: self._push(conn_session, data)
+        )
+        if conn_session.session.pending_deadline is not None:
+            self.coalescing[conn_session.conn] = conn_session
+        elif flush_now:
+            self._flush(conn_session)
+
+        return True
+
+    def send_file(self, dest_addr: Addr, path: str) -> Optional[str]:
+        # returns the transfer id, the file is streamed in chunks from run()
+        # and the outcome reported through the transfer observer
+        conn_session = self.addr_conn_mapping.get(dest_addr, None)
+        if not conn_session:
+            return None
+
+        transfer_id = conn_session.session.send_file(path)
+        self._flush(conn_session)
+        return transfer_id
+
+    def create_group(self, members: Iterable[Addr]) -> str:
+        # every member needs an established session, the group key is handed
+        # out over it. returns the group id
+        members = list(members)
+        for addr in members:
+            self._group_session(addr)
+
+        group = Group(new_group_id(), members=members)
+        self.groups[group.group_id] = group
+        self._send_invites(group)
+        return group.group_id
+
+    def add_group_member(self, group_id: str, addr: Addr):
+        group = self._owned_group(group_id)
+        self._group_session(addr)
+        group.members.add(addr)
+        group.rekey()
+        self._send_invites(group)
+
+    def remove_group_member(self, group_id: str, addr: Addr):
+        # the rest get a new key the removed member never sees
+        group = self._owned_group(group_id)
+        group.members.discard(addr)
+        self._send_group_record(addr, GroupRecordKind.LEAVE, group_id, b"")
+        group.rekey()
+        self._send_invites(group)
+
+    def leave_group(self, group_id: str):
+        # the owner leaving ends the group for everyone
+        group = self.groups.pop(group_id, None)
+        if group is None:
+            return
+        addrs = group.members if group.owner is None else {group.owner}
+        for addr in addrs:
+            self._send_group_record(addr, GroupRecordKind.LEAVE, group_id, b"")
+
+    def group_members(self, group_id: str) -> List[Addr]:
+        group = self.groups.get(group_id, None)
+        return group.peers() if group else []
+
+    def send_group_message(self, group_id: str, message: bytes) -> int:
+        # sealed once under the group key whatever the number of members,
+        # the owner writes the same record to each of them and members hand
+        # it to the owner to pass on. returns the connections it was queued on
+        group = self.groups.get(group_id, None)
+        if group is None:
+            raise RuntimeError(f"unknown group: {group_id}")
+
+        sealed = group.seal(message)
+        if group.owner is not None:
+            return self._post(group_id, sealed, [group.owner])
+        return self._post(group_id, sealed, group.members)
+
+    def on_group_record(self, addr: Addr, kind: str, group_id: str, payload: bytes):
+        if self.receiving_unconfirmed:
+            print(f"group record claiming to be from {format_addr(addr)} dropped")
+            return
+        group = self.groups.get(group_id, None)
+        if kind == GroupRecordKind.INVITE:
+            if group is None:
+                group = Group(group_id, owner=addr)
+            elif group.owner != addr:
+                print(f"group {group_id}: invite from {format_addr(addr)} ignored")
+                GROUP_ERRORS.inc()
+                return
+            if group.accept(payload):
+                self.groups[group_id] = group
+                self._notify_group_update(group_id, group.peers())
+            return
+
+        if group is None:
+            # left already, whatever was in flight is dropped
+            return
+
+        if kind == GroupRecordKind.LEAVE:
+            if group.owner is None and addr in group.members:
+                group.members.discard(addr)
+                group.rekey()
+                self._send_invites(group)
+                self._notify_group_update(group_id, group.peers())
+            elif group.owner == addr:
+                del self.groups[group_id]
+                self._notify_group_update(group_id, [])
+            return
+
+        if kind == GroupRecordKind.POST:
+            self._on_group_post(group, addr, payload)
 
     def start_new_connection(self, dest_addr: Addr) -> None:
-        assert self.addr_conn_mapping.get(dest_addr, None) is None
+        # returns right away, the connect completes inside run() and failures
+        # are reported through the session close observer. a peer that is
+        # already connected, whoever dialled, is left as it is
+        if dest_addr in self.addr_conn_mapping or dest_addr in self.queued_connects:
+            return
 
-        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if len(self.pending_connects) >= self.max_pending_connects:
+            self.queued_connects.append(dest_addr)
+            return
 
-        conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        conn.connect((dest_addr.host, dest_addr.port))
+        self._connect(dest_addr)
 
-        self.poller.register(conn)
+    def _on_group_post(self, group: Group, addr: Addr, sealed: bytes):
+        try:
+            # a member still on the key before a membership change, or a
+            # post from anyone but the owner, is dropped not disconnected
+            name, sequence, message = group.open(sealed)
+            if group.owner is None:
+                if addr not in group.members or name != format_addr(addr):
+                    raise RuntimeError(f"post from {format_addr(addr)} as {name!r}")
+                sender = addr
+            else:
+                if addr != group.owner:
+                    raise RuntimeError(f"post from {format_addr(addr)}")
+                sender = parse_addr(name) if name else addr
+            group.check_sequence(name, sequence)
+        except Exception as e:
+            print(f"group {group.group_id}: {e}")
+            GROUP_ERRORS.inc()
+            return
+
+        if group.owner is None:
+            # passed on as it came, nothing is sealed again
+            self._post(
+                group.group_id,
+                sealed,
+                [member for member in group.members if member != addr],
+            )
+        if self.group_observer:
+            self.group_observer.on_group_message(group.group_id, sender, message)
+
+    def _post(self, group_id: str, sealed: bytes, addrs: Iterable[Addr]) -> int:
+        # one framed record per wire format, the same buffer is queued on
+        # every connection using it
+        frames: Dict[Optional[str], bytes] = {}
+        posted = 0
+        for addr in addrs:
+            conn_session = self.addr_conn_mapping.get(addr, None)
+            if (
+                not conn_session
+                or not conn_session.session.established
+                or conn_session.outbound.is_full()
+            ):
+                continue
 
-        remote_host, remote_port = conn.getpeername()
+            wire_format = conn_session.session.wire_format
+            frame = frames.get(wire_format, None)
+            if frame is None:
+                frame = frames[wire_format] = network.pack_frame(
+                    conn_session.session.encode_group_post(group_id, sealed)
+                )
 
-        if not self.addr_conn_mapping.get(dest_addr, None):
-            self.addr_conn_mapping[
-                Addr(host=remote_host, port=remote_port)
-            ] = ConnSessionPair(
-                conn=conn,
-                session=session.ClientSession(addr=dest_addr, chat_observer=self),
+            # messages held back for a batch go out first
+            conn_session.session.flush_pending()
+            flush_now = not conn_session.outbound
+            conn_session.outbound.push(frame)
+            RECORDS_SENT.inc()
+            if flush_now:
+                self._flush(conn_session)
+            posted += 1
+        return posted
+
+    def _send_invites(self, group: Group):
+        # the key goes to each member sealed by its own session
+        for addr in group.members:
+            self._send_group_record(
+                addr, GroupRecordKind.INVITE, group.group_id, group.invite(addr)
             )
 
-        conn.send(b"hello")  # send something to start key exchange handshake
+    def _send_group_record(
+        self, addr: Addr, kind: str, group_id: str, payload: bytes
+    ) -> bool:
+        conn_session = self.addr_conn_mapping.get(addr, None)
+        if not conn_session or not conn_session.session.established:
+            return False
+
+        flush_now = not conn_session.outbound
+        conn_session.session.send_group_record(
+            kind, group_id, payload, lambda data: self._push(conn_session, data)
+        )
+        if flush_now:
+            self._flush(conn_session)
+        return True
+
+    def _group_session(self, addr: Addr) -> ConnSessionPair:
+        conn_session = self.addr_conn_mapping.get(addr, None)
+        if not conn_session or not conn_session.session.established:
+            raise RuntimeError(f"no session with {format_addr(addr)}")
+        return conn_session
+
+    def _drop_group_peer(self, addr: Addr):
+        # a member gone with its session leaves the groups this node owns, the
+        # rest get a key it never saw. a group whose owner is gone has ended
+        for group_id, group in list(self.groups.items()):
+            if group.owner is None and addr in group.members:
+                group.members.discard(addr)
+                group.rekey()
+                self._send_invites(group)
+                self._notify_group_update(group_id, group.peers())
+            elif group.owner == addr:
+                del self.groups[group_id]
+                self._notify_group_update(group_id, [])
+
+    def _owned_group(self, group_id: str) -> Group:
+        group = self.groups.get(group_id, None)
+        if group is None or group.owner is not None:
+            raise RuntimeError(f"not the owner of group: {group_id}")
+        return group
+
+    def _notify_group_update(self, group_id: str, members: List[Addr]):
+        if self.group_observer:
+            self.group_observer.on_group_update(group_id, members)
+
+    def _session_count(self) -> int:
+        return len(self.addr_conn_mapping)
+
+    def _conn_count(self) -> int:
+        return len(self.conn_session_mapping)
+
+    def _outbound_bytes(self) -> int:
+        return sum(
+            conn_session.outbound.pending_bytes
+            for conn_session in self.conn_session_mapping.values()
+        )
+
+    def _pending_count(self) -> int:
+        return len(self.pending_connects)
+
+    def _queued_count(self) -> int:
+        return len(self.queued_connects)
 
     def _create_tcp_server(self, addr: Tuple[str, int]) -> socket.socket:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -109,28 +528,270 @@ class ChatManager:
 
         sock.bind(addr)
         sock.listen()
+        sock.setblocking(False)
 
         self.poller.register(sock)
         return sock
 
-    def _accept_new_conn(self, conn: socket.socket) -> Tuple[ConnSessionPair, Addr]:
+    def _accept_new_conn(self, conn: socket.socket):
         new_conn, remote_addr = conn.accept()
+        CONNECTIONS_ACCEPTED.inc()
         new_conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        new_conn.setblocking(False)
 
         self.poller.register(new_conn)
         host, port = remote_addr
 
-        return (
-            ConnSessionPair(
-                conn=new_conn,
-                session=session.ServerSession(
-                    Addr(host=host, port=port), chat_observer=self
-                ),
+        # registered under the peer's address once its hello has arrived
+        self.conn_session_mapping[new_conn] = ConnSessionPair(
+            conn=new_conn,
+            session=session.ServerSession(
+                Addr(host=host, port=port),
+                chat_observer=self,
+                key_pool=self.key_pool,
+                tickets=self.server_tickets,
             ),
-            Addr(host=host, port=port),
+            buffer=network.FrameBuffer(),
+            outbound=network.OutboundQueue(self.high_water_mark),
         )
+        self.conn_session_mapping[new_conn].session.set_group_observer(self)
+
+    def _connect(self, dest_addr: Addr):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        conn.setblocking(False)
+        CONNECTIONS_DIALLED.inc()
+
+        client_session = session.ClientSession(
+            addr=dest_addr,
+            chat_observer=self,
+            tickets=self.client_tickets,
+            listen_port=self.listen_port,
+        )
+        client_session.set_group_observer(self)
+        conn_session = ConnSessionPair(
+            conn=conn,
+            session=client_session,
+            buffer=network.FrameBuffer(),
+            outbound=network.OutboundQueue(self.high_water_mark),
+        )
+        self.poller.register(conn)
+        self.pending_connects[conn] = PendingConnect(
+            addr=dest_addr, deadline=time.monotonic() + self.connect_timeout
+        )
+        self.conn_session_mapping[conn] = conn_session
+        self._add_conn_session(dest_addr, conn_session)
+
+        # start the key exchange handshake, flushed once connected
+        self._push(conn_session, client_session.hello())
+
+        err = conn.connect_ex((dest_addr.host, dest_addr.port))
+        if err not in (0, errno.EINPROGRESS):
+            print(f"connect exception: {dest_addr} {errno.errorcode.get(err, err)}")
+            CONNECT_ERRORS.inc()
+            self._close_conn(conn)
+            return
+
+        self.poller.set_writable(conn, True)
+
+    def _finish_connect(self, conn: socket.socket):
+        pending = self.pending_connects.pop(conn)
+        err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            print(f"connect exception: {pending.addr} {errno.errorcode.get(err, err)}")
+            CONNECT_ERRORS.inc()
+            self._close_conn(conn)
+        else:
+            self._flush(self.conn_session_mapping[conn])
+
+        self._start_queued_connects()
+
+    def _expire_connects(self):
+        now = time.monotonic()
+        for conn, pending in list(self.pending_connects.items()):
+            if pending.deadline <= now:
+                print(f"connect timeout: {pending.addr}")
+                CONNECT_TIMEOUTS.inc()
+                self._close_conn(conn)
+
+    def _start_queued_connects(self):
+        while (
+            self.queued_connects
+            and len(self.pending_connects) < self.max_pending_connects
+        ):
+            dest_addr = self.queued_connects.popleft()
+            if dest_addr not in self.addr_conn_mapping:
+                self._connect(dest_addr)
+
+    def _flush_batches(self):
+        now = time.monotonic()
+        for conn, conn_session in list(self.coalescing.items()):
+            if conn_session.session.poll_timers(now) is None:
+                del self.coalescing[conn]
+                self._flush(conn_session)
+
+    def _add_conn_session(self, addr: Addr, conn_session: ConnSessionPair):
+        if self.transfer_observer:
+            conn_session.session.set_transfer_observer(
+                self.transfer_observer, self.download_dir
+            )
+        if self.coalesce_window > 0:
+            conn_session.session.set_coalescing(
+                self.coalesce_window, self.coalesce_bytes
+            )
+        self.addr_conn_mapping[addr] = conn_session
+        self.conn_addr_mapping[conn_session.conn] = addr
+        if self.session_open_observer:
+            self.session_open_observer.on_session_open(addr)
+
+    def _register_peer(self, conn_session: ConnSessionPair):
+        # called once the hello of an inbound session is in
+        conn = conn_session.conn
+        addr = conn_session.session.addr
+        existing = self.addr_conn_mapping.get(addr, None)
+
+        if existing is None:
+            self._add_conn_session(addr, conn_session)
+            return
+
+        # both sides dialled, keep the connection opened by the lower address.
+        # each end sees the same pair of addresses so both keep the same one.
+        # only the dialling side closes the other connection, until then it
+        # stays parked here and whatever still arrives on it is delivered
+        self.conn_addr_mapping[conn] = addr
+        dialled = isinstance(existing.session, session.ClientSession)
+        if existing.session.established and (
+            not dialled or not conn_session.session.established
+        ):
+            # the listen port in a hello is only a claim, anyone can make it.
+            # an established inbound session is kept while it lives, one we
+            # dialled is not given up before the newcomer's key exchange
+            self.unconfirmed[conn] = conn_session
+            return
+
+        local_host = conn.getsockname()[0]
+        if dialled and (local_host, self.listen_port) < (addr.host, addr.port):
+            return
+
+        # a peer dialling in again replaces its older inbound connection
+        self.addr_conn_mapping[addr] = conn_session
+        self._close_conn(existing.conn)
+
+    def _promote_unconfirmed(self, addr: Addr) -> bool:
+        # a connection held back for addr takes over once its session is gone
+        for conn, conn_session in list(self.unconfirmed.items()):
+            if self.conn_addr_mapping.get(conn) == addr:
+                del self.unconfirmed[conn]
+                self._add_conn_session(addr, conn_session)
+                return True
+        return False
+
+    def _recv(self, conn_session: ConnSessionPair):
+        conn = conn_session.conn
+        try:
+            nbytes = conn_session.buffer.recv_from(conn)
+            if not nbytes:
+                self._close_conn(conn)
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        BYTES_RECEIVED.inc(nbytes)
+
+        for record in conn_session.buffer.frames():
+            RECORDS_RECEIVED.inc()
+            self.receiving_unconfirmed = conn in self.unconfirmed
+            response = conn_session.session.on_message_recv(record)
+            self.receiving_unconfirmed = False
+
+            if response.status == ReponseStatus.DISCONNECT:
+                self._close_conn(conn)
+                return
+
+            if response.status == ReponseStatus.REPLY_NEEDED:
+                self._push(conn_session, response.message)
+
+            if conn not in self.conn_addr_mapping:
+                self._register_peer(conn_session)
+
+        if conn in self.unconfirmed and conn_session.session.established:
+            del self.unconfirmed[conn]
+            self._register_peer(conn_session)
+
+        self._flush(conn_session)
+
+    def _push(self, conn_session: ConnSessionPair, data: bytes) -> int:
+        conn_session.outbound.push(network.pack_frame(data))
+        RECORDS_SENT.inc()
+        return len(data)
+
+    def _flush(self, conn_session: ConnSessionPair):
+        conn = conn_session.conn
+        if conn in self.pending_connects:
+            return
+
+        outbound = conn_session.outbound
+        try:
+            queued = outbound.pending_bytes
+            drained = outbound.flush(conn)
+            BYTES_SENT.inc(queued - outbound.pending_bytes)
+            if drained and conn_session.session.transfer_ready:
+                self._queue_chunks(conn_session)
+                queued = outbound.pending_bytes
+                drained = outbound.flush(conn)
+                BYTES_SENT.inc(queued - outbound.pending_bytes)
+            # keep EVENT_WRITE while a transfer still has chunks to queue
+            self.poller.set_writable(
+                conn, not drained or conn_session.session.transfer_ready
+            )
+        except OSError as e:
+            print(f"conn exception: {e}")
+            CONN_ERRORS.inc()
+            self._close_conn(conn)
+
+    def _queue_chunks(self, conn_session: ConnSessionPair):
+        outbound = conn_session.outbound
+        while (
+            conn_session.session.transfer_ready
+            and outbound.pending_bytes < self.transfer_window
+        ):
+            conn_session.session.send_transfer_chunk(
+                lambda data: self._push(conn_session, data)
+            )
 
     def _close_conn(self, conn: socket.socket):
+        if self.pending_connects.pop(conn, None):
+            self._start_queued_connects()
+        self.coalescing.pop(conn, None)
+        self.unconfirmed.pop(conn, None)
+
+        conn_session = self.conn_session_mapping.get(conn, None)
+        if (
+            conn_session is not None
+            and conn_session.session.pending_deadline is not None
+        ):
+            # messages held for a batch get one last try at the socket
+            conn_session.session.flush_pending()
+            try:
+                conn_session.outbound.flush(conn)
+            except OSError:
+                pass
+
+        conn_session = self.conn_session_mapping.pop(conn, None)
+        addr = self.conn_addr_mapping.pop(conn, None)
+        if conn_session is not None:
+            CONNECTIONS_CLOSED.inc()
+            if addr is not None and self.addr_conn_mapping.get(addr) is conn_session:
+                del self.addr_conn_mapping[addr]
+                conn_session.session.close_session(addr, self.session_close_observer)
+                if not self._promote_unconfirmed(addr):
+                    self._drop_group_peer(addr)
+            else:
+                # a duplicate that lost or a peer gone before its hello, it
+                # was never reported open
+                conn_session.session.release()
+
         try:
             print(f"connection close: {conn}")
             self.poller.unregister(conn)
@@ -0,0 +1,84 @@
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import os
+import struct
+
+from typing import Dict, Tuple, Type, Union
+
+import metrics
+
+AES_256_GCM = "aes-256-gcm"
+CHACHA20_POLY1305 = "chacha20-poly1305"
+
+ALGORITHMS: Dict[str, Type[Union[AESGCM, ChaCha20Poly1305]]] = {
+    AES_256_GCM: AESGCM,
+    CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+# 4 zero bytes followed by a 64 bit message counter
+NONCE = struct.Struct("!4xQ")
+
+KEY_SIZE = 32
+NONCE_SIZE = 12
+
+
+def generate_key() -> bytes:
+    return os.urandom(KEY_SIZE)
+
+
+def derive_keys(secret: bytes, algorithm: str, initiator: bool) -> Tuple[bytes, bytes]:
+    # one key per direction so both sides can count nonces from zero
+    key_material = HKDF(
+        algorithm=hashes.SHA256(),
+        length=64,
+        salt=None,
+        info=b"zerotrust_chat " + algorithm.encode(),
+    ).derive(secret)
+    initiator_key, responder_key = key_material[:32], key_material[32:]
+
+    if initiator:
+        return initiator_key, responder_key
+    return responder_key, initiator_key
+
+
+class AeadCipher:
+    # nonces are implicit counters, records must be decrypted in the order
+    # they were encrypted, which the tcp stream guarantees
+    def __init__(self, algorithm: str, send_key: bytes, recv_key: bytes) -> None:
+        self._send_cipher = ALGORITHMS[algorithm](send_key)
+        self._recv_cipher = ALGORITHMS[algorithm](recv_key)
+        self._send_counter = 0
+        self._recv_counter = 0
+
+    @metrics.crypto_timer("aead.encrypt")
+    def encrypt(self, message: bytes) -> bytes:
+        nonce = NONCE.pack(self._send_counter)
+        self._send_counter += 1
+        return self._send_cipher.encrypt(nonce, message, None)
+
+    @metrics.crypto_timer("aead.decrypt")
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        nonce = NONCE.pack(self._recv_counter)
+        message = self._recv_cipher.decrypt(nonce, ciphertext, None)
+        self._recv_counter += 1
+        return message
+
+
+class RandomNonceCipher:
+    # aes-gcm with a random nonce sealed ahead of every message, for keys
+    # there is no single counter for. stored files are truncated and appended
+    # to again, group keys are shared by every member. ops are timed under
+    # "<name>.seal" and "<name>.open"
+    def __init__(self, key: bytes, name: str) -> None:
+        self._cipher = AESGCM(key)
+        self.seal = metrics.crypto_timer(f"{name}.seal")(self._seal)
+        self.open = metrics.crypto_timer(f"{name}.open")(self._open)
+
+    def _seal(self, message: bytes, associated_data: bytes) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._cipher.encrypt(nonce, message, associated_data)
+
+    def _open(self, sealed: bytes, associated_data: bytes) -> bytes:
+        nonce = sealed[:NONCE_SIZE]
+        return self._cipher.decrypt(nonce, sealed[NONCE_SIZE:], associated_data)
@@ -1,17 +1,35 @@
 from cryptography.fernet import Fernet
 
+import metrics
+
 
 def generate_key() -> bytes:
     return Fernet.generate_key()
 
 
+@metrics.crypto_timer("aes.encrypt_message")
 def encrypt_message(key: bytes, message: bytes):
     cipher_suite = Fernet(key)
     ciphertext = cipher_suite.encrypt(message)
     return ciphertext
 
 
+@metrics.crypto_timer("aes.decrypt_message")
 def decrypt_message(key: bytes, ciphertext: bytes) -> bytes:
     cipher_suite = Fernet(key)
     decrypted_message = cipher_suite.decrypt(ciphertext)
     return decrypted_message
+
+
+class FernetCipher:
+    # keeps the decoded key around instead of rebuilding Fernet per message
+    def __init__(self, key: bytes) -> None:
+        self._cipher_suite = Fernet(key)
+
+    @metrics.crypto_timer("aes.encrypt")
+    def encrypt(self, message: bytes) -> bytes:
+        return self._cipher_suite.encrypt(message)
+
+    @metrics.crypto_timer("aes.decrypt")
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        return self._cipher_suite.decrypt(ciphertext)
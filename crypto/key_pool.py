@@ -0,0 +1,94 @@
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+from typing import Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
+
+from crypto import rsa
+
+KeyPair = Tuple[RSAPrivateKey, RSAPublicKey]
+
+
+def _generate_private_key_bytes() -> bytes:
+    private_key, _ = rsa.generate_key_pair()
+    return rsa.private_key_to_bytes(private_key)
+
+
+class KeyPool:
+    # keeps a bounded stock of ready rsa key pairs so a handshake never pays
+    # for key generation. keys are generated by a background thread, in a
+    # helper process by default since generation holds the gil.
+    def __init__(
+        self,
+        depth: int = 4,
+        refill_interval: float = 0.0,
+        max_reuse: int = 1,
+        use_process: bool = True,
+    ) -> None:
+        assert depth > 0 and max_reuse > 0
+        self.keys: "queue.Queue[KeyPair]" = queue.Queue(maxsize=depth)
+        self.refill_interval = refill_interval
+        self.max_reuse = max_reuse
+
+        self._current: Optional[KeyPair] = None
+        self._uses_left = 0
+        self._stopped = threading.Event()
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if use_process:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+
+        self._thread = threading.Thread(
+            target=self._refill, name="rsa-key-pool", daemon=True
+        )
+        self._thread.start()
+
+    def take(self) -> KeyPair:
+        if not self._uses_left:
+            try:
+                self._current = self.keys.get_nowait()
+            except queue.Empty:
+                # drained by a burst, generate inline rather than wait
+                self._current = rsa.generate_key_pair()
+            self._uses_left = self.max_reuse
+
+        assert self._current
+        self._uses_left -= 1
+        return self._current
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._thread.join()
+
+    def _refill(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                key_pair = self._generate()
+            except Exception as e:
+                if not self._stopped.is_set():
+                    print(f"key pool exception: {e}")
+                return
+
+            while not self._stopped.is_set():
+                try:
+                    self.keys.put(key_pair, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+            if self.refill_interval:
+                self._stopped.wait(self.refill_interval)
+
+    def _generate(self) -> KeyPair:
+        if self._executor is None:
+            return rsa.generate_key_pair()
+
+        private_key = rsa.bytes_to_private_key(
+            self._executor.submit(_generate_private_key_bytes).result()
+        )
+        return private_key, private_key.public_key()
@@ -5,7 +5,10 @@ from cryptography.hazmat.primitives import serialization
 
 from typing import Tuple
 
+import metrics
 
+
+@metrics.crypto_timer("rsa.generate_key_pair")
 def generate_key_pair() -> Tuple[rsa.RSAPrivateKey, rsa.RSAPublicKey]:
     private_key = rsa.generate_private_key(
         public_exponent=65537,
@@ -16,6 +19,7 @@ def generate_key_pair() -> Tuple[rsa.RSAPrivateKey, rsa.RSAPublicKey]:
     return private_key, public_key
 
 
+@metrics.crypto_timer("rsa.encrypt_message")
 def encrypt_message(public_key: rsa.RSAPublicKey, message: bytes) -> bytes:
     ciphertext = public_key.encrypt(
         message,
@@ -28,6 +32,7 @@ def encrypt_message(public_key: rsa.RSAPublicKey, message: bytes) -> bytes:
     return ciphertext
 
 
+@metrics.crypto_timer("rsa.decrypt_message")
 def decrypt_message(private_key: rsa.RSAPrivateKey, ciphertext: bytes) -> bytes:
     plaintext = private_key.decrypt(
         ciphertext,
@@ -40,19 +45,46 @@ def decrypt_message(private_key: rsa.RSAPrivateKey, ciphertext: bytes) -> bytes:
     return plaintext
 
 
-def public_key_to_bytes(public_key: rsa.RSAPublicKey):
+def public_key_to_bytes(public_key: rsa.RSAPublicKey, der: bool = False):
     public_key_bytes = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
+        encoding=serialization.Encoding.DER if der else serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo,
     )
     return public_key_bytes
 
 
-def bytes_to_public_key(public_key_bytes: bytes) -> rsa.RSAPublicKey:
-    public_key = serialization.load_pem_public_key(
-        public_key_bytes, backend=default_backend()
+def private_key_to_bytes(private_key: rsa.RSAPrivateKey) -> bytes:
+    private_key_bytes = private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    return private_key_bytes
+
+
+def bytes_to_private_key(private_key_bytes: bytes) -> rsa.RSAPrivateKey:
+    # only used for keys this process asked a worker to generate, so the
+    # expensive consistency check can be skipped
+    private_key = serialization.load_der_private_key(
+        private_key_bytes, password=None, unsafe_skip_rsa_key_validation=True
     )
 
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key
+
+    raise RuntimeError("invalid key type, expecting RSAPrivateKey")
+
+
+def bytes_to_public_key(public_key_bytes: bytes) -> rsa.RSAPublicKey:
+    if public_key_bytes.startswith(b"-----BEGIN"):
+        public_key = serialization.load_pem_public_key(
+            public_key_bytes, backend=default_backend()
+        )
+    else:
+        public_key = serialization.load_der_public_key(
+            public_key_bytes, backend=default_backend()
+        )
+
     if isinstance(public_key, rsa.RSAPublicKey):
         return public_key
 
@@ -0,0 +1,33 @@
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import os
+
+from crypto.aead import KEY_SIZE, generate_key
+
+
+def load_or_create_key(path: str) -> bytes:
+    # the key file is only ever readable by its owner
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+        if len(key) != KEY_SIZE:
+            raise RuntimeError(f"bad storage key in {path}")
+        return key
+    except FileNotFoundError:
+        pass
+
+    key = generate_key()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def derive_key(master_key: bytes, name: str) -> bytes:
+    # one key per file, so nothing encrypted for one file opens in another
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=None,
+        info=b"zerotrust_chat storage " + name.encode(),
+    ).derive(master_key)
@@ -0,0 +1,38 @@
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
+import os
+
+TICKET_SIZE = 16
+NONCE_SIZE = 16
+
+
+def new_ticket() -> bytes:
+    return os.urandom(TICKET_SIZE)
+
+
+def new_nonce() -> bytes:
+    return os.urandom(NONCE_SIZE)
+
+
+def resumption_secret(secret: bytes) -> bytes:
+    # kept by both sides once a session is up, never used to encrypt anything
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"zerotrust_chat resumption",
+    ).derive(secret)
+
+
+def resumed_secret(
+    resumption_secret: bytes, client_nonce: bytes, server_nonce: bytes
+) -> bytes:
+    # returns a fernet key, fresh for every resumption thanks to both nonces
+    derived_key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"zerotrust_chat resume" + client_nonce + server_nonce,
+    ).derive(resumption_secret)
+    return base64.urlsafe_b64encode(derived_key)
@@ -0,0 +1,41 @@
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
+
+from typing import Tuple
+
+
+def generate_key_pair() -> Tuple[x25519.X25519PrivateKey, x25519.X25519PublicKey]:
+    private_key = x25519.X25519PrivateKey.generate()
+    public_key = private_key.public_key()
+
+    return private_key, public_key
+
+
+def public_key_to_bytes(public_key: x25519.X25519PublicKey) -> bytes:
+    public_key_bytes = public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+    return public_key_bytes
+
+
+def bytes_to_public_key(public_key_bytes: bytes) -> x25519.X25519PublicKey:
+    return x25519.X25519PublicKey.from_public_bytes(public_key_bytes)
+
+
+def derive_secret(
+    private_key: x25519.X25519PrivateKey,
+    peer_public_key: x25519.X25519PublicKey,
+    info: bytes,
+) -> bytes:
+    # returns a fernet key, info binds it to both public keys of the exchange
+    shared_key = private_key.exchange(peer_public_key)
+    derived_key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+    ).derive(shared_key)
+    return base64.urlsafe_b64encode(derived_key)
@@ -0,0 +1,626 @@
+import argparse
+import json
+import os
+import selectors
+import socket
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Union,
+)
+
+# taken ahead of the imports below, startup is measured from here
+STARTED = time.perf_counter()
+
+import chat_manager
+import gossip_discovery
+import metrics
+import network
+import service_discovery
+import session
+import supervisor
+import tracing
+from network import Addr, format_addr, parse_addr
+
+if TYPE_CHECKING:
+    from crypto.key_pool import KeyPool
+    from history import HistoryStore
+
+STARTUP_LISTENING = metrics.REGISTRY.gauge(
+    "startup_seconds",
+    "seconds from process start to each startup phase",
+    phase="listening",
+)
+STARTUP_READY = metrics.REGISTRY.gauge(
+    "startup_seconds",
+    "seconds from process start to each startup phase",
+    phase="ready",
+)
+
+GROUP_COMMANDS = (
+    "group_create",
+    "group_send",
+    "group_add",
+    "group_remove",
+    "group_leave",
+    "groups",
+)
+
+
+class CommandHandler(Protocol):
+    def on_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        pass
+
+
+class ControlClient:
+    def __init__(self, conn: socket.socket) -> None:
+        self.conn = conn
+        self.inbound = bytearray()
+        self.outbound = network.OutboundQueue()
+
+
+class ControlServer:
+    # newline delimited json over a unix domain socket, every line received is
+    # a command answered by one reply line, events are pushed to all clients
+    def __init__(self, path: str, command_handler: CommandHandler) -> None:
+        self.path = path
+        self.command_handler: CommandHandler = command_handler
+        self.poller = network.Poller()
+        self.clients: Dict[socket.socket, ControlClient] = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.poller.register(self.sock)
+
+    def poll(self, timeout: Optional[float] = None):
+        for conn, mask in self.poller.poll_events(timeout):
+            if conn == self.sock:
+                new_conn, _ = conn.accept()
+                new_conn.setblocking(False)
+                self.poller.register(new_conn)
+                self.clients[new_conn] = ControlClient(new_conn)
+                continue
+
+            client = self.clients[conn]
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(client)
+
+                if mask & selectors.EVENT_READ:
+                    self._recv(client)
+
+            except OSError as e:
+                print(f"control exception: {e}")
+                self._close_client(client)
+
+    def broadcast(self, event: Dict[str, Any]):
+        for client in list(self.clients.values()):
+            self._write(client, event)
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self._close_client(client)
+        self.poller.unregister(self.sock)
+        self.sock.close()
+        os.unlink(self.path)
+
+    def _recv(self, client: ControlClient):
+        data = client.conn.recv(4096)
+        if not data:
+            self._close_client(client)
+            return
+
+        client.inbound += data
+        *lines, rest = client.inbound.split(b"\n")
+        client.inbound = bytearray(rest)
+
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                reply = self.command_handler.on_command(json.loads(line))
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self._write(client, reply)
+
+    def _write(self, client: ControlClient, message: Dict[str, Any]):
+        if client.conn not in self.clients:
+            return
+        flush_now = not client.outbound
+        client.outbound.push(json.dumps(message).encode() + b"\n")
+        if flush_now:
+            self._flush(client)
+
+    def _flush(self, client: ControlClient):
+        try:
+            drained = client.outbound.flush(client.conn)
+            self.poller.set_writable(client.conn, not drained)
+        except OSError:
+            self._close_client(client)
+
+    def _close_client(self, client: ControlClient):
+        if self.clients.pop(client.conn, None) is None:
+            return
+        try:
+            self.poller.unregister(client.conn)
+            client.conn.close()
+        except Exception:
+            pass
+
+
+class Daemon:
+    # runs the chat, discovery and session layers without a gui, driven
+    # through the control socket
+    def __init__(
+        self,
+        local_addr: Addr,
+        multicast_addr: Addr,
+        control_path: str,
+        tick: float = 0.01,
+        workers: int = 0,
+        key_pool_depth: int = 4,
+        coalesce_window: float = 0.0,
+        download_dir: Optional[str] = None,
+        seeds: Optional[Sequence[Addr]] = None,
+        metrics_path: Optional[str] = None,
+        metrics_interval: float = 5.0,
+        trace_capacity: int = 0,
+        dump_prefix: Optional[str] = None,
+        history_dir: Optional[str] = None,
+        history_key: Optional[str] = None,
+    ) -> None:
+        self.tick = tick
+        # with workers the sessions, and so their traces, live elsewhere
+        self.trace_buffer: Optional[tracing.TraceBuffer] = None
+        self.profiler = tracing.SamplingProfiler()
+        self.dump_prefix = dump_prefix or f"/tmp/zerotrust_chat_{local_addr.port}"
+        self.set_tracing(trace_capacity)
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.running = False
+        # the pool is started by finish_startup, sessions accepted before
+        # that generate their own keys
+        self.key_pool: Optional["KeyPool"] = None
+        self.key_pool_depth = 0 if workers else key_pool_depth
+        self.started = False
+
+        # the listener comes first, peers connecting while the rest starts
+        # wait in its backlog rather than being refused
+        # with workers the sessions live in forked processes sharing the port
+        self.chat_manager: Union[chat_manager.ChatManager, supervisor.Supervisor]
+        if workers:
+            self.chat_manager = supervisor.Supervisor(
+                host_addr=local_addr,
+                chat_recv_observer=self,
+                session_close_observer=self,
+                workers=workers,
+                tick=tick,
+                key_pool_depth=key_pool_depth,
+                coalesce_window=coalesce_window,
+            )
+        else:
+            self.chat_manager = chat_manager.ChatManager(
+                host_addr=local_addr,
+                chat_recv_observer=self,
+                session_close_observer=self,
+                coalesce_window=coalesce_window,
+                transfer_observer=self,
+                download_dir=download_dir,
+                group_observer=self,
+            )
+        self.control_server = ControlServer(control_path, command_handler=self)
+        STARTUP_LISTENING.set(time.perf_counter() - STARTED)
+
+        # messages both ways are kept encrypted on disk when a dir is given.
+        # opened before the first tick so none go unrecorded
+        self.history: Optional["HistoryStore"] = None
+        if history_dir:
+            from history import HistoryStore, default_key_path
+
+            self.history = HistoryStore(
+                history_dir, history_key or default_key_path(history_dir)
+            )
+
+        self.service_discovery_client: Union[
+            service_discovery.ServiceDiscoveryClient, gossip_discovery.GossipDiscovery
+        ]
+        self.service_discovery_server: Union[
+            service_discovery.ServiceDiscoveryServer, gossip_discovery.GossipDiscovery
+        ]
+        if seeds is not None:
+            # one gossip node plays both parts over unicast
+            gossip = gossip_discovery.GossipDiscovery(
+                local_addr=local_addr, seeds=seeds, peer_observer=self
+            )
+            self.service_discovery_client = gossip
+            self.service_discovery_server = gossip
+        else:
+            self.service_discovery_client = service_discovery.ServiceDiscoveryClient(
+                local_addr=local_addr, multicast_addr=multicast_addr
+            )
+            self.service_discovery_server = service_discovery.ServiceDiscoveryServer(
+                local_addr=local_addr, multicast_addr=multicast_addr, peer_observer=self
+            )
+
+        metrics.REGISTRY.gauge(
+            "discovery_peers",
+            "peers currently known to discovery",
+            fn=lambda: len(self.service_discovery_server.last_seen),
+        )
+
+    def loop(self):
+        self.running = True
+        next_publish = 0.0
+        next_metrics = 0.0
+        try:
+            while self.running:
+                now = time.monotonic()
+                if self.metrics_path and now >= next_metrics:
+                    metrics.REGISTRY.write(self.metrics_path)
+                    next_metrics = now + self.metrics_interval
+
+                if now >= next_publish:
+                    self.service_discovery_client.publish()
+                    next_publish = now + self.service_discovery_client.next_interval(
+                        len(self.service_discovery_server.last_seen)
+                    )
+
+                self.chat_manager.run(self.tick)
+                self.service_discovery_server.poll(timeout=0)
+                self.control_server.poll(timeout=0)
+
+                if not self.started:
+                    self.finish_startup()
+        finally:
+            self.profiler.stop()
+            self.chat_manager.stop()
+            if self.key_pool:
+                self.key_pool.stop()
+            self.control_server.close()
+            if self.history:
+                self.history.close()
+
+    def finish_startup(self):
+        # what the first handshake needs but listening does not, done once
+        # the first tick has served whoever was already waiting
+        self.started = True
+        if self.key_pool_depth:
+            from crypto.key_pool import KeyPool
+
+            self.key_pool = KeyPool(depth=self.key_pool_depth)
+            assert isinstance(self.chat_manager, chat_manager.ChatManager)
+            self.chat_manager.key_pool = self.key_pool
+        session.preload()
+        STARTUP_READY.set(time.perf_counter() - STARTED)
+
+    def set_tracing(self, capacity: int):
+        # a capacity of 0 turns tracing off, a new capacity starts over
+        if self.trace_buffer is not None:
+            tracing.TRACER.remove_hook(self.trace_buffer)
+            self.trace_buffer = None
+        if capacity > 0:
+            self.trace_buffer = tracing.TraceBuffer(capacity)
+            tracing.TRACER.add_hook(self.trace_buffer)
+
+    def install_signal_handlers(self):
+        tracing.install_signal_handlers(self.profiler, self.dump)
+
+    def dump(self):
+        # the trace ring and the profile so far, for a node that is stuck
+        # too badly to answer on the control socket
+        if self.trace_buffer is not None:
+            self.trace_buffer.write(f"{self.dump_prefix}.trace.jsonl")
+        with open(f"{self.dump_prefix}.profile.folded", "w") as f:
+            f.write(self.profiler.folded())
+
+    def on_chat(self, addr: Addr, message: bytes):
+        if self.history:
+            self.history.log(addr).append(False, message)
+        self.control_server.broadcast(
+            {
+                "event": "chat",
+                "addr": format_addr(addr),
+                "message": message.decode(errors="replace"),
+            }
+        )
+
+    def on_session_close(self, addr: Addr):
+        self.control_server.broadcast(
+            {"event": "session_close", "addr": format_addr(addr)}
+        )
+
+    def on_peers_changed(self, added: List[Addr], removed: List[Addr]):
+        self.control_server.broadcast(
+            {
+                "event": "peers",
+                "added": self._format_addrs(added),
+                "removed": self._format_addrs(removed),
+            }
+        )
+
+    def on_transfer_done(self, addr: Addr, transfer_id: str, path: str):
+        self.control_server.broadcast(
+            {
+                "event": "transfer_done",
+                "addr": format_addr(addr),
+                "transfer": transfer_id,
+                "path": path,
+            }
+        )
+
+    def on_transfer_failed(self, addr: Addr, transfer_id: str, reason: str):
+        self.control_server.broadcast(
+            {
+                "event": "transfer_failed",
+                "addr": format_addr(addr),
+                "transfer": transfer_id,
+                "reason": reason,
+            }
+        )
+
+    def on_group_message(self, group_id: str, addr: Addr, message: bytes):
+        self.control_server.broadcast(
+            {
+                "event": "group_chat",
+                "group": group_id,
+                "addr": format_addr(addr),
+                "message": message.decode(errors="replace"),
+            }
+        )
+
+    def on_group_update(self, group_id: str, members: List[Addr]):
+        self.control_server.broadcast(
+            {
+                "event": "group",
+                "group": group_id,
+                "members": self._format_addrs(members),
+            }
+        )
+
+    def on_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        cmd = command.get("cmd")
+
+        if cmd == "connect":
+            addr = parse_addr(command["addr"])
+            if addr not in set(self.chat_manager.retrieve_active_sessions()):
+                self.chat_manager.start_new_connection(addr)
+            return {"ok": True}
+
+        if cmd == "send":
+            addr = parse_addr(command["addr"])
+            message = command["message"].encode()
+            sent = self.chat_manager.send_message(addr, message)
+            if sent and self.history:
+                self.history.log(addr).append(True, message)
+            return {"ok": sent}
+
+        if cmd == "history":
+            # count entries before "before", the latest ones by default
+            if not self.history:
+                return {"ok": False, "error": "history is off"}
+            history_log = self.history.log(parse_addr(command["addr"]))
+            end = int(command.get("before", len(history_log)))
+            entries = history_log.page(end, int(command.get("count", 50)))
+            return {
+                "ok": True,
+                "total": len(history_log),
+                "start": max(min(end, len(history_log)) - len(entries), 0),
+                "entries": [
+                    {
+                        "time": entry.timestamp,
+                        "outgoing": entry.outgoing,
+                        "message": entry.message.decode(errors="replace"),
+                    }
+                    for entry in entries
+                ],
+            }
+
+        if cmd == "send_file":
+            if not isinstance(self.chat_manager, chat_manager.ChatManager):
+                return {"ok": False, "error": "file transfers need --workers 0"}
+            transfer_id = self.chat_manager.send_file(
+                parse_addr(command["addr"]), command["path"]
+            )
+            return {"ok": transfer_id is not None, "transfer": transfer_id}
+
+        if cmd in GROUP_COMMANDS:
+            if not isinstance(self.chat_manager, chat_manager.ChatManager):
+                return {"ok": False, "error": "groups need --workers 0"}
+            return self._on_group_command(cmd, command, self.chat_manager)
+
+        if cmd == "list":
+            return {
+                "ok": True,
+                "sessions": self._format_addrs(
+                    self.chat_manager.retrieve_active_sessions()
+                ),
+                "peers": self._format_addrs(
+                    self.service_discovery_server.retrieve_active_address()
+                ),
+            }
+
+        if cmd == "metrics":
+            # with workers this only covers the supervisor process
+            return {"ok": True, "metrics": metrics.REGISTRY.snapshot()}
+
+        if cmd == "trace":
+            self.set_tracing(int(command.get("capacity", 10000)))
+            return {"ok": True}
+
+        if cmd == "trace_dump":
+            if self.trace_buffer is None:
+                return {"ok": False, "error": "tracing is off"}
+            return {"ok": True, "records": self.trace_buffer.dump(command.get("limit"))}
+
+        if cmd == "profile":
+            action = command.get("action", "report")
+            if action == "start":
+                self.profiler.start()
+            elif action == "stop":
+                self.profiler.stop()
+            elif action == "clear":
+                self.profiler.clear()
+            elif action != "report":
+                return {"ok": False, "error": f"unknown profile action: {action}"}
+            return {
+                "ok": True,
+                "running": self.profiler.running,
+                "samples": self.profiler.samples,
+                "top": self.profiler.top(int(command.get("limit", 20))),
+                "folded": self.profiler.folded(),
+            }
+
+        if cmd == "close":
+            self.chat_manager.close_conn(parse_addr(command["addr"]))
+            return {"ok": True}
+
+        if cmd == "shutdown":
+            self.running = False
+            return {"ok": True}
+
+        return {"ok": False, "error": f"unknown command: {cmd}"}
+
+    def _on_group_command(
+        self, cmd: str, command: Dict[str, Any], manager: chat_manager.ChatManager
+    ) -> Dict[str, Any]:
+        if cmd == "group_create":
+            group_id = manager.create_group(
+                parse_addr(addr) for addr in command["members"]
+            )
+            return {"ok": True, "group": group_id}
+
+        if cmd == "group_send":
+            posted = manager.send_group_message(
+                command["group"], command["message"].encode()
+            )
+            return {"ok": posted > 0, "sent": posted}
+
+        if cmd == "group_add":
+            manager.add_group_member(command["group"], parse_addr(command["addr"]))
+            return {"ok": True}
+
+        if cmd == "group_remove":
+            manager.remove_group_member(command["group"], parse_addr(command["addr"]))
+            return {"ok": True}
+
+        if cmd == "group_leave":
+            manager.leave_group(command["group"])
+            return {"ok": True}
+
+        if cmd == "groups":
+            return {
+                "ok": True,
+                "groups": {
+                    group_id: self._format_addrs(manager.group_members(group_id))
+                    for group_id in manager.groups
+                },
+            }
+
+        return {"ok": False, "error": f"unknown command: {cmd}"}
+
+    def _format_addrs(self, addrs: Iterable[Addr]) -> List[str]:
+        return sorted(format_addr(addr) for addr in addrs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless zero trust chat node")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--control", help="unix socket path for the control api")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="fork this many worker processes sharing the listening port",
+    )
+    parser.add_argument(
+        "--key-pool",
+        type=int,
+        default=4,
+        help="rsa key pairs kept ready for incoming handshakes, 0 to disable",
+    )
+    parser.add_argument(
+        "--coalesce",
+        type=float,
+        default=0.0,
+        help="milliseconds to hold outgoing messages for one batch record",
+    )
+    parser.add_argument(
+        "--downloads", help="directory incoming files are written to, off if unset"
+    )
+    parser.add_argument(
+        "--gossip",
+        action="store_true",
+        help="discover peers by unicast gossip instead of multicast",
+    )
+    parser.add_argument(
+        "--seed",
+        action="append",
+        default=[],
+        help="host:port of a node to start gossiping with, may be repeated",
+    )
+    parser.add_argument(
+        "--metrics-file", help="path a metrics snapshot is written to periodically"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=5.0,
+        help="seconds between metrics snapshots",
+    )
+    parser.add_argument(
+        "--trace",
+        type=int,
+        default=0,
+        help="keep the last N per record traces, 0 to start with tracing off",
+    )
+    parser.add_argument(
+        "--history", help="directory messages are kept in, encrypted, off if unset"
+    )
+    parser.add_argument(
+        "--history-key",
+        help="file the history key is kept in, outside the history directory,"
+        " <history>.key if unset",
+    )
+    args = parser.parse_args()
+    if args.seed and not args.gossip:
+        parser.error("--seed needs --gossip")
+
+    local_addr = Addr(host=args.host, port=args.port)
+    multicast_addr = Addr(host="224.0.0.1", port=5005)
+    control_path = args.control or f"/tmp/zerotrust_chat_{args.port}.sock"
+
+    daemon = Daemon(
+        local_addr=local_addr,
+        multicast_addr=multicast_addr,
+        control_path=control_path,
+        workers=args.workers,
+        key_pool_depth=args.key_pool,
+        coalesce_window=args.coalesce / 1000,
+        download_dir=args.downloads,
+        seeds=[parse_addr(seed) for seed in args.seed] if args.gossip else None,
+        metrics_path=args.metrics_file,
+        metrics_interval=args.metrics_interval,
+        trace_capacity=args.trace,
+        history_dir=args.history,
+        history_key=args.history_key,
+    )
+    daemon.install_signal_handlers()
+    print(f"listening on {format_addr(local_addr)}, control socket {control_path}")
+    daemon.loop()
+
+
+if __name__ == "__main__":
+    main()
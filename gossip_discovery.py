@@ -0,0 +1,160 @@
+import math
+import random
+import socket
+import struct
+import time
+import metrics
+import network
+from network import Addr
+from service_discovery import PeerObserver, PeerTable
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+GOSSIP_VERSION = 1
+# ipv4 address, port and heartbeat of one member
+DIGEST_ENTRY = struct.Struct("!4sHQ")
+MAX_DATAGRAM = 1200
+MAX_ENTRIES = (MAX_DATAGRAM - 1) // DIGEST_ENTRY.size
+
+DATAGRAMS_RECEIVED = metrics.REGISTRY.counter(
+    "discovery_datagrams_total", "discovery datagrams received", backend="gossip"
+)
+
+
+def encode_digest(entries: Iterable[Tuple[Addr, int]]) -> bytes:
+    parts: List[bytes] = [bytes((GOSSIP_VERSION,))]
+    for addr, heartbeat in entries:
+        try:
+            host = socket.inet_aton(addr.host)
+        except OSError:
+            continue
+        parts.append(DIGEST_ENTRY.pack(host, addr.port, heartbeat))
+    return b"".join(parts)
+
+
+def decode_digest(data: bytes) -> List[Tuple[Addr, int]]:
+    if not data or data[0] != GOSSIP_VERSION:
+        return []
+
+    entries: List[Tuple[Addr, int]] = []
+    for host, port, heartbeat in DIGEST_ENTRY.iter_unpack(
+        data[1 : 1 + (len(data) - 1) // DIGEST_ENTRY.size * DIGEST_ENTRY.size]
+    ):
+        entries.append((Addr(host=socket.inet_ntoa(host), port=port), heartbeat))
+    return entries
+
+
+def advertised_host(host: str, seeds: Sequence[Addr]) -> str:
+    # the ipv4 address other members reach this node at. a wildcard bind is
+    # replaced by the address the route towards a seed leaves from
+    if host not in ("", "0.0.0.0"):
+        return socket.gethostbyname(host)
+    for seed in seeds:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                # connecting a udp socket only picks the route, nothing is sent
+                probe.connect((seed.host, seed.port))
+                return probe.getsockname()[0]
+        except OSError:
+            continue
+    return socket.gethostbyname(socket.gethostname())
+
+
+class GossipDiscovery(PeerTable):
+    # unicast alternative to the multicast pair, stands in for both the
+    # ServiceDiscoveryClient and the ServiceDiscoveryServer. every round the
+    # node sends a digest of members and their heartbeats to a few random
+    # members, so what a node sends and receives per round does not grow
+    # with the network. a member stays alive while its heartbeat goes up,
+    # first or second hand. seeds are dialled until members are known.
+    def __init__(
+        self,
+        local_addr: Addr,
+        seeds: Sequence[Addr] = (),
+        fanout: int = 3,
+        interval: float = 1.0,
+        ttl: float = 10.0,
+        peer_observer: Optional[PeerObserver] = None,
+        recv_buffer: int = 1024 * 1024,
+    ) -> None:
+        PeerTable.__init__(self, ttl, peer_observer)
+        # what goes into digests, the bind address may be a wildcard
+        self.local_addr = Addr(
+            host=advertised_host(local_addr.host, seeds), port=local_addr.port
+        )
+        self.seeds = [seed for seed in seeds if seed != self.local_addr]
+        self.fanout = fanout
+        self.interval = interval
+        self.heartbeat = 0
+        # highest heartbeat heard per member, kept after a member expires so
+        # stale digests cannot bring it back
+        self.heartbeats: Dict[Addr, int] = {}
+        self.poller = network.Poller()
+
+        # the udp port matching the chat listener's tcp port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+        self.sock.setblocking(False)
+        self.sock.bind((local_addr.host, local_addr.port))
+
+        self.poller.register(self.sock)
+
+    def publish(self) -> None:
+        # wall clock milliseconds so a restarted node is not taken for stale
+        # gossip
+        self.heartbeat = max(self.heartbeat + 1, int(time.time() * 1000))
+
+        members = list(self.last_seen.keys())
+        targets = random.sample(members, min(self.fanout, len(members)))
+        if len(targets) < self.fanout:
+            seeds = [seed for seed in self.seeds if seed not in targets]
+            targets += random.sample(seeds, min(self.fanout - len(targets), len(seeds)))
+
+        sample = random.sample(members, min(MAX_ENTRIES - 1, len(members)))
+        digest = encode_digest(
+            [(self.local_addr, self.heartbeat)]
+            + [(addr, self.heartbeats[addr]) for addr in sample]
+        )
+
+        for target in targets:
+            try:
+                self.sock.sendto(digest, (target.host, target.port))
+            except OSError as e:
+                print(f"gossip exception: {target} {e}")
+
+    def next_interval(self, group_size: int) -> float:
+        # the per node cost of a round is fixed, no need to slow down
+        return self.interval * random.uniform(0.5, 1.5)
+
+    def group_ttl(self) -> float:
+        # a heartbeat needs about log(n) rounds to reach everyone
+        rounds = math.log(len(self.last_seen) + 1, max(self.fanout, 2))
+        return self.ttl + 2 * rounds * self.interval
+
+    def poll(self, timeout: Optional[float] = None):
+        added: List[Addr] = []
+        for conn in self.poller.poll(timeout):
+            assert conn == self.sock
+            now = time.monotonic()
+
+            while True:
+                try:
+                    data, _ = conn.recvfrom(MAX_DATAGRAM)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    # icmp unreachable from a gone member surfaces here
+                    continue
+                DATAGRAMS_RECEIVED.inc()
+
+                for addr, heartbeat in decode_digest(data):
+                    if self._merge(addr, heartbeat, now):
+                        added.append(addr)
+
+        self._report(added)
+
+    def _merge(self, addr: Addr, heartbeat: int, now: float) -> bool:
+        # returns whether the member is new
+        if addr == self.local_addr or heartbeat <= self.heartbeats.get(addr, 0):
+            return False
+        self.heartbeats[addr] = heartbeat
+        return self._seen(addr, now)
@@ -0,0 +1,137 @@
+import base64
+import json
+import os
+import struct
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Protocol, Set, Tuple
+
+from network import Addr, format_addr, parse_addr
+
+if TYPE_CHECKING:
+    from crypto.aead import RandomNonceCipher
+
+# the sender's sequence number and its name, as the owner knows it, go sealed
+# ahead of every group message
+SENDER_HEADER = struct.Struct("!QH")
+
+
+class GroupRecordKind:
+    # the group key and member list, sealed for one member by its session
+    INVITE = "invite"
+    # a message sealed once under the group key, the same record goes to all
+    POST = "post"
+    # leaving, or being removed when it comes from the owner
+    LEAVE = "leave"
+
+
+GROUP_RECORD_KINDS = (
+    GroupRecordKind.INVITE,
+    GroupRecordKind.POST,
+    GroupRecordKind.LEAVE,
+)
+
+
+def new_group_id() -> str:
+    return os.urandom(8).hex()
+
+
+class GroupObserver(Protocol):
+    def on_group_message(self, group_id: str, addr: Addr, message: bytes):
+        pass
+
+    def on_group_update(self, group_id: str, members: List[Addr]):
+        # members other than this node, none once the group is gone
+        pass
+
+
+class Group:
+    # the node that creates a group owns it, owner is None there. members
+    # only have a session with the owner, which relays their messages to
+    # everyone else as they are, without opening them again. only the owner
+    # changes membership and every change comes with a new key
+    def __init__(
+        self, group_id: str, owner: Optional[Addr] = None, members: Iterable[Addr] = ()
+    ) -> None:
+        self.group_id = group_id
+        self.owner = owner
+        # everyone but this node and the owner
+        self.members: Set[Addr] = set(members)
+        # this node as the owner knows it, empty on the owner
+        self.name = ""
+        self.key = b""
+        self.epoch = 0
+        self.cipher: Optional["RandomNonceCipher"] = None
+        # posts are not protected by the sessions' counters, every sender
+        # numbers its own and anything not past the last one seen is dropped
+        self.sequence = 0
+        self.last_seen: Dict[str, int] = {}
+        if owner is None:
+            self.rekey()
+
+    def rekey(self, key: Optional[bytes] = None, epoch: Optional[int] = None):
+        # every member seals under the same key, so nonces are random. the
+        # key changes with every membership change, long before they repeat
+        from crypto.aead import RandomNonceCipher, generate_key
+
+        self.key = key if key is not None else generate_key()
+        self.epoch = epoch if epoch is not None else self.epoch + 1
+        self.cipher = RandomNonceCipher(self.key, "group")
+        # the epoch is in the associated data, numbering starts over with it
+        self.sequence = 0
+        self.last_seen = {}
+
+    def peers(self) -> List[Addr]:
+        if self.owner is None:
+            return sorted(self.members)
+        return [self.owner] + sorted(self.members)
+
+    def invite(self, member: Addr) -> bytes:
+        return json.dumps(
+            {
+                "key": base64.b64encode(self.key).decode(),
+                "epoch": self.epoch,
+                "name": format_addr(member),
+                "members": [format_addr(addr) for addr in self.members],
+            }
+        ).encode()
+
+    def accept(self, payload: bytes) -> bool:
+        # returns False for an invite older than the key already held
+        invite = json.loads(payload.decode())
+        epoch = int(invite["epoch"])
+        if epoch <= self.epoch:
+            return False
+        self.name = invite["name"]
+        self.members = {
+            parse_addr(name) for name in invite["members"] if name != self.name
+        }
+        self.rekey(base64.b64decode(invite["key"]), epoch)
+        return True
+
+    def seal(self, message: bytes) -> bytes:
+        assert self.cipher is not None
+        name = self.name.encode()
+        self.sequence += 1
+        return self.cipher.seal(
+            SENDER_HEADER.pack(self.sequence, len(name)) + name + message,
+            self._associated_data(),
+        )
+
+    def open(self, sealed: bytes) -> Tuple[str, int, bytes]:
+        # returns the sender's name, empty for the owner, its sequence number
+        # and the message
+        assert self.cipher is not None
+        plaintext = self.cipher.open(sealed, self._associated_data())
+        sequence, length = SENDER_HEADER.unpack_from(plaintext)
+        offset = SENDER_HEADER.size + length
+        name = plaintext[SENDER_HEADER.size : offset].decode()
+        return name, sequence, plaintext[offset:]
+
+    def check_sequence(self, name: str, sequence: int):
+        # only once the sender is known to be who the name says
+        if sequence <= self.last_seen.get(name, 0):
+            raise RuntimeError(f"replayed post {sequence} from {name!r}")
+        self.last_seen[name] = sequence
+
+    def _associated_data(self) -> bytes:
+        # a message only opens in the group and key it was sealed for
+        return f"{self.group_id}:{self.epoch}".encode()
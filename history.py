@@ -0,0 +1,202 @@
+import mmap
+import os
+import struct
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from crypto.aead import RandomNonceCipher
+from crypto.storage import derive_key, load_or_create_key
+from network import Addr, format_addr
+
+# every log record is its length followed by the sealed entry
+RECORD_HEADER = struct.Struct("!I")
+# the log offset of entry i sits at INDEX_ENTRY.size * i in the index
+INDEX_ENTRY = struct.Struct("!Q")
+# time and direction ahead of the message, encrypted along with it
+ENTRY_HEADER = struct.Struct("!d?")
+
+
+class HistoryEntry(NamedTuple):
+    timestamp: float
+    outgoing: bool
+    message: bytes
+
+
+class HistoryLog:
+    # append only log of one peer's messages, each sealed on its own with its
+    # position as associated data so entries cannot be reordered on disk.
+    # the index is mapped, any entry is one lookup and one read away
+    def __init__(self, directory: str, cipher: RandomNonceCipher) -> None:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.cipher = cipher
+        self.log = open(os.path.join(directory, "log"), "a+b")
+        self.index = open(os.path.join(directory, "index"), "a+b")
+        self.map: Optional[mmap.mmap] = None
+        # entries covered by the current mapping, remapped once reads go past
+        self.mapped = 0
+        self.count = 0
+        self.log_size = 0
+        self._recover()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(
+        self, outgoing: bool, message: bytes, timestamp: Optional[float] = None
+    ) -> int:
+        index = self.count
+        entry = ENTRY_HEADER.pack(
+            time.time() if timestamp is None else timestamp, outgoing
+        )
+        sealed = self.cipher.seal(entry + message, INDEX_ENTRY.pack(index))
+
+        # the record goes first, an offset never points past the log
+        self.log.write(RECORD_HEADER.pack(len(sealed)) + sealed)
+        self.log.flush()
+        self.index.write(INDEX_ENTRY.pack(self.log_size))
+        self.index.flush()
+
+        self.log_size += RECORD_HEADER.size + len(sealed)
+        self.count += 1
+        return index
+
+    def read(self, index: int) -> HistoryEntry:
+        entries = self.page(index + 1, 1)
+        if not entries or index < 0:
+            raise IndexError(f"no history entry {index}")
+        return entries[0]
+
+    def page(self, end: int, count: int) -> List[HistoryEntry]:
+        # up to count entries before end, oldest first, in a single read
+        end = min(end, self.count)
+        start = max(end - count, 0)
+        if start >= end:
+            return []
+
+        base = self._offset(start)
+        stop = self._offset(end) if end < self.count else self.log_size
+        data = os.pread(self.log.fileno(), stop - base, base)
+
+        entries: List[HistoryEntry] = []
+        for index in range(start, end):
+            offset = self._offset(index) - base
+            (length,) = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            entry = self.cipher.open(
+                data[offset : offset + length], INDEX_ENTRY.pack(index)
+            )
+            timestamp, outgoing = ENTRY_HEADER.unpack_from(entry)
+            entries.append(
+                HistoryEntry(timestamp, outgoing, entry[ENTRY_HEADER.size :])
+            )
+        return entries
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.log.close()
+        self.index.close()
+
+    def _offset(self, index: int) -> int:
+        if index >= self.mapped:
+            self._remap()
+        assert self.map is not None
+        return INDEX_ENTRY.unpack_from(self.map, index * INDEX_ENTRY.size)[0]
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.mapped = 0
+        if self.count:
+            self.map = mmap.mmap(
+                self.index.fileno(),
+                self.count * INDEX_ENTRY.size,
+                access=mmap.ACCESS_READ,
+            )
+            self.mapped = self.count
+
+    def _recover(self):
+        # a crash can leave a torn record at the end of the log or records
+        # the index never heard of. the index is cut back to entries whose
+        # record is whole, then rebuilt from whatever whole records follow
+        log_fd = self.log.fileno()
+        log_size = os.fstat(log_fd).st_size
+        count = os.fstat(self.index.fileno()).st_size // INDEX_ENTRY.size
+
+        end = 0
+        while count:
+            (offset,) = INDEX_ENTRY.unpack(
+                os.pread(
+                    self.index.fileno(),
+                    INDEX_ENTRY.size,
+                    (count - 1) * INDEX_ENTRY.size,
+                )
+            )
+            record_end = self._record_end(log_fd, offset, log_size)
+            if record_end is not None:
+                end = record_end
+                break
+            count -= 1
+        self.index.truncate(count * INDEX_ENTRY.size)
+
+        offsets: List[bytes] = []
+        while True:
+            record_end = self._record_end(log_fd, end, log_size)
+            if record_end is None:
+                break
+            offsets.append(INDEX_ENTRY.pack(end))
+            end = record_end
+        if offsets:
+            self.index.write(b"".join(offsets))
+            self.index.flush()
+
+        self.log.truncate(end)
+        self.count = count + len(offsets)
+        self.log_size = end
+
+    def _record_end(self, log_fd: int, offset: int, log_size: int) -> Optional[int]:
+        header = os.pread(log_fd, RECORD_HEADER.size, offset)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        (length,) = RECORD_HEADER.unpack(header)
+        end = offset + RECORD_HEADER.size + length
+        return end if end <= log_size else None
+
+
+def default_key_path(directory: str) -> str:
+    # next to the history dir, not in it
+    return os.path.normpath(directory) + ".key"
+
+
+class HistoryStore:
+    # one log per peer under directory, each under its own key derived from
+    # the master key. the key is never kept in directory, a copy of the logs
+    # alone opens nothing
+    def __init__(self, directory: str, key_path: str) -> None:
+        inside = os.path.realpath(directory)
+        if os.path.commonpath([inside, os.path.realpath(key_path)]) == inside:
+            raise RuntimeError(f"history key {key_path} must be outside {directory}")
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(key_path)), exist_ok=True)
+
+        self.directory = directory
+        self.master_key = load_or_create_key(key_path)
+        self.logs: Dict[Addr, HistoryLog] = {}
+
+    def log(self, addr: Addr) -> HistoryLog:
+        history_log = self.logs.get(addr)
+        if history_log is None:
+            name = format_addr(addr)
+            history_log = self.logs[addr] = HistoryLog(
+                os.path.join(self.directory, name.replace(":", "_")),
+                RandomNonceCipher(derive_key(self.master_key, name), "storage"),
+            )
+        return history_log
+
+    def close(self):
+        for history_log in self.logs.values():
+            history_log.close()
+        self.logs.clear()
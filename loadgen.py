@@ -0,0 +1,512 @@
+import argparse
+import errno
+import heapq
+import json
+import random
+import resource
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import chat_manager
+import network
+import session
+from network import Addr, format_addr, parse_addr
+from state.base import DEFAULT_HANDSHAKE_MODES, HandshakeMode, ReponseStatus
+
+# send time carried at the front of every payload, the target echoes it back
+PROBE = struct.Struct("!d")
+
+
+class LoadConfig(NamedTuple):
+    peers: int = 100
+    connect_rate: float = 50.0
+    # messages per second per established peer
+    message_rate: float = 1.0
+    payload: int = 256
+    # established peers dropped and replaced per second
+    churn: float = 0.0
+    duration: float = 30.0
+    handshake_timeout: float = 10.0
+    modes: Tuple[str, ...] = (HandshakeMode.X25519,)
+
+
+class Reservoir:
+    # uniform sample of an unbounded stream, keeps memory flat on long runs
+    def __init__(self, capacity: int = 100_000) -> None:
+        self.capacity = capacity
+        self.samples: List[float] = []
+        self.seen = 0
+
+    def add(self, value: float):
+        self.seen += 1
+        if len(self.samples) < self.capacity:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.capacity:
+                self.samples[index] = value
+
+    def percentiles(self, qs: Sequence[float]) -> Dict[str, Optional[float]]:
+        ordered = sorted(self.samples)
+        return {
+            f"p{q * 100:g}": (
+                ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+                if ordered
+                else None
+            )
+            for q in qs
+        }
+
+
+class LoadPeer:
+    def __init__(
+        self, index: int, conn: socket.socket, client_session: session.ClientSession
+    ) -> None:
+        self.index = index
+        self.conn = conn
+        self.session = client_session
+        self.buffer = network.FrameBuffer(initial_size=4096)
+        self.outbound = network.OutboundQueue()
+        self.started = time.monotonic()
+        self.connecting = True
+        self.established = False
+        self.closed = False
+
+
+def read_rss(pid: int) -> Optional[int]:
+    # resident set size in bytes, linux only
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def raise_fd_limit():
+    # every peer is a socket, the default soft limit is often 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class LoadGenerator:
+    # simulated peers dialling one target from a single poll loop, every peer
+    # is a real ClientSession doing its own handshake over its own socket
+    def __init__(
+        self,
+        target: Addr,
+        config: LoadConfig,
+        target_pid: Optional[int] = None,
+        report_interval: float = 1.0,
+    ) -> None:
+        self.target = target
+        self.config = config
+        self.target_pid = target_pid
+        self.report_interval = report_interval
+        self.poller = network.Poller()
+        self.peers: Dict[socket.socket, LoadPeer] = {}
+        self.handshaking: Set[LoadPeer] = set()
+        self.established: List[LoadPeer] = []
+        # (due, peer index, peer) for the next message of every peer
+        self.schedule: List[Tuple[float, int, LoadPeer]] = []
+        self.next_index = 0
+        self.padding = b"\0" * max(config.payload - PROBE.size, 0)
+
+        self.counts: Dict[str, int] = {
+            "connects": 0,
+            "handshakes": 0,
+            "handshake_failures": 0,
+            "churned": 0,
+            "disconnects": 0,
+            "sent": 0,
+            "received": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "backpressure": 0,
+        }
+        self.failures: Dict[str, int] = {}
+        self.latency = Reservoir()
+        self.handshake_time = Reservoir()
+        self.peak_peers = 0
+        self.rss: List[int] = []
+
+    def on_chat(self, addr: Addr, message: bytes):
+        (sent,) = PROBE.unpack_from(message)
+        self.latency.add(time.perf_counter() - sent)
+        self.counts["received"] += 1
+        self.counts["bytes_received"] += len(message)
+
+    def run(self) -> Dict[str, Any]:
+        config = self.config
+        started = last = time.monotonic()
+        end = started + config.duration
+        next_report = started + self.report_interval
+        connect_credit = churn_credit = 0.0
+        last_counts = dict(self.counts)
+        self._sample_rss()
+
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+
+            elapsed, last = now - last, now
+            connect_credit = min(
+                connect_credit + elapsed * config.connect_rate,
+                max(config.connect_rate, 1.0),
+            )
+            while connect_credit >= 1 and len(self.peers) < config.peers:
+                connect_credit -= 1
+                self._connect()
+
+            churn_credit += elapsed * config.churn
+            while churn_credit >= 1 and self.established:
+                churn_credit -= 1
+                self.counts["churned"] += 1
+                peer = self.established[random.randrange(len(self.established))]
+                self._close(peer)
+
+            self._send_due(now)
+            self._expire_handshakes(now)
+
+            timeout = 0.01
+            if self.schedule:
+                timeout = min(timeout, max(self.schedule[0][0] - now, 0))
+            for conn, mask in self.poller.poll_events(timeout):
+                peer = self.peers.get(conn)
+                if peer is None:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._on_writable(peer)
+                if mask & selectors.EVENT_READ and not peer.closed:
+                    self._on_readable(peer)
+
+            self.peak_peers = max(self.peak_peers, len(self.peers))
+            if now >= next_report:
+                self._sample_rss()
+                self._print_progress(last_counts, self.report_interval)
+                last_counts = dict(self.counts)
+                next_report = now + self.report_interval
+
+        self._sample_rss()
+        for peer in list(self.peers.values()):
+            self._close(peer)
+        return self.report(time.monotonic() - started)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        rss = self.rss
+        return {
+            "target": format_addr(self.target),
+            "config": self.config._asdict(),
+            "elapsed": elapsed,
+            "peak_peers": self.peak_peers,
+            "counts": self.counts,
+            "handshake_failures": self.failures,
+            "throughput": {
+                "sent_per_second": self.counts["sent"] / elapsed,
+                "received_per_second": self.counts["received"] / elapsed,
+                "bytes_received_per_second": self.counts["bytes_received"] / elapsed,
+                "handshakes_per_second": self.counts["handshakes"] / elapsed,
+            },
+            "latency_ms": self.latency.percentiles((0.5, 0.9, 0.99, 0.999)),
+            "handshake_ms": self.handshake_time.percentiles((0.5, 0.9, 0.99)),
+            "target_rss": (
+                {
+                    "start": rss[0],
+                    "end": rss[-1],
+                    "peak": max(rss),
+                    "growth": rss[-1] - rss[0],
+                }
+                if rss
+                else None
+            ),
+        }
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.setblocking(False)
+
+        # no listen port in the hello, the target keeps every peer apart by
+        # its ephemeral port instead of collapsing them into one
+        client_session = session.ClientSession(
+            addr=self.target, chat_observer=self, modes=self.config.modes
+        )
+        peer = LoadPeer(self.next_index, conn, client_session)
+        self.next_index += 1
+        self.counts["connects"] += 1
+        self.peers[conn] = peer
+        self.handshaking.add(peer)
+        self.poller.register(conn)
+        peer.outbound.push(network.pack_frame(client_session.hello()))
+
+        err = conn.connect_ex((self.target.host, self.target.port))
+        if err not in (0, errno.EINPROGRESS):
+            self._fail(peer, errno.errorcode.get(err, str(err)))
+            return
+        self.poller.set_writable(conn, True)
+
+    def _on_writable(self, peer: LoadPeer):
+        if peer.connecting:
+            peer.connecting = False
+            err = peer.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._fail(peer, errno.errorcode.get(err, str(err)))
+                return
+        self._flush(peer)
+
+    def _on_readable(self, peer: LoadPeer):
+        try:
+            nbytes = peer.buffer.recv_from(peer.conn)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fail(peer, errno.errorcode.get(e.errno or 0, str(e)))
+            return
+        if not nbytes:
+            self._fail(peer, "closed by target")
+            return
+
+        for record in peer.buffer.frames():
+            response = peer.session.on_message_recv(record)
+            if response.status == ReponseStatus.DISCONNECT:
+                self._fail(peer, "rejected")
+                return
+            if response.status == ReponseStatus.REPLY_NEEDED:
+                peer.outbound.push(network.pack_frame(response.message))
+
+        if not peer.established and peer.session.established:
+            peer.established = True
+            self.handshaking.discard(peer)
+            self.established.append(peer)
+            self.counts["handshakes"] += 1
+            self.handshake_time.add(time.monotonic() - peer.started)
+            if self.config.message_rate > 0:
+                # spread the first messages over one interval
+                due = time.monotonic() + random.random() / self.config.message_rate
+                heapq.heappush(self.schedule, (due, peer.index, peer))
+
+        self._flush(peer)
+
+    def _send_due(self, now: float):
+        interval = 1 / self.config.message_rate if self.config.message_rate else 0
+        while self.schedule and self.schedule[0][0] <= now:
+            due, index, peer = heapq.heappop(self.schedule)
+            if peer.closed:
+                continue
+
+            if peer.outbound.is_full():
+                self.counts["backpressure"] += 1
+            else:
+                message = PROBE.pack(time.perf_counter()) + self.padding
+                peer.session.send_message(message, lambda data: self._push(peer, data))
+                self.counts["sent"] += 1
+                self.counts["bytes_sent"] += len(message)
+                self._flush(peer)
+
+            # a peer that fell behind does not burst to catch up
+            heapq.heappush(self.schedule, (max(due + interval, now), index, peer))
+
+    def _expire_handshakes(self, now: float):
+        deadline = now - self.config.handshake_timeout
+        for peer in [peer for peer in self.handshaking if peer.started <= deadline]:
+            self._fail(peer, "timeout")
+
+    def _push(self, peer: LoadPeer, data: bytes) -> int:
+        peer.outbound.push(network.pack_frame(data))
+        return len(data)
+
+    def _flush(self, peer: LoadPeer):
+        if peer.connecting or peer.closed:
+            return
+        try:
+            drained = peer.outbound.flush(peer.conn)
+        except OSError as e:
+            self._fail(peer, errno.errorcode.get(e.errno or 0, str(e)))
+            return
+        self.poller.set_writable(peer.conn, not drained)
+
+    def _fail(self, peer: LoadPeer, reason: str):
+        if peer.established:
+            self.counts["disconnects"] += 1
+        else:
+            self.counts["handshake_failures"] += 1
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+        self._close(peer)
+
+    def _close(self, peer: LoadPeer):
+        if peer.closed:
+            return
+        peer.closed = True
+        self.handshaking.discard(peer)
+        if peer.established:
+            # swap remove, the order of established peers does not matter
+            index = self.established.index(peer)
+            self.established[index] = self.established[-1]
+            self.established.pop()
+        del self.peers[peer.conn]
+        peer.session.release()
+        try:
+            self.poller.unregister(peer.conn)
+        except (KeyError, ValueError):
+            pass
+        peer.conn.close()
+
+    def _sample_rss(self):
+        if self.target_pid is not None:
+            rss = read_rss(self.target_pid)
+            if rss is not None:
+                self.rss.append(rss)
+
+    def _print_progress(self, last_counts: Dict[str, int], interval: float):
+        def rate(key: str) -> float:
+            return (self.counts[key] - last_counts[key]) / interval
+
+        p99 = self.latency.percentiles((0.99,))["p99"]
+        rss = f" rss {self.rss[-1] / 2**20:.1f}MiB" if self.rss else ""
+        print(
+            f"peers {len(self.established)}/{len(self.peers)}"
+            f" handshakes {rate('handshakes'):.0f}/s"
+            f" failures {self.counts['handshake_failures']}"
+            f" sent {rate('sent'):.0f}/s received {rate('received'):.0f}/s"
+            f" p99 {p99 if p99 is None else round(p99, 2)}ms{rss}",
+            flush=True,
+        )
+
+
+class EchoTarget:
+    # a plain node that sends every chat back to whoever sent it
+    def __init__(self, local_addr: Addr) -> None:
+        self.chat_manager = chat_manager.ChatManager(
+            host_addr=local_addr,
+            chat_recv_observer=self,
+            session_close_observer=self,
+        )
+
+    def on_chat(self, addr: Addr, message: bytes):
+        self.chat_manager.send_message(addr, message)
+
+    def on_session_close(self, addr: Addr):
+        pass
+
+    def loop(self):
+        try:
+            while True:
+                self.chat_manager.run(0.1)
+        finally:
+            self.chat_manager.stop()
+
+
+def spawn_target(local_addr: Addr) -> subprocess.Popen:
+    target = subprocess.Popen(
+        [sys.executable, __file__, "serve", format_addr(local_addr)],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((local_addr.host, local_addr.port), 0.1).close()
+            return target
+        except OSError:
+            if target.poll() is not None:
+                break
+            time.sleep(0.05)
+    target.kill()
+    raise RuntimeError(f"target did not start listening on {format_addr(local_addr)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zero trust chat load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run an echo node to load")
+    serve.add_argument("addr", help="host:port to listen on")
+
+    run = commands.add_parser("run", help="load a target node with simulated peers")
+    run.add_argument("addr", help="host:port of the target")
+    run.add_argument(
+        "--spawn",
+        action="store_true",
+        help="start an echo node on addr first and watch its memory",
+    )
+    run.add_argument("--target-pid", type=int, help="pid of the target to watch")
+    run.add_argument("--peers", type=int, default=100, help="concurrent peers")
+    run.add_argument(
+        "--connect-rate", type=float, default=50.0, help="new connections per second"
+    )
+    run.add_argument(
+        "--message-rate",
+        type=float,
+        default=1.0,
+        help="messages per second per peer",
+    )
+    run.add_argument("--payload", type=int, default=256, help="message size in bytes")
+    run.add_argument(
+        "--churn",
+        type=float,
+        default=0.0,
+        help="peers dropped and replaced per second",
+    )
+    run.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    run.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=10.0,
+        help="seconds before a handshake counts as failed",
+    )
+    run.add_argument(
+        "--modes",
+        default=HandshakeMode.X25519,
+        help=f"handshake modes offered, comma separated from "
+        f"{', '.join(DEFAULT_HANDSHAKE_MODES)}",
+    )
+    run.add_argument("--output", help="write the report as json to this path")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    addr = parse_addr(args.addr)
+
+    if args.command == "serve":
+        EchoTarget(addr).loop()
+        return
+
+    config = LoadConfig(
+        peers=args.peers,
+        connect_rate=args.connect_rate,
+        message_rate=args.message_rate,
+        payload=max(args.payload, PROBE.size),
+        churn=args.churn,
+        duration=args.duration,
+        handshake_timeout=args.handshake_timeout,
+        modes=tuple(args.modes.split(",")),
+    )
+
+    target: Optional[subprocess.Popen] = None
+    target_pid: Optional[int] = args.target_pid
+    if args.spawn:
+        target = spawn_target(addr)
+        target_pid = target.pid
+
+    try:
+        report = LoadGenerator(addr, config, target_pid=target_pid).run()
+    finally:
+        if target is not None:
+            target.terminate()
+            target.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
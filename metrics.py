@@ -0,0 +1,219 @@
+import functools
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+# latency buckets are powers of two seconds, 2**-20 (about 1us) up to 16s
+MIN_EXPONENT = -20
+BUCKET_COUNT = 25
+BUCKET_BOUNDS = [2.0 ** (MIN_EXPONENT + i) for i in range(BUCKET_COUNT)]
+
+Labels = Tuple[Tuple[str, str], ...]
+F = TypeVar("F", bound=Callable)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Gauge:
+    # either set by the owner or read through fn when a snapshot is taken
+    __slots__ = ("value", "fn")
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None) -> None:
+        self.value: float = 0
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def read(self) -> float:
+        return self.fn() if self.fn else self.value
+
+
+class Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: "Histogram") -> None:
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram:
+    # an observation is one frexp and a list increment, no bucket search
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self) -> None:
+        # the last slot counts everything past the largest bound
+        self.counts = [0] * (BUCKET_COUNT + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds <= 0:
+            self.counts[0] += 1
+            return
+        index = math.frexp(seconds)[1] - MIN_EXPONENT
+        if index < 0:
+            index = 0
+        elif index > BUCKET_COUNT:
+            index = BUCKET_COUNT
+        self.counts[index] += 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return math.inf if self.counts[-1] else 0.0
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+def timed(histogram: Histogram) -> Callable[[F], F]:
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def crypto_timer(op: str) -> Callable[[F], F]:
+    return timed(
+        REGISTRY.histogram("crypto_seconds", "time spent in crypto calls", op=op)
+    )
+
+
+class Registry:
+    # metrics by name and labels, a snapshot is rendered in the prometheus
+    # text format so it can be read by eye or scraped as it is
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Dict[Labels, Metric]] = {}
+        self.descriptions: Dict[str, Tuple[str, str]] = {}
+
+    def counter(self, name: str, description: str = "", **labels: str) -> Counter:
+        metric = self._get(name, "counter", description, labels, Counter)
+        assert isinstance(metric, Counter)
+        return metric
+
+    def gauge(
+        self,
+        name: str,
+        description: str = "",
+        fn: Optional[Callable[[], float]] = None,
+        **labels: str,
+    ) -> Gauge:
+        metric = self._get(name, "gauge", description, labels, Gauge)
+        assert isinstance(metric, Gauge)
+        if fn is not None:
+            # the latest owner wins, a gauge fed by several owners registers
+            # once and adds them up itself
+            metric.fn = fn
+        return metric
+
+    def histogram(self, name: str, description: str = "", **labels: str) -> Histogram:
+        metric = self._get(name, "histogram", description, labels, Histogram)
+        assert isinstance(metric, Histogram)
+        return metric
+
+    def snapshot(self) -> str:
+        lines: List[str] = []
+        for name, family in sorted(self.metrics.items()):
+            kind, description = self.descriptions[name]
+            if description:
+                lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(family.items()):
+                if isinstance(metric, Histogram):
+                    lines.extend(_histogram_lines(name, labels, metric))
+                elif isinstance(metric, Gauge):
+                    lines.append(f"{name}{_format_labels(labels)} {metric.read():g}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # replaced in one step so a reader never sees half a snapshot
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.snapshot())
+        os.replace(tmp_path, path)
+
+    def _get(
+        self,
+        name: str,
+        kind: str,
+        description: str,
+        labels: Dict[str, str],
+        factory: Callable[[], Metric],
+    ) -> Metric:
+        known = self.descriptions.get(name)
+        if known is None:
+            self.descriptions[name] = (kind, description)
+            self.metrics[name] = {}
+        elif known[0] != kind:
+            raise RuntimeError(f"metric {name} is a {known[0]}, not a {kind}")
+
+        key = tuple(sorted(labels.items()))
+        family = self.metrics[name]
+        metric = family.get(key)
+        if metric is None:
+            metric = family[key] = factory()
+        return metric
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def _histogram_lines(name: str, labels: Labels, histogram: Histogram) -> List[str]:
+    lines: List[str] = []
+    cumulative = 0
+    for bound, count in zip(BUCKET_BOUNDS, histogram.counts):
+        cumulative += count
+        lines.append(
+            f"{name}_bucket{_format_labels(labels, ('le', f'{bound:.6g}'))} {cumulative}"
+        )
+    lines.append(
+        f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}"
+    )
+    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total:.6f}")
+    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return lines
+
+
+# the process wide registry everything reports to
+REGISTRY = Registry()
@@ -1,6 +1,10 @@
+import os
 import selectors
 import socket
-from typing import Iterable, Optional, NamedTuple
+import struct
+from collections import deque
+from itertools import islice
+from typing import Deque, Iterable, Iterator, Optional, NamedTuple, Tuple
 
 
 class Addr(NamedTuple):
@@ -8,6 +12,15 @@ class Addr(NamedTuple):
     port: int
 
 
+def parse_addr(addr: str) -> Addr:
+    host, port = addr.rsplit(":", 1)
+    return Addr(host=host, port=int(port))
+
+
+def format_addr(addr: Addr) -> str:
+    return f"{addr.host}:{addr.port}"
+
+
 class Poller:
     def __init__(self) -> None:
         self.selector = selectors.DefaultSelector()
@@ -18,15 +31,138 @@ class Poller:
     def unregister(self, conn: socket.socket) -> None:
         self.selector.unregister(conn)
 
+    def set_writable(self, conn: socket.socket, writable: bool) -> None:
+        events = selectors.EVENT_READ
+        if writable:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn).events != events:
+            self.selector.modify(conn, events, data=None)
+
     def poll(self, timeout: Optional[float] = None) -> Iterable[socket.socket]:
+        return (
+            conn
+            for conn, mask in self.poll_events(timeout)
+            if mask & selectors.EVENT_READ
+        )
+
+    def poll_events(
+        self, timeout: Optional[float] = None
+    ) -> Iterable[Tuple[socket.socket, int]]:
         events = self.selector.select(timeout=timeout)
         return (
-            key.fileobj
+            (key.fileobj, mask)
             for key, mask in events
-            if mask & selectors.EVENT_READ and isinstance(key.fileobj, socket.socket)
+            if isinstance(key.fileobj, socket.socket)
         )
 
 
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def pack_frame(payload: bytes) -> bytes:
+    if len(payload) > MAX_FRAME_SIZE:
+        raise RuntimeError(f"frame too large: {len(payload)} bytes")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameBuffer:
+    # per connection reassembly buffer for length prefixed records, a single
+    # recv fills the free tail and every complete frame in it is handed out
+    def __init__(self, initial_size: int = 64 * 1024) -> None:
+        self._buf = bytearray(initial_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def recv_from(self, conn: socket.socket) -> int:
+        self._reserve(1)
+        nbytes = conn.recv_into(self._view[self._end :])
+        self._end += nbytes
+        return nbytes
+
+    def feed(self, data: bytes) -> None:
+        self._reserve(len(data))
+        self._view[self._end : self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self) -> Iterator[bytes]:
+        while self._end - self._start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buf, self._start)
+            if length > MAX_FRAME_SIZE:
+                raise RuntimeError(f"frame too large: {length} bytes")
+
+            frame_end = self._start + FRAME_HEADER.size + length
+            if frame_end > self._end:
+                self._reserve(frame_end - self._end)
+                break
+
+            frame = bytes(self._view[self._start + FRAME_HEADER.size : frame_end])
+            self._start = frame_end
+            yield frame
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _reserve(self, nbytes: int) -> None:
+        if len(self._buf) - self._end >= nbytes:
+            return
+
+        pending = self._end - self._start
+        if self._start:
+            self._view[:pending] = self._view[self._start : self._end]
+            self._start, self._end = 0, pending
+
+        if len(self._buf) - self._end < nbytes:
+            self._view.release()
+            self._buf.extend(
+                bytes(max(nbytes - (len(self._buf) - self._end), len(self._buf)))
+            )
+            self._view = memoryview(self._buf)
+
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+class OutboundQueue:
+    # pending outbound frames of a non-blocking connection, written out with
+    # one scatter/gather sendmsg per flush
+    def __init__(self, high_water_mark: int = 4 * 1024 * 1024) -> None:
+        self.high_water_mark = high_water_mark
+        self.pending_bytes = 0
+        self._chunks: Deque[memoryview] = deque()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def is_full(self) -> bool:
+        return self.pending_bytes >= self.high_water_mark
+
+    def push(self, data: bytes) -> None:
+        if data:
+            self._chunks.append(memoryview(data))
+            self.pending_bytes += len(data)
+
+    def flush(self, conn: socket.socket) -> bool:
+        # returns True once everything queued has been handed to the kernel
+        while self._chunks:
+            try:
+                sent = conn.sendmsg(list(islice(self._chunks, IOV_MAX)))
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            self.pending_bytes -= sent
+            while sent:
+                chunk = self._chunks[0]
+                if len(chunk) > sent:
+                    self._chunks[0] = chunk[sent:]
+                    return False
+                sent -= len(chunk)
+                self._chunks.popleft()
+
+        return True
+
+
 if __name__ == "__main__":
     poller = Poller()
 
@@ -1,11 +1,23 @@
 import tkinter as tk
 from tkinter import scrolledtext
-from typing import Protocol
+from collections import deque
+from typing import TYPE_CHECKING, Deque, List, Optional, Protocol
 from state.base import Addr
 
+if TYPE_CHECKING:
+    from history import HistoryEntry, HistoryLog
+
+# about 60 redraws a second at most, however fast messages come in
+FRAME_INTERVAL_MS = 16
+DEFAULT_SCROLLBACK = 5000
+# history entries loaded at a time, the latest page when the window opens
+# and one more whenever the view is scrolled to the top
+HISTORY_PAGE_SIZE = 100
+
 
 class ChatSentObserver(Protocol):
-    def on_chat_message_sent(self, addr: Addr, message: str):
+    def on_chat_message_sent(self, addr: Addr, message: str) -> bool:
+        # returns whether the message was queued for the peer
         pass
 
 
@@ -21,6 +33,10 @@ class ChatScreen:
         target_addr: Addr,
         chat_sent_observer: ChatSentObserver,
         chat_close_observer: ChatCloseObserver,
+        scrollback: int = DEFAULT_SCROLLBACK,
+        frame_interval: int = FRAME_INTERVAL_MS,
+        history: Optional["HistoryLog"] = None,
+        page_size: int = HISTORY_PAGE_SIZE,
     ):
         master.protocol("WM_DELETE_WINDOW", self.on_frame_close)
         self.master = master
@@ -29,6 +45,23 @@ class ChatScreen:
         self.chat_close_observer: ChatCloseObserver = chat_close_observer
         self.master.title(str(target_addr))
 
+        # messages kept in the widget, the oldest are dropped past it. 0
+        # keeps everything
+        self.scrollback = scrollback
+        self.frame_interval = frame_interval
+        # messages waiting for the next frame, inserted together
+        self.render_queue: List[str] = []
+        self.render_job: Optional[str] = None
+        # text lines taken by every message shown, oldest first
+        self.shown: Deque[int] = deque()
+
+        # every message shown is in the history, the ones before
+        # history_start are still on disk only
+        self.history = history
+        self.page_size = page_size
+        self.history_start = len(history) if history is not None else 0
+        self.history_job: Optional[str] = None
+
         self.chat_msg = scrolledtext.ScrolledText(
             master, wrap=tk.WORD, width=60, height=20
         )
@@ -52,11 +85,19 @@ class ChatScreen:
         master.grid_rowconfigure(1, weight=0)
         master.grid_columnconfigure(0, weight=1)
 
+        if self.history is not None:
+            self.chat_msg.configure(yscrollcommand=self._on_scroll)
+            self._load_history()
+
     def send_message(self):
         message = self.message_entry.get()
-        if message:
+        # only what was queued is shown, as only that is in the history. an
+        # unsent message stays in the entry to be sent again
+        if message and self.chat_sent_observer.on_chat_message_sent(
+            self.target_addr, message
+        ):
             self._insert_message(message=f"you: {message}")
-            self.chat_sent_observer.on_chat_message_sent(self.target_addr, message)
+            self.message_entry.delete(0, tk.END)
 
     def recv_message(self, message: str):
         self._insert_message(f"others: {message}")
@@ -65,9 +106,73 @@ class ChatScreen:
         self.on_frame_close()
 
     def _insert_message(self, message: str):
-        self.chat_msg.insert(tk.END, f"{message}\n")
-        self.message_entry.delete(0, tk.END)
+        self.render_queue.append(message)
+        if self.render_job is None:
+            self.render_job = self.master.after(self.frame_interval, self._render)
+
+    def _render(self):
+        # one insert per frame, tk lays the text out once however many
+        # messages arrived since the last frame
+        self.render_job = None
+        messages = self.render_queue
+        self.render_queue = []
+
+        # only follow new messages when the view is at the bottom already
+        follow = self.chat_msg.yview()[1] >= 1.0
+        self.chat_msg.insert(tk.END, "\n".join(messages) + "\n")
+        self.shown.extend(message.count("\n") + 1 for message in messages)
+        self._trim_scrollback()
+        if follow:
+            self.chat_msg.see(tk.END)
+
+    def _trim_scrollback(self):
+        if not self.scrollback or len(self.shown) <= self.scrollback:
+            return
+        lines = 0
+        dropped = len(self.shown) - self.scrollback
+        for _ in range(dropped):
+            lines += self.shown.popleft()
+        self.chat_msg.delete("1.0", f"{lines + 1}.0")
+        if self.history is not None:
+            # dropped messages can be paged back in from disk
+            self.history_start += dropped
+
+    def _on_scroll(self, first: str, last: str):
+        self.chat_msg.vbar.set(first, last)
+        if float(first) <= 0.0 and self.history_start > 0 and self.history_job is None:
+            # not from inside the scroll callback, the insert scrolls again
+            self.history_job = self.master.after_idle(self._load_history)
+
+    def _load_history(self):
+        self.history_job = None
+        assert self.history is not None
+        entries = self.history.page(self.history_start, self.page_size)
+        if not entries:
+            return
+        self.history_start -= len(entries)
+
+        at_start = not self.shown
+        messages = [self._format_entry(entry) for entry in entries]
+        self.chat_msg.insert("1.0", "\n".join(messages) + "\n")
+        line_counts = [message.count("\n") + 1 for message in messages]
+        self.shown.extendleft(reversed(line_counts))
+
+        if at_start:
+            self.chat_msg.see(tk.END)
+        else:
+            # keep the line that was at the top of the view in place
+            self.chat_msg.yview(f"{sum(line_counts) + 1}.0")
+
+    def _format_entry(self, entry: "HistoryEntry") -> str:
+        message = entry.message.decode(errors="replace")
+        return f"you: {message}" if entry.outgoing else f"others: {message}"
 
     def on_frame_close(self):
+        if self.render_job is not None:
+            self.master.after_cancel(self.render_job)
+            self.render_job = None
+        if self.history_job is not None:
+            self.master.after_cancel(self.history_job)
+            self.history_job = None
         self.chat_close_observer.on_chat_closes(addr=self.target_addr)
         self.master.destroy()
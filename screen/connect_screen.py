@@ -1,6 +1,6 @@
 import tkinter as tk
 from tkinter import ttk
-from typing import Iterable, Protocol
+from typing import List, Protocol
 from state.base import Addr
 
 
@@ -34,7 +34,8 @@ class ConnectionScreen:
         host, port = addr.split(":")
         self.connect_observer.on_connect(Addr(host=host, port=int(port)))
 
-    def update_active_ip(self, active_ip: Iterable[Addr]):
-        self.combo_box["values"] = list(
-            f"{addr.host}:{addr.port}" for addr in active_ip
-        )
+    def update_peers(self, added: List[Addr], removed: List[Addr]):
+        values = set(self.combo_box["values"])
+        values.difference_update(f"{addr.host}:{addr.port}" for addr in removed)
+        values.update(f"{addr.host}:{addr.port}" for addr in added)
+        self.combo_box["values"] = sorted(values)
@@ -1,13 +1,44 @@
+import heapq
+import random
 import socket
+import time
+import metrics
 import network
 from state.base import Addr
-from typing import Optional, Set, Iterable
+from typing import Dict, List, Optional, Protocol, Iterable, Tuple
+
+
+class PeerObserver(Protocol):
+    def on_peers_changed(self, added: List[Addr], removed: List[Addr]):
+        pass
+
+
+DATAGRAMS_RECEIVED = metrics.REGISTRY.counter(
+    "discovery_datagrams_total", "discovery datagrams received", backend="multicast"
+)
+
+ANNOUNCE_INTERVAL = 3.0
+MAX_ANNOUNCE_INTERVAL = 60.0
+# announcements per second every node is willing to receive from the group
+GROUP_ANNOUNCE_RATE = 50.0
+
+
+def announce_interval(group_size: int, base: float = ANNOUNCE_INTERVAL) -> float:
+    # stretches the interval once the group would go past the receive budget,
+    # so the traffic every node sees stays flat as the network grows
+    return min(max(base, group_size / GROUP_ANNOUNCE_RATE), MAX_ANNOUNCE_INTERVAL)
 
 
 class ServiceDiscoveryClient:
-    def __init__(self, local_addr: Addr, multicast_addr: Addr) -> None:
+    def __init__(
+        self,
+        local_addr: Addr,
+        multicast_addr: Addr,
+        interval: float = ANNOUNCE_INTERVAL,
+    ) -> None:
         self.message: bytes = f"{local_addr.host}:{local_addr.port}".encode()
         self.multicast_addr = multicast_addr
+        self.interval = interval
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
@@ -17,15 +48,76 @@ class ServiceDiscoveryClient:
             self.message, (self.multicast_addr.host, self.multicast_addr.port)
         )
 
+    def next_interval(self, group_size: int) -> float:
+        # seconds until the next publish, randomised so nodes started together
+        # do not keep announcing in lockstep
+        return announce_interval(group_size, self.interval) * random.uniform(0.5, 1.5)
 
-class ServiceDiscoveryServer:
-    def __init__(self, local_addr: Addr, multicast_addr: Addr) -> None:
+
+class PeerTable:
+    # peers that stay quiet for ttl seconds are dropped, the observer hears
+    # about peers coming and going once per poll instead of the whole table
+    def __init__(self, ttl: float, peer_observer: Optional[PeerObserver]) -> None:
+        self.ttl = ttl
+        self.peer_observer: Optional[PeerObserver] = peer_observer
+        self.last_seen: Dict[Addr, float] = {}
+        # one (deadline, addr) entry per peer, re-armed when it turns out the
+        # peer was heard from since
+        self.expiry_heap: List[Tuple[float, Addr]] = []
+
+    def retrieve_active_address(self) -> Iterable[Addr]:
+        return (addr for addr in self.last_seen.keys())
+
+    def group_ttl(self) -> float:
+        # peers announce less often in a large group, stretch the ttl with
+        # their interval
+        return self.ttl * announce_interval(len(self.last_seen)) / ANNOUNCE_INTERVAL
+
+    def _seen(self, addr: Addr, now: float) -> bool:
+        # returns whether the peer is new
+        is_new = addr not in self.last_seen
+        self.last_seen[addr] = now
+        if is_new:
+            heapq.heappush(self.expiry_heap, (now + self.group_ttl(), addr))
+        return is_new
+
+    def _expire(self, now: float) -> List[Addr]:
+        removed: List[Addr] = []
+        ttl = self.group_ttl()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, addr = heapq.heappop(self.expiry_heap)
+            deadline = self.last_seen[addr] + ttl
+            if deadline > now:
+                heapq.heappush(self.expiry_heap, (deadline, addr))
+            else:
+                del self.last_seen[addr]
+                removed.append(addr)
+        return removed
+
+    def _report(self, added: List[Addr]):
+        removed = self._expire(time.monotonic())
+        if (added or removed) and self.peer_observer:
+            self.peer_observer.on_peers_changed(added, removed)
+
+
+class ServiceDiscoveryServer(PeerTable):
+    def __init__(
+        self,
+        local_addr: Addr,
+        multicast_addr: Addr,
+        ttl: float = 10.0,
+        peer_observer: Optional[PeerObserver] = None,
+        recv_buffer: int = 1024 * 1024,
+    ) -> None:
+        PeerTable.__init__(self, ttl, peer_observer)
         self.local_addr = local_addr
         self.poller = network.Poller()
-        self.active_address: Set[Addr] = set()
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # room for a burst of announcements between two polls
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+        self.sock.setblocking(False)
         self.sock.bind(("", multicast_addr.port))
         self.mreq = socket.inet_aton(multicast_addr.host) + socket.inet_aton(
             local_addr.host
@@ -34,20 +126,30 @@ class ServiceDiscoveryServer:
         self.poller.register(self.sock)
 
     def poll(self, timeout: Optional[float] = None):
+        added: List[Addr] = []
         for conn in self.poller.poll(timeout):
             assert conn == self.sock
-            data, _ = conn.recvfrom(1024)
-
-            try:
-                host, port = data.decode().split(":")
-                addr = Addr(host=host, port=int(port))
-                if addr != self.local_addr:
-                    self.active_address.add(addr)
-            except Exception:
-                pass
-
-    def retrieve_active_address(self) -> Iterable[Addr]:
-        return (addr for addr in self.active_address)
+            now = time.monotonic()
+
+            # empty the socket, one datagram per wakeup falls behind as soon
+            # as the group announces faster than we poll
+            while True:
+                try:
+                    data, _ = conn.recvfrom(1024)
+                except (BlockingIOError, InterruptedError):
+                    break
+                DATAGRAMS_RECEIVED.inc()
+
+                try:
+                    host, port = data.decode().split(":")
+                    addr = Addr(host=host, port=int(port))
+                    if addr != self.local_addr:
+                        if self._seen(addr, now):
+                            added.append(addr)
+                except Exception:
+                    pass
+
+        self._report(added)
 
 
 if __name__ == "__main__":
@@ -6,13 +6,81 @@ from state.base import (
     ProtocolContextChatObserver,
     Context,
     SenderCallback,
+    DEFAULT_HANDSHAKE_MODES,
+    DEFAULT_CIPHER_SUITES,
+    DEFAULT_WIRE_FORMATS,
 )
-from state.sync_key_exchange import SyncKeyExchangeState
-from state.key_exchange import KeyExchangeState
+from state.resumption import TicketCache
+import importlib
 import json
-from crypto import aes
-from typing import Protocol
-from network import Addr
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+)
+from collections import deque
+from network import Addr, format_addr
+from transfer import (
+    IncomingTransfer,
+    OutgoingTransfer,
+    TransferKind,
+    new_transfer_id,
+)
+import metrics
+import time
+import tracing
+
+if TYPE_CHECKING:
+    from crypto.key_pool import KeyPool
+
+# the handshake states pull in every crypto backend, they are imported by the
+# first session rather than by whoever imports this module
+HANDSHAKE_MODULES = (
+    "state.sync_key_exchange",
+    "state.key_exchange",
+    "state.ack_key_exchange",
+    "state.chat",
+    "crypto.aes",
+)
+
+
+def preload():
+    # imports now what the first session would, once a node is listening and
+    # has nothing better to do, so the first handshake does not pay for it
+    for name in HANDSHAKE_MODULES:
+        importlib.import_module(name)
+
+
+STATE_CHANGES = metrics.REGISTRY.counter(
+    "session_state_changes_total", "handshake and chat state transitions"
+)
+SESSION_ERRORS = metrics.REGISTRY.counter(
+    "chat_errors_total", "failures by where they were caught", kind="session"
+)
+MESSAGES_DROPPED = metrics.REGISTRY.counter(
+    "chat_messages_dropped_total",
+    "messages held for a batch when their session went away",
+)
+# on_message time per state class, filled in as states are first seen
+STATE_SECONDS: Dict[type, metrics.Histogram] = {}
+
+
+def state_histogram(state: BaseState) -> metrics.Histogram:
+    histogram = STATE_SECONDS.get(type(state))
+    if histogram is None:
+        histogram = STATE_SECONDS[type(state)] = metrics.REGISTRY.histogram(
+            "session_state_seconds",
+            "time to handle one record, by the state handling it",
+            state=type(state).__name__,
+        )
+    return histogram
 
 
 class SessionCloseObserver(Protocol):
@@ -20,6 +88,29 @@ class SessionCloseObserver(Protocol):
         pass
 
 
+class SessionOpenObserver(Protocol):
+    def on_session_open(self, addr: Addr):
+        pass
+
+
+class TransferObserver(Protocol):
+    def on_transfer_done(self, addr: Addr, transfer_id: str, path: str):
+        pass
+
+    def on_transfer_failed(self, addr: Addr, transfer_id: str, reason: str):
+        pass
+
+
+class GroupRecordObserver(Protocol):
+    def on_group_record(self, addr: Addr, kind: str, group_id: str, payload: bytes):
+        pass
+
+
+class CoalesceConfig(NamedTuple):
+    window: float
+    max_bytes: int
+
+
 class Receiver(ABC):
     @abstractmethod
     def on_message_recv(self, raw_message: bytes) -> Response:
@@ -50,48 +141,380 @@ class BaseSession(ReceiverSender):
         self._chat_observer: ProtocolContextChatObserver = chat_observer
         self._state: BaseState = state
 
+        self._coalesce: Optional[CoalesceConfig] = None
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._pending_deadline: Optional[float] = None
+        self._pending_sender_cb: Optional[SenderCallback] = None
+
+        self._transfer_observer: Optional[TransferObserver] = None
+        self._download_dir: Optional[str] = None
+        self._outgoing: Deque[OutgoingTransfer] = deque()
+        # fully sent, reported done once the peer's receipt comes back
+        self._unconfirmed: Dict[str, OutgoingTransfer] = {}
+        self._incoming: Dict[str, IncomingTransfer] = {}
+
+        self._group_observer: Optional[GroupRecordObserver] = None
+
+    @property
+    def addr(self) -> Addr:
+        return self._addr
+
+    @property
+    def pending_deadline(self) -> Optional[float]:
+        return self._pending_deadline
+
     def change_state(self, state: BaseState):
+        STATE_CHANGES.inc()
         self._state = state
 
+    def on_peer_listen_port(self, port: int):
+        # peers are known by the address they accept connections on, only
+        # the port is taken from the hello, the host is where it came from
+        self._addr = Addr(host=self._addr.host, port=port)
+
+    def set_coalescing(self, window: float, max_bytes: int = 64 * 1024):
+        # messages sent within window seconds, up to max_bytes, go out as one
+        # encrypted batch record. a window of 0 sends every message right away
+        self.flush_pending()
+        self._coalesce = CoalesceConfig(window, max_bytes) if window > 0 else None
+
+    def send_message(self, message: bytes, sender_cb: SenderCallback):
+        if self._coalesce is None or not self._state.batches:
+            self.flush_pending()
+            if tracing.TRACER.hooks:
+                self._traced_send(
+                    len(message),
+                    lambda cb: self._state.send_message(message, cb),
+                    sender_cb,
+                )
+            else:
+                self._state.send_message(message, sender_cb)
+            return
+
+        self._pending.append(message)
+        self._pending_bytes += len(message)
+        self._pending_sender_cb = sender_cb
+        if self._pending_deadline is None:
+            self._pending_deadline = time.monotonic() + self._coalesce.window
+
+        if self._pending_bytes >= self._coalesce.max_bytes:
+            self.flush_pending()
+
+    def flush_pending(self):
+        if not self._pending:
+            return
+
+        messages, sender_cb = self._pending, self._pending_sender_cb
+        self._pending, self._pending_bytes = [], 0
+        self._pending_deadline = self._pending_sender_cb = None
+
+        assert sender_cb is not None
+        if tracing.TRACER.hooks:
+            self._traced_send(
+                sum(len(message) for message in messages),
+                lambda cb: self._state.send_batch(messages, cb),
+                sender_cb,
+            )
+        else:
+            self._state.send_batch(messages, sender_cb)
+
+    def _traced_send(
+        self,
+        size: int,
+        send: Callable[[SenderCallback], None],
+        sender_cb: SenderCallback,
+    ):
+        wire_size = 0
+
+        def counting_sender_cb(data: bytes) -> int:
+            nonlocal wire_size
+            wire_size += len(data)
+            return sender_cb(data)
+
+        state = self._state
+        started = time.perf_counter()
+        send(counting_sender_cb)
+        tracing.TRACER.emit(
+            tracing.trace_record(
+                self._addr,
+                "send",
+                state,
+                self._state,
+                size,
+                wire_size,
+                time.perf_counter() - started,
+            )
+        )
+
+    def poll_timers(self, now: float) -> Optional[float]:
+        # flushes a coalescing window that has run out, returns the next
+        # deadline or None when nothing is pending
+        if self._pending_deadline is not None and now >= self._pending_deadline:
+            self.flush_pending()
+        return self._pending_deadline
+
+    @property
+    def established(self) -> bool:
+        return self._state.established
+
+    @property
+    def wire_format(self) -> Optional[str]:
+        return self._state.wire_format
+
+    @property
+    def transfer_ready(self) -> bool:
+        # a file is waiting to be sent and the key exchange is over
+        return bool(self._outgoing) and self._state.transfers
+
+    def set_transfer_observer(
+        self, observer: TransferObserver, download_dir: Optional[str] = None
+    ):
+        # without a download dir incoming files are refused
+        self._transfer_observer = observer
+        self._download_dir = download_dir
+
+    def send_file(self, path: str) -> str:
+        transfer = OutgoingTransfer(new_transfer_id(), path)
+        self._outgoing.append(transfer)
+        return transfer.transfer_id
+
+    def send_transfer_chunk(self, sender_cb: SenderCallback):
+        # one record of the oldest transfer, which then goes to the back so
+        # concurrent transfers take turns
+        transfer = self._outgoing.popleft()
+        try:
+            kind, payload = transfer.next_record()
+        except (OSError, ValueError) as e:
+            # the file shrank or went away under the mapping
+            transfer.close()
+            self._state.send_transfer_record(
+                TransferKind.CANCEL, transfer.transfer_id, str(e).encode(), sender_cb
+            )
+            self._notify_transfer_failed(transfer.transfer_id, str(e))
+            return
+
+        self._state.send_transfer_record(kind, transfer.transfer_id, payload, sender_cb)
+        if not transfer.done:
+            self._outgoing.append(transfer)
+            return
+
+        transfer.close()
+        self._unconfirmed[transfer.transfer_id] = transfer
+
+    def on_transfer_record(
+        self, kind: str, transfer_id: str, payload: bytes
+    ) -> Optional[Tuple[str, bytes]]:
+        if kind == TransferKind.CANCEL:
+            self._cancel_transfer(transfer_id, payload.decode(errors="replace"))
+            return None
+
+        if kind == TransferKind.RECEIVED:
+            transfer = self._unconfirmed.pop(transfer_id, None)
+            if transfer is not None and self._transfer_observer:
+                self._transfer_observer.on_transfer_done(
+                    self._addr, transfer_id, transfer.path
+                )
+            return None
+
+        if kind == TransferKind.OFFER:
+            if self._download_dir is None:
+                return TransferKind.CANCEL, b"file transfers are not accepted"
+            if transfer_id in self._incoming:
+                return TransferKind.CANCEL, b"transfer id already in use"
+            try:
+                self._incoming[transfer_id] = IncomingTransfer(
+                    transfer_id, self._download_dir, payload
+                )
+            except (OSError, ValueError, KeyError) as e:
+                return TransferKind.CANCEL, str(e).encode()
+            return None
+
+        incoming = self._incoming.get(transfer_id, None)
+        if incoming is None:
+            # already cancelled, the rest of it is still in flight
+            return None
+
+        try:
+            if kind == TransferKind.CHUNK:
+                incoming.write_chunk(payload)
+                return None
+
+            path = incoming.finish(payload)
+        except (OSError, RuntimeError) as e:
+            self._cancel_transfer(transfer_id, str(e))
+            return TransferKind.CANCEL, str(e).encode()
+
+        del self._incoming[transfer_id]
+        if self._transfer_observer:
+            self._transfer_observer.on_transfer_done(self._addr, transfer_id, path)
+        return TransferKind.RECEIVED, b""
+
+    def set_group_observer(self, observer: GroupRecordObserver):
+        # without one group records are dropped
+        self._group_observer = observer
+
+    def send_group_record(
+        self, kind: str, group_id: str, payload: bytes, sender_cb: SenderCallback
+    ):
+        self.flush_pending()
+        self._state.send_group_record(kind, group_id, payload, sender_cb)
+
+    def encode_group_post(self, group_id: str, sealed: bytes) -> bytes:
+        return self._state.encode_group_post(group_id, sealed)
+
+    def on_group_record(self, kind: str, group_id: str, payload: bytes):
+        if self._group_observer:
+            self._group_observer.on_group_record(self._addr, kind, group_id, payload)
+
     def on_message_recv(self, raw_message: bytes) -> Response:
+        state = self._state
+        chat_observer = self._chat_observer
+        timed_observer: Optional[tracing.TimedChatObserver] = None
+        if tracing.TRACER.hooks:
+            chat_observer = timed_observer = tracing.TimedChatObserver(chat_observer)
+
+        started = time.perf_counter()
         try:
-            return self._state.on_message(
+            response = state.on_message(
                 raw_message,
                 Context(
                     state_changer=self,
-                    chat_observer=self._chat_observer,
+                    chat_observer=chat_observer,
                     addr=self._addr,
+                    transfer_sink=self,
+                    group_sink=self,
                 ),
             )
         except Exception as e:
             print(f"exception caught: {e}")
+            SESSION_ERRORS.inc()
             error_msg = {}
             error_msg["result"] = "invalid"
-            return Response(
+            response = Response(
                 message=json.dumps(error_msg).encode(),
                 status=ReponseStatus.DISCONNECT,
             )
+        duration = time.perf_counter() - started
+        state_histogram(state).observe(duration)
+
+        if timed_observer is not None:
+            tracing.TRACER.emit(
+                tracing.trace_record(
+                    self._addr,
+                    "recv",
+                    state,
+                    self._state,
+                    len(raw_message),
+                    len(response.message or b""),
+                    duration,
+                    timed_observer.elapsed,
+                    response.status.name,
+                )
+            )
+        return response
 
     def close_session(self, addr: Addr, close_observer: SessionCloseObserver):
+        self.release()
         close_observer.on_session_close(self._addr)
 
+    def release(self):
+        # drops everything the session holds without reporting a close.
+        # messages still held for a batch are counted and reported lost, the
+        # caller flushes them first while the connection can take them
+        if self._pending:
+            print(f"{len(self._pending)} messages to {format_addr(self._addr)} dropped")
+            MESSAGES_DROPPED.inc(len(self._pending))
+            self._pending, self._pending_bytes = [], 0
+            self._pending_deadline = self._pending_sender_cb = None
+        for transfer in self._outgoing:
+            transfer.close()
+        self._outgoing.clear()
+        self._unconfirmed.clear()
+        for incoming in self._incoming.values():
+            incoming.abort()
+        self._incoming.clear()
+
+    def _cancel_transfer(self, transfer_id: str, reason: str):
+        incoming = self._incoming.pop(transfer_id, None)
+        if incoming is not None:
+            incoming.abort()
+
+        for transfer in self._outgoing:
+            if transfer.transfer_id == transfer_id:
+                self._outgoing.remove(transfer)
+                transfer.close()
+                break
+        else:
+            # a file already sent can still fail its digest on the other end
+            unconfirmed = self._unconfirmed.pop(transfer_id, None)
+            if incoming is None and unconfirmed is None:
+                return
+
+        self._notify_transfer_failed(transfer_id, reason)
+
+    def _notify_transfer_failed(self, transfer_id: str, reason: str):
+        print(f"transfer {transfer_id} failed: {reason}")
+        if self._transfer_observer:
+            self._transfer_observer.on_transfer_failed(self._addr, transfer_id, reason)
+
 
 class ServerSession(BaseSession):
-    def __init__(self, addr: Addr, chat_observer: ProtocolContextChatObserver) -> None:
-        BaseSession.__init__(self, SyncKeyExchangeState(), addr, chat_observer)
+    def __init__(
+        self,
+        addr: Addr,
+        chat_observer: ProtocolContextChatObserver,
+        key_pool: Optional["KeyPool"] = None,
+        modes: Sequence[str] = DEFAULT_HANDSHAKE_MODES,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        wire_formats: Sequence[str] = DEFAULT_WIRE_FORMATS,
+        tickets: Optional[TicketCache] = None,
+    ) -> None:
+        from state.sync_key_exchange import SyncKeyExchangeState
 
-    def send_message(self, message: bytes, sender_cb: SenderCallback):
-        self._state.send_message(message, sender_cb)
+        BaseSession.__init__(
+            self,
+            SyncKeyExchangeState(
+                key_pool=key_pool,
+                modes=modes,
+                cipher_suites=cipher_suites,
+                wire_formats=wire_formats,
+                tickets=tickets,
+            ),
+            addr,
+            chat_observer,
+        )
 
 
 class ClientSession(BaseSession):
-    def __init__(self, addr: Addr, chat_observer: ProtocolContextChatObserver) -> None:
-        BaseSession.__init__(
-            self, KeyExchangeState(aes.generate_key()), addr, chat_observer
+    def __init__(
+        self,
+        addr: Addr,
+        chat_observer: ProtocolContextChatObserver,
+        modes: Sequence[str] = DEFAULT_HANDSHAKE_MODES,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        wire_formats: Sequence[str] = DEFAULT_WIRE_FORMATS,
+        tickets: Optional[TicketCache] = None,
+        listen_port: Optional[int] = None,
+    ) -> None:
+        from crypto import aes
+        from state.key_exchange import KeyExchangeState
+
+        # tickets are single use, a failed resumption falls back to a full
+        # handshake in the same round trip
+        self._key_exchange_state = KeyExchangeState(
+            aes.generate_key(),
+            modes=modes,
+            cipher_suites=cipher_suites,
+            wire_formats=wire_formats,
+            tickets=tickets,
+            resume_ticket=tickets.pop(addr) if tickets is not None else None,
+            listen_port=listen_port,
         )
+        BaseSession.__init__(self, self._key_exchange_state, addr, chat_observer)
 
-    def send_message(self, message: bytes, sender_cb: SenderCallback):
-        self._state.send_message(message, sender_cb)
+    def hello(self) -> bytes:
+        return self._key_exchange_state.hello()
 
 
 if __name__ == "__main__":
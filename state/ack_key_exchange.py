@@ -1,16 +1,33 @@
-from state.base import BaseState, Response, ReponseStatus, Context, SenderCallback
-import json
+from state.base import (
+    BaseState,
+    Response,
+    ReponseStatus,
+    Context,
+    SenderCallback,
+    CipherSuite,
+    WireFormat,
+)
 from crypto import rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 from typing import Optional
-import base64
 from state.chat import ChatState
+from state.codec import decode_record
+from state.resumption import TicketCache
 
 
 class AckKeyExchangeState(BaseState):
-    def __init__(self, pri_key: RSAPrivateKey) -> None:
+    def __init__(
+        self,
+        pri_key: RSAPrivateKey,
+        cipher_suite: str = CipherSuite.FERNET,
+        wire_format: str = WireFormat.JSON,
+        tickets: Optional[TicketCache] = None,
+    ) -> None:
         self.pri_key = pri_key
+        self.cipher_suite = cipher_suite
+        self.wire_format = wire_format
         self._secret: Optional[bytes] = None
+        self.tickets: Optional[TicketCache] = tickets
 
     @property
     def secret(self) -> bytes:
@@ -20,14 +37,28 @@ class AckKeyExchangeState(BaseState):
     def on_message(self, message: bytes, context: Context) -> Response:
         state_changer = context.state_changer
 
-        input_msg = json.loads(message.decode())
-        cipher_secret = base64.b64decode(input_msg["secret"].encode())
+        input_msg = decode_record(message)
+        cipher_secret = input_msg["secret"]
 
         self._secret = rsa.decrypt_message(self.pri_key, cipher_secret)
 
-        response = Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+        chat_state = ChatState(
+            secret=self._secret,
+            cipher_suite=self.cipher_suite,
+            initiator=False,
+            wire_format=self.wire_format,
+        )
 
-        state_changer.change_state(ChatState(secret=self._secret))
+        if self.tickets is not None:
+            # the first sealed record of the session hands over the ticket
+            response = Response(
+                message=chat_state.encode_ticket(self.tickets),
+                status=ReponseStatus.REPLY_NEEDED,
+            )
+        else:
+            response = Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+
+        state_changer.change_state(chat_state)
 
         return response
 
@@ -1,29 +1,85 @@
 from abc import ABC, abstractmethod
-from typing import NamedTuple, Any, Protocol, Callable
+from typing import NamedTuple, Any, Optional, Protocol, Callable, Sequence, Tuple
 from enum import Enum
 from network import Addr
 
 
+class HandshakeMode:
+    X25519 = "x25519"
+    RSA = "rsa"
+    # skips the key exchange with a ticket from an earlier session
+    RESUME = "resume"
+
+
+DEFAULT_HANDSHAKE_MODES = (
+    HandshakeMode.RESUME,
+    HandshakeMode.X25519,
+    HandshakeMode.RSA,
+)
+
+
+class CipherSuite:
+    AES_256_GCM = "aes-256-gcm"
+    CHACHA20_POLY1305 = "chacha20-poly1305"
+    FERNET = "fernet"
+
+
+DEFAULT_CIPHER_SUITES = (
+    CipherSuite.AES_256_GCM,
+    CipherSuite.CHACHA20_POLY1305,
+    CipherSuite.FERNET,
+)
+
+
+class WireFormat:
+    BINARY = "binary-v1"
+    JSON = "json"
+
+
+DEFAULT_WIRE_FORMATS = (WireFormat.BINARY, WireFormat.JSON)
+
+
 class ContextKey:
     STATE_CHANGER = "state_changer"
     CHAT_OBSERVER = "chat_observer"
     ADDR = "addr"
+    TRANSFER_SINK = "transfer_sink"
+    GROUP_SINK = "group_sink"
 
 
 class ProtocolContextStateChanger(Protocol):
     def change_state(self, state: Any):
         pass
 
+    def on_peer_listen_port(self, port: int):
+        pass
+
 
 class ProtocolContextChatObserver(Protocol):
     def on_chat(self, addr: Addr, message: bytes):
         pass
 
 
+class ProtocolContextTransferSink(Protocol):
+    def on_transfer_record(
+        self, kind: str, transfer_id: str, payload: bytes
+    ) -> Optional[Tuple[str, bytes]]:
+        # returns the record to send back, a cancel with its reason or the
+        # receipt for a finished file
+        pass
+
+
+class ProtocolContextGroupSink(Protocol):
+    def on_group_record(self, kind: str, group_id: str, payload: bytes):
+        pass
+
+
 class Context(NamedTuple):
     state_changer: ProtocolContextStateChanger
     chat_observer: ProtocolContextChatObserver
     addr: Addr
+    transfer_sink: ProtocolContextTransferSink
+    group_sink: ProtocolContextGroupSink
 
 
 class ReponseStatus(Enum):
@@ -41,6 +97,15 @@ SenderCallback = Callable[[bytes], int]
 
 
 class BaseState(ABC):
+    # whether send_batch packs several messages into one record
+    batches = False
+    # whether file transfer records can be sent yet
+    transfers = False
+    # whether the key exchange is over and chat messages can be sent
+    established = False
+    # the record format agreed on, known once the key exchange is over
+    wire_format: Optional[str] = None
+
     @abstractmethod
     def on_message(self, message: bytes, context: Context) -> Response:
         pass
@@ -48,3 +113,20 @@ class BaseState(ABC):
     @abstractmethod
     def send_message(self, message: bytes, sender_cb: SenderCallback):
         pass
+
+    def send_batch(self, messages: Sequence[bytes], sender_cb: SenderCallback):
+        for message in messages:
+            self.send_message(message, sender_cb)
+
+    def send_transfer_record(
+        self, kind: str, transfer_id: str, payload: bytes, sender_cb: SenderCallback
+    ):
+        raise RuntimeError("no session established for file transfers")
+
+    def send_group_record(
+        self, kind: str, group_id: str, payload: bytes, sender_cb: SenderCallback
+    ):
+        raise RuntimeError("no session established for groups")
+
+    def encode_group_post(self, group_id: str, sealed: bytes) -> bytes:
+        raise RuntimeError("no session established for groups")
@@ -1,18 +1,118 @@
-from state.base import BaseState, Response, ReponseStatus, Context, SenderCallback
-import json
-from crypto import aes
+from state.base import (
+    BaseState,
+    Response,
+    ReponseStatus,
+    Context,
+    SenderCallback,
+    CipherSuite,
+    WireFormat,
+)
+from state.codec import Codec, Record, decode_record, get_codec
+from crypto import aes, aead, ticket
+from state.resumption import ClientTicket, TicketCache
+from transfer import TRANSFER_KINDS, TransferKind, valid_transfer_id
+from group import GROUP_RECORD_KINDS, GroupRecordKind
+from network import Addr
+from typing import Iterator, List, Optional, Protocol, Sequence
+import struct
+
+
+class Cipher(Protocol):
+    def encrypt(self, message: bytes) -> bytes:
+        pass
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        pass
+
+
+def create_cipher(cipher_suite: str, secret: bytes, initiator: bool) -> Cipher:
+    if cipher_suite == CipherSuite.FERNET:
+        return aes.FernetCipher(secret)
+
+    if cipher_suite in aead.ALGORITHMS:
+        send_key, recv_key = aead.derive_keys(secret, cipher_suite, initiator)
+        return aead.AeadCipher(cipher_suite, send_key, recv_key)
+
+    raise RuntimeError(f"unknown cipher suite: {cipher_suite}")
+
+
+def select_cipher_suite(offered: Sequence[str], supported: Sequence[str]) -> str:
+    # picked by the server in its own order of preference, peers that do not
+    # offer anything only know fernet
+    for cipher_suite in supported:
+        if cipher_suite in offered:
+            return cipher_suite
+    return CipherSuite.FERNET
+
+
+BATCH_ITEM_HEADER = struct.Struct("!I")
+
+
+def pack_batch(messages: Sequence[bytes]) -> bytes:
+    parts: List[bytes] = []
+    for message in messages:
+        parts.append(BATCH_ITEM_HEADER.pack(len(message)))
+        parts.append(message)
+    return b"".join(parts)
+
+
+def unpack_batch(batch: bytes) -> Iterator[bytes]:
+    offset = 0
+    while offset < len(batch):
+        (length,) = BATCH_ITEM_HEADER.unpack_from(batch, offset)
+        offset += BATCH_ITEM_HEADER.size
+        if offset + length > len(batch):
+            raise RuntimeError("truncated batch record")
+        yield batch[offset : offset + length]
+        offset += length
 
 
 class ChatState(BaseState):
-    def __init__(self, secret: bytes) -> None:
+    established = True
+
+    def __init__(
+        self,
+        secret: bytes,
+        cipher_suite: str = CipherSuite.FERNET,
+        initiator: bool = True,
+        wire_format: str = WireFormat.JSON,
+        tickets: Optional[TicketCache] = None,
+    ) -> None:
         self.secret: bytes = secret
+        self.cipher_suite = cipher_suite
+        self.cipher: Cipher = create_cipher(cipher_suite, secret, initiator)
+        self.codec: Codec = get_codec(wire_format)
+        self.wire_format = wire_format
+        # batch records came with the binary format, json peers predate them
+        self.batches = wire_format != WireFormat.JSON
+        self.transfers = True
+        # where the client keeps tickets the server sends after the handshake
+        self.tickets: Optional[TicketCache] = tickets
 
     def on_message(self, message: bytes, context: Context) -> Response:
         chat_observer = context.chat_observer
         addr = context.addr
 
-        input_msg = json.loads(message.decode())
-        recv_msg = aes.decrypt_message(self.secret, input_msg["message"].encode())
+        input_msg = decode_record(message)
+        if "batch" in input_msg:
+            for recv_msg in unpack_batch(self.cipher.decrypt(input_msg["batch"])):
+                chat_observer.on_chat(addr=addr, message=recv_msg)
+            return Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+
+        if "ticket" in input_msg:
+            self.accept_ticket(input_msg["ticket"], addr)
+            return Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+
+        if "transfer" in input_msg:
+            return self._on_transfer_record(input_msg, context)
+
+        if "group" in input_msg:
+            return self._on_group_record(input_msg, context)
+
+        if "sealed" in input_msg:
+            recv_msg = self.cipher.decrypt(input_msg["sealed"])
+        else:
+            recv_msg = self.cipher.decrypt(input_msg["message"])
 
         chat_observer.on_chat(addr=addr, message=recv_msg)
         return Response(
@@ -21,7 +121,108 @@ class ChatState(BaseState):
         )
 
     def send_message(self, message: bytes, sender_cb: SenderCallback):
-        cipher_message = aes.encrypt_message(self.secret, message)
-        output_msg = {}
-        output_msg["message"] = cipher_message.decode()
-        sender_cb(json.dumps(output_msg).encode())
+        cipher_message = self.cipher.encrypt(message)
+        output_msg: Record = {}
+        if self.cipher_suite == CipherSuite.FERNET:
+            # fernet tokens are already url safe base64 text
+            output_msg["message"] = cipher_message
+        else:
+            output_msg["sealed"] = cipher_message
+        sender_cb(self.codec.encode(output_msg))
+
+    def send_batch(self, messages: Sequence[bytes], sender_cb: SenderCallback):
+        if not self.batches or len(messages) == 1:
+            BaseState.send_batch(self, messages, sender_cb)
+            return
+
+        output_msg: Record = {}
+        output_msg["batch"] = self.cipher.encrypt(pack_batch(messages))
+        sender_cb(self.codec.encode(output_msg))
+
+    def issue_ticket(self, tickets: TicketCache) -> bytes:
+        # server side, the ticket only travels sealed so nobody can link the
+        # resumed session to this one
+        new_ticket = ticket.new_ticket()
+        tickets.put(new_ticket, ticket.resumption_secret(self.secret))
+        return self.cipher.encrypt(new_ticket)
+
+    def encode_ticket(self, tickets: TicketCache) -> bytes:
+        output_msg: Record = {}
+        output_msg["ticket"] = self.issue_ticket(tickets)
+        return self.codec.encode(output_msg)
+
+    def accept_ticket(self, sealed_ticket: bytes, addr: Addr):
+        new_ticket = self.cipher.decrypt(sealed_ticket)
+        if self.tickets is not None:
+            self.tickets.put(
+                addr,
+                ClientTicket(
+                    ticket=new_ticket, secret=ticket.resumption_secret(self.secret)
+                ),
+            )
+
+    def send_transfer_record(
+        self, kind: str, transfer_id: str, payload: bytes, sender_cb: SenderCallback
+    ):
+        sender_cb(self._encode_transfer_record(kind, transfer_id, payload))
+
+    def _encode_transfer_record(
+        self, kind: str, transfer_id: str, payload: bytes
+    ) -> bytes:
+        # each record is sealed on its own, a chunk is authenticated before
+        # anything of it reaches the disk
+        output_msg: Record = {}
+        output_msg["transfer"] = transfer_id
+        output_msg[kind] = self.cipher.encrypt(payload)
+        return self.codec.encode(output_msg)
+
+    def send_group_record(
+        self, kind: str, group_id: str, payload: bytes, sender_cb: SenderCallback
+    ):
+        # invites and leaves are for this peer only, sealed by the session
+        output_msg: Record = {}
+        output_msg["group"] = group_id
+        output_msg[kind] = self.cipher.encrypt(payload)
+        sender_cb(self.codec.encode(output_msg))
+
+    def encode_group_post(self, group_id: str, sealed: bytes) -> bytes:
+        # already sealed under the group key, the record is the same for
+        # every member using this wire format
+        output_msg: Record = {}
+        output_msg["group"] = group_id
+        output_msg[GroupRecordKind.POST] = sealed
+        return self.codec.encode(output_msg)
+
+    def _on_group_record(self, input_msg: Record, context: Context) -> Response:
+        group_id = input_msg["group"]
+        for kind in GROUP_RECORD_KINDS:
+            if kind in input_msg:
+                break
+        else:
+            raise RuntimeError("group record without payload")
+
+        payload = input_msg[kind]
+        if kind != GroupRecordKind.POST:
+            payload = self.cipher.decrypt(payload)
+        context.group_sink.on_group_record(kind, group_id, payload)
+        return Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+
+    def _on_transfer_record(self, input_msg: Record, context: Context) -> Response:
+        transfer_id = input_msg["transfer"]
+        if not valid_transfer_id(transfer_id):
+            raise RuntimeError("malformed transfer id")
+        for kind in TRANSFER_KINDS:
+            if kind in input_msg:
+                break
+        else:
+            raise RuntimeError("transfer record without payload")
+
+        payload = self.cipher.decrypt(input_msg[kind])
+        reply = context.transfer_sink.on_transfer_record(kind, transfer_id, payload)
+        if reply is None:
+            return Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
+
+        return Response(
+            message=self._encode_transfer_record(reply[0], transfer_id, reply[1]),
+            status=ReponseStatus.REPLY_NEEDED,
+        )
@@ -0,0 +1,168 @@
+from state.base import WireFormat
+import base64
+import json
+import struct
+from typing import Any, Dict, List, Protocol, Sequence, Tuple
+
+Record = Dict[str, Any]
+
+
+class Codec(Protocol):
+    name: str
+
+    def encode(self, record: Record) -> bytes:
+        pass
+
+    def decode(self, data: bytes) -> Record:
+        pass
+
+
+class FieldKind:
+    BYTES = 0
+    TEXT_BYTES = 1  # bytes that already are ascii text, e.g. fernet tokens
+    STR = 2
+    STR_LIST = 3
+
+
+# wire tag and in memory kind of every record field, bytes fields hold raw
+# bytes in memory whatever the codec
+FIELDS: Dict[str, Tuple[int, int]] = {
+    "modes": (1, FieldKind.STR_LIST),
+    "ciphers": (2, FieldKind.STR_LIST),
+    "wires": (3, FieldKind.STR_LIST),
+    "x25519": (4, FieldKind.BYTES),
+    "mode": (5, FieldKind.STR),
+    "cipher": (6, FieldKind.STR),
+    "wire": (7, FieldKind.STR),
+    "pub": (8, FieldKind.BYTES),
+    "secret": (9, FieldKind.BYTES),
+    "message": (10, FieldKind.TEXT_BYTES),
+    "sealed": (11, FieldKind.BYTES),
+    "result": (12, FieldKind.STR),
+    "batch": (13, FieldKind.BYTES),
+    "transfer": (14, FieldKind.STR),
+    "offer": (15, FieldKind.BYTES),
+    "chunk": (16, FieldKind.BYTES),
+    "digest": (17, FieldKind.BYTES),
+    "cancel": (18, FieldKind.BYTES),
+    "ticket": (19, FieldKind.BYTES),
+    "nonce": (20, FieldKind.BYTES),
+    "listen": (21, FieldKind.STR),
+    "group": (22, FieldKind.STR),
+    "invite": (23, FieldKind.BYTES),
+    "post": (24, FieldKind.BYTES),
+    "leave": (25, FieldKind.BYTES),
+    "received": (26, FieldKind.BYTES),
+}
+
+TAG_FIELDS: Dict[int, Tuple[str, int]] = {
+    tag: (name, kind) for name, (tag, kind) in FIELDS.items()
+}
+
+
+class JsonCodec:
+    # the original format, one json object per record with bytes as base64
+    name = WireFormat.JSON
+
+    def encode(self, record: Record) -> bytes:
+        output_msg = {}
+        for name, value in record.items():
+            kind = FIELDS[name][1]
+            if kind == FieldKind.BYTES:
+                output_msg[name] = base64.b64encode(value).decode()
+            elif kind == FieldKind.TEXT_BYTES:
+                output_msg[name] = value.decode()
+            else:
+                output_msg[name] = value
+        return json.dumps(output_msg).encode()
+
+    def decode(self, data: bytes) -> Record:
+        input_msg = json.loads(data.decode())
+        if not isinstance(input_msg, dict):
+            raise RuntimeError("json record is not an object")
+
+        record: Record = {}
+        for name, value in input_msg.items():
+            if name not in FIELDS:
+                continue
+            kind = FIELDS[name][1]
+            if kind == FieldKind.BYTES:
+                record[name] = base64.b64decode(value.encode())
+            elif kind == FieldKind.TEXT_BYTES:
+                record[name] = value.encode()
+            else:
+                record[name] = value
+        return record
+
+
+class BinaryCodec:
+    # version byte followed by (tag byte, 32 bit length, raw bytes) fields
+    name = WireFormat.BINARY
+    VERSION = 1
+    FIELD_HEADER = struct.Struct("!BI")
+
+    def encode(self, record: Record) -> bytes:
+        parts: List[bytes] = [bytes((self.VERSION,))]
+        for name, value in record.items():
+            tag, kind = FIELDS[name]
+            if kind == FieldKind.STR:
+                value = value.encode()
+            elif kind == FieldKind.STR_LIST:
+                value = ",".join(value).encode()
+            parts.append(self.FIELD_HEADER.pack(tag, len(value)))
+            parts.append(value)
+        return b"".join(parts)
+
+    def decode(self, data: bytes) -> Record:
+        if not data or data[0] != self.VERSION:
+            raise RuntimeError("unsupported binary record version")
+
+        record: Record = {}
+        view = memoryview(data)
+        offset = 1
+        while offset < len(data):
+            tag, length = self.FIELD_HEADER.unpack_from(data, offset)
+            offset += self.FIELD_HEADER.size
+            if offset + length > len(data):
+                raise RuntimeError("truncated binary record")
+
+            value = bytes(view[offset : offset + length])
+            offset += length
+
+            if tag not in TAG_FIELDS:
+                continue
+            name, kind = TAG_FIELDS[tag]
+            if kind == FieldKind.STR:
+                record[name] = value.decode()
+            elif kind == FieldKind.STR_LIST:
+                record[name] = value.decode().split(",") if value else []
+            else:
+                record[name] = value
+        return record
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (JSON_CODEC, BINARY_CODEC)}
+
+
+def get_codec(wire_format: str) -> Codec:
+    codec = CODECS.get(wire_format, None)
+    if codec is None:
+        raise RuntimeError(f"unknown wire format: {wire_format}")
+    return codec
+
+
+def decode_record(data: bytes) -> Record:
+    # json records start with "{", binary ones with their version byte
+    if data[:1] == b"{":
+        return JSON_CODEC.decode(data)
+    return BINARY_CODEC.decode(data)
+
+
+def select_wire_format(offered: Sequence[str], supported: Sequence[str]) -> str:
+    for wire_format in supported:
+        if wire_format in offered:
+            return wire_format
+    return WireFormat.JSON
@@ -1,40 +1,188 @@
-from state.base import BaseState, Response, ReponseStatus, Context, SenderCallback
+from state.base import (
+    BaseState,
+    Response,
+    ReponseStatus,
+    Context,
+    SenderCallback,
+    HandshakeMode,
+    CipherSuite,
+    WireFormat,
+    DEFAULT_HANDSHAKE_MODES,
+    DEFAULT_CIPHER_SUITES,
+    DEFAULT_WIRE_FORMATS,
+)
 
 from state.chat import ChatState
+from state.codec import JSON_CODEC, Record, decode_record, get_codec
+from state.resumption import ClientTicket, TicketCache
 
-import json
-from crypto import rsa
-from typing import Optional
-import base64
+from crypto import rsa, ticket, x25519
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from typing import Optional, Sequence
 
 
 class KeyExchangeState(BaseState):
-    def __init__(self, secret: bytes) -> None:
+    def __init__(
+        self,
+        secret: bytes,
+        modes: Sequence[str] = DEFAULT_HANDSHAKE_MODES,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        wire_formats: Sequence[str] = DEFAULT_WIRE_FORMATS,
+        tickets: Optional[TicketCache] = None,
+        resume_ticket: Optional[ClientTicket] = None,
+        listen_port: Optional[int] = None,
+    ) -> None:
         self._secret = secret
+        # resuming needs somewhere to keep the tickets
+        if tickets is None:
+            modes = [mode for mode in modes if mode != HandshakeMode.RESUME]
+        self.modes = modes
+        self.cipher_suites = cipher_suites
+        self.wire_formats = wire_formats
+        self._x25519_pri_key: Optional[X25519PrivateKey] = None
+        self._x25519_pub_key_bytes = b""
+        self.tickets: Optional[TicketCache] = tickets
+        self._resume_ticket: Optional[ClientTicket] = resume_ticket
+        self._nonce = b""
+        self.listen_port = listen_port
 
     @property
     def secret(self) -> Optional[bytes]:
         return self._secret
 
+    def hello(self) -> bytes:
+        # first record of the handshake, offers the modes this side supports.
+        # always json since the peer's formats are unknown, peers that only
+        # know rsa ignore its content.
+        output_msg: Record = {}
+        output_msg["modes"] = list(self.modes)
+        output_msg["ciphers"] = list(self.cipher_suites)
+        output_msg["wires"] = list(self.wire_formats)
+        if self.listen_port is not None:
+            # lets the server file this session under our listening address
+            output_msg["listen"] = str(self.listen_port)
+
+        if HandshakeMode.X25519 in self.modes:
+            self._x25519_pri_key, pub_key = x25519.generate_key_pair()
+            self._x25519_pub_key_bytes = x25519.public_key_to_bytes(pub_key)
+            output_msg["x25519"] = self._x25519_pub_key_bytes
+
+        if HandshakeMode.RESUME in self.modes and self._resume_ticket:
+            # the other modes stay on offer in case the server forgot it
+            self._nonce = ticket.new_nonce()
+            output_msg["ticket"] = self._resume_ticket.ticket
+            output_msg["nonce"] = self._nonce
+
+        return JSON_CODEC.encode(output_msg)
+
     def send_message(self, message: bytes, sender_cb: SenderCallback):
         raise RuntimeError("key exchange state: unable to send message")
 
     def on_message(self, message: bytes, context: Context) -> Response:
+        input_msg = decode_record(message)
+
+        cipher_suite = input_msg.get("cipher", CipherSuite.FERNET)
+        if cipher_suite not in self.cipher_suites:
+            raise RuntimeError(f"key exchange state: cipher {cipher_suite} refused")
+
+        wire_format = input_msg.get("wire", WireFormat.JSON)
+        if wire_format not in self.wire_formats:
+            raise RuntimeError(f"key exchange state: wire {wire_format} refused")
+
+        if input_msg.get("mode") == HandshakeMode.RESUME:
+            return self._on_resume_message(
+                input_msg, cipher_suite, wire_format, context
+            )
+
+        if input_msg.get("mode") == HandshakeMode.X25519:
+            return self._on_x25519_message(
+                input_msg, cipher_suite, wire_format, context
+            )
+
+        if HandshakeMode.RSA not in self.modes:
+            raise RuntimeError("key exchange state: rsa handshake not allowed")
+
+        return self._on_rsa_message(input_msg, cipher_suite, wire_format, context)
+
+    def _on_rsa_message(
+        self, input_msg: Record, cipher_suite: str, wire_format: str, context: Context
+    ) -> Response:
         state_changer = context.state_changer
 
-        input_msg = json.loads(message.decode())
-        pub_key_bytes = base64.b64decode(input_msg["pub"].encode())
-        pub_key = rsa.bytes_to_public_key(pub_key_bytes)
+        pub_key = rsa.bytes_to_public_key(input_msg["pub"])
 
         cipher_secret = rsa.encrypt_message(pub_key, self._secret)
 
-        output_msg = {}
-        output_msg["secret"] = base64.b64encode(cipher_secret).decode()
+        output_msg: Record = {}
+        output_msg["secret"] = cipher_secret
         response = Response(
-            message=json.dumps(output_msg).encode(),
+            message=get_codec(wire_format).encode(output_msg),
             status=ReponseStatus.REPLY_NEEDED,
         )
 
-        state_changer.change_state(ChatState(self._secret))
+        state_changer.change_state(
+            ChatState(
+                self._secret,
+                cipher_suite=cipher_suite,
+                initiator=True,
+                wire_format=wire_format,
+                tickets=self.tickets,
+            )
+        )
 
         return response
+
+    def _on_x25519_message(
+        self, input_msg: Record, cipher_suite: str, wire_format: str, context: Context
+    ) -> Response:
+        state_changer = context.state_changer
+
+        if self._x25519_pri_key is None:
+            raise RuntimeError("key exchange state: x25519 was not offered")
+
+        peer_pub_key_bytes = input_msg["x25519"]
+        secret = x25519.derive_secret(
+            self._x25519_pri_key,
+            x25519.bytes_to_public_key(peer_pub_key_bytes),
+            info=b"zerotrust_chat x25519"
+            + self._x25519_pub_key_bytes
+            + peer_pub_key_bytes,
+        )
+        self._x25519_pri_key = None
+
+        return self._finish(input_msg, secret, cipher_suite, wire_format, context)
+
+    def _on_resume_message(
+        self, input_msg: Record, cipher_suite: str, wire_format: str, context: Context
+    ) -> Response:
+        if self._resume_ticket is None:
+            raise RuntimeError("key exchange state: resume was not offered")
+
+        secret = ticket.resumed_secret(
+            self._resume_ticket.secret, self._nonce, input_msg["nonce"]
+        )
+        self._resume_ticket = None
+
+        return self._finish(input_msg, secret, cipher_suite, wire_format, context)
+
+    def _finish(
+        self,
+        input_msg: Record,
+        secret: bytes,
+        cipher_suite: str,
+        wire_format: str,
+        context: Context,
+    ) -> Response:
+        chat_state = ChatState(
+            secret,
+            cipher_suite=cipher_suite,
+            initiator=True,
+            wire_format=wire_format,
+            tickets=self.tickets,
+        )
+        if "ticket" in input_msg:
+            chat_state.accept_ticket(input_msg["ticket"], context.addr)
+
+        context.state_changer.change_state(chat_state)
+
+        return Response(message=b"", status=ReponseStatus.REPLY_NOT_NEEDED)
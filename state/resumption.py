@@ -0,0 +1,38 @@
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional, Tuple
+import time
+
+
+class ClientTicket(NamedTuple):
+    # opaque ticket handed back to the server and the secret it stands for
+    ticket: bytes
+    secret: bytes
+
+
+class TicketCache:
+    # bounded lru of resumption tickets, every ticket is good for one
+    # resumption within its lifetime. servers key it by ticket, clients by
+    # the address they dialled
+    def __init__(self, capacity: int = 1024, lifetime: float = 3600.0) -> None:
+        self.capacity = capacity
+        self.lifetime = lifetime
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.lifetime, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= time.monotonic():
+            return None
+        return value
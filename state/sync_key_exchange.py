@@ -1,15 +1,40 @@
-from state.base import BaseState, Response, ReponseStatus, Context, SenderCallback
-import json
-from crypto import rsa
+from state.base import (
+    BaseState,
+    Response,
+    ReponseStatus,
+    Context,
+    SenderCallback,
+    HandshakeMode,
+    WireFormat,
+    DEFAULT_HANDSHAKE_MODES,
+    DEFAULT_CIPHER_SUITES,
+    DEFAULT_WIRE_FORMATS,
+)
+from crypto import rsa, ticket, x25519
+from crypto.key_pool import KeyPool
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
-from typing import Optional
-import base64
+from typing import Optional, Sequence
 from state.ack_key_exchange import AckKeyExchangeState
+from state.chat import ChatState, select_cipher_suite
+from state.codec import Record, decode_record, get_codec, select_wire_format
+from state.resumption import TicketCache
 
 
 class SyncKeyExchangeState(BaseState):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        key_pool: Optional[KeyPool] = None,
+        modes: Sequence[str] = DEFAULT_HANDSHAKE_MODES,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        wire_formats: Sequence[str] = DEFAULT_WIRE_FORMATS,
+        tickets: Optional[TicketCache] = None,
+    ) -> None:
         self.pri_key: Optional[RSAPrivateKey] = None
+        self.key_pool: Optional[KeyPool] = key_pool
+        self.modes = modes
+        self.cipher_suites = cipher_suites
+        self.wire_formats = wire_formats
+        self.tickets: Optional[TicketCache] = tickets
 
     @property
     def private_key(self) -> RSAPrivateKey:
@@ -20,19 +45,169 @@ class SyncKeyExchangeState(BaseState):
         raise RuntimeError("sync key state, unable to send")
 
     def on_message(self, message: bytes, context: Context) -> Response:
+        offer = self._parse_hello(message)
+        listen = str(offer.get("listen", ""))
+        if listen.isdigit() and 0 < int(listen) < 65536:
+            context.state_changer.on_peer_listen_port(int(listen))
+        cipher_suite = select_cipher_suite(offer.get("ciphers", []), self.cipher_suites)
+        wire_format = select_wire_format(offer.get("wires", []), self.wire_formats)
+
+        # clients offering resume take a ticket home from every handshake
+        tickets = None
+        if HandshakeMode.RESUME in self.modes and HandshakeMode.RESUME in offer.get(
+            "modes", []
+        ):
+            tickets = self.tickets
+
+        if tickets is not None and "ticket" in offer:
+            resumption_secret = tickets.pop(offer["ticket"])
+            if resumption_secret is not None:
+                return self._on_resume_hello(
+                    offer,
+                    resumption_secret,
+                    tickets,
+                    cipher_suite,
+                    wire_format,
+                    context,
+                )
+
+        if HandshakeMode.X25519 in self.modes and "x25519" in offer:
+            return self._on_x25519_hello(
+                offer, tickets, cipher_suite, wire_format, context
+            )
+
+        if HandshakeMode.RSA not in self.modes:
+            raise RuntimeError("sync key state, no common handshake mode")
+
+        return self._on_rsa_hello(tickets, cipher_suite, wire_format, context)
+
+    def _on_rsa_hello(
+        self,
+        tickets: Optional[TicketCache],
+        cipher_suite: str,
+        wire_format: str,
+        context: Context,
+    ) -> Response:
         changer = context.state_changer
 
-        pri_key, pub_key = rsa.generate_key_pair()
-        pub_key_bytes = rsa.public_key_to_bytes(pub_key)
+        if self.key_pool:
+            pri_key, pub_key = self.key_pool.take()
+        else:
+            pri_key, pub_key = rsa.generate_key_pair()
+        # der is enough once json and its base64 are out of the way
+        pub_key_bytes = rsa.public_key_to_bytes(
+            pub_key, der=wire_format != WireFormat.JSON
+        )
         self.pri_key = pri_key
 
-        output_msg = {}
-        output_msg["pub"] = base64.b64encode(pub_key_bytes).decode()
+        output_msg: Record = {}
+        output_msg["pub"] = pub_key_bytes
+        output_msg["cipher"] = cipher_suite
+        output_msg["wire"] = wire_format
 
         response = Response(
-            message=json.dumps(output_msg).encode(), status=ReponseStatus.REPLY_NEEDED
+            message=get_codec(wire_format).encode(output_msg),
+            status=ReponseStatus.REPLY_NEEDED,
         )
 
-        changer.change_state(AckKeyExchangeState(pri_key=pri_key))
+        changer.change_state(
+            AckKeyExchangeState(
+                pri_key=pri_key,
+                cipher_suite=cipher_suite,
+                wire_format=wire_format,
+                tickets=tickets,
+            )
+        )
 
         return response
+
+    def _on_x25519_hello(
+        self,
+        offer: Record,
+        tickets: Optional[TicketCache],
+        cipher_suite: str,
+        wire_format: str,
+        context: Context,
+    ) -> Response:
+        changer = context.state_changer
+
+        peer_pub_key_bytes = offer["x25519"]
+        pri_key, pub_key = x25519.generate_key_pair()
+        pub_key_bytes = x25519.public_key_to_bytes(pub_key)
+
+        secret = x25519.derive_secret(
+            pri_key,
+            x25519.bytes_to_public_key(peer_pub_key_bytes),
+            info=b"zerotrust_chat x25519" + peer_pub_key_bytes + pub_key_bytes,
+        )
+
+        output_msg: Record = {}
+        output_msg["mode"] = HandshakeMode.X25519
+        output_msg["x25519"] = pub_key_bytes
+
+        return self._finish(
+            output_msg, secret, tickets, cipher_suite, wire_format, context
+        )
+
+    def _on_resume_hello(
+        self,
+        offer: Record,
+        resumption_secret: bytes,
+        tickets: TicketCache,
+        cipher_suite: str,
+        wire_format: str,
+        context: Context,
+    ) -> Response:
+        client_nonce = offer.get("nonce", b"")
+        if len(client_nonce) != ticket.NONCE_SIZE:
+            raise RuntimeError("sync key state, resume without a nonce")
+
+        server_nonce = ticket.new_nonce()
+        secret = ticket.resumed_secret(resumption_secret, client_nonce, server_nonce)
+
+        output_msg: Record = {}
+        output_msg["mode"] = HandshakeMode.RESUME
+        output_msg["nonce"] = server_nonce
+
+        return self._finish(
+            output_msg, secret, tickets, cipher_suite, wire_format, context
+        )
+
+    def _finish(
+        self,
+        output_msg: Record,
+        secret: bytes,
+        tickets: Optional[TicketCache],
+        cipher_suite: str,
+        wire_format: str,
+        context: Context,
+    ) -> Response:
+        # one round trip handshakes reply and switch to chat right away
+        chat_state = ChatState(
+            secret,
+            cipher_suite=cipher_suite,
+            initiator=False,
+            wire_format=wire_format,
+        )
+
+        output_msg["cipher"] = cipher_suite
+        output_msg["wire"] = wire_format
+        if tickets is not None:
+            output_msg["ticket"] = chat_state.issue_ticket(tickets)
+
+        response = Response(
+            message=get_codec(wire_format).encode(output_msg),
+            status=ReponseStatus.REPLY_NEEDED,
+        )
+
+        context.state_changer.change_state(chat_state)
+
+        return response
+
+    @staticmethod
+    def _parse_hello(message: bytes) -> Record:
+        # older clients open with a plain b"hello"
+        try:
+            return decode_record(message)
+        except Exception:
+            return {}
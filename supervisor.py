@@ -0,0 +1,380 @@
+import base64
+import json
+import os
+import selectors
+import signal
+import select
+import socket
+import struct
+import sys
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional
+
+import chat_manager
+import network
+import session
+from network import Addr, format_addr, parse_addr
+
+if TYPE_CHECKING:
+    from crypto.key_pool import KeyPool
+
+
+class ChannelMessageType:
+    SESSION_OPEN = "session_open"
+    SESSION_CLOSE = "session_close"
+    CHAT = "chat"
+    CONNECT = "connect"
+    SEND = "send"
+    # the worker's answer to every send, whether its session took the message
+    SENT = "sent"
+    CLOSE = "close"
+
+
+# the number of the send answered, counted on both ends, and the result
+SENT_RESULT = struct.Struct("!Q?")
+# how long a send waits for the worker's answer before it counts as failed
+SEND_TIMEOUT = 1.0
+
+
+def _encode(kind: str, addr: Addr, message: bytes = b"") -> bytes:
+    record = {
+        "type": kind,
+        "addr": format_addr(addr),
+        "message": base64.b64encode(message).decode(),
+    }
+    return network.pack_frame(json.dumps(record).encode())
+
+
+def _decode(record: bytes):
+    decoded = json.loads(record.decode())
+    return (
+        decoded["type"],
+        parse_addr(decoded["addr"]),
+        base64.b64decode(decoded["message"].encode()),
+    )
+
+
+class Channel:
+    # framed stream between the supervisor and one worker process
+    def __init__(self, conn: socket.socket) -> None:
+        conn.setblocking(False)
+        self.conn = conn
+        self.buffer = network.FrameBuffer()
+        self.outbound = network.OutboundQueue()
+
+    def send(self, kind: str, addr: Addr, message: bytes = b"") -> None:
+        self.outbound.push(_encode(kind, addr, message))
+
+    def flush(self) -> bool:
+        return self.outbound.flush(self.conn)
+
+    def recv(self) -> Optional[List[bytes]]:
+        # None once the other end has gone away
+        try:
+            if not self.buffer.recv_from(self.conn):
+                return None
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            # reset by a process that died with records still unread
+            return None
+        return list(self.buffer.frames())
+
+
+class Worker:
+    # runs in a forked process, owns one ChatManager listening on the shared
+    # SO_REUSEPORT port and relays its events to the supervisor
+    def __init__(
+        self,
+        host_addr: Addr,
+        channel: Channel,
+        tick: float,
+        key_pool_depth: int,
+        coalesce_window: float = 0.0,
+    ) -> None:
+        self.channel = channel
+        # set while the supervisor is not keeping up, the channel is written
+        # again once it reports writable
+        self.blocked = False
+        self.sends = 0
+        self.tick = tick
+        self.poller = network.Poller()
+        self.poller.register(channel.conn)
+        self.chat_manager = chat_manager.ChatManager(
+            host_addr=host_addr,
+            chat_recv_observer=self,
+            session_close_observer=self,
+            session_open_observer=self,
+            coalesce_window=coalesce_window,
+        )
+        # created after the fork, the pool thread would not survive it, and
+        # after the listener, its import is most of a worker's startup
+        self.key_pool: Optional["KeyPool"] = None
+        if key_pool_depth:
+            from crypto.key_pool import KeyPool
+
+            self.key_pool = KeyPool(depth=key_pool_depth)
+            self.chat_manager.key_pool = self.key_pool
+
+    def loop(self):
+        while True:
+            self.chat_manager.run(self.tick)
+
+            events = dict(self.poller.poll_events(timeout=0))
+            mask = events.get(self.channel.conn, 0)
+            if mask & selectors.EVENT_READ:
+                records = self.channel.recv()
+                if records is None:
+                    break
+                for record in records:
+                    self._on_record(*_decode(record))
+
+            if self.channel.outbound and (
+                not self.blocked or mask & selectors.EVENT_WRITE
+            ):
+                try:
+                    self.blocked = not self.channel.flush()
+                except OSError:
+                    break
+                self.poller.set_writable(self.channel.conn, self.blocked)
+
+        self.chat_manager.stop()
+        if self.key_pool:
+            self.key_pool.stop()
+
+    def on_session_open(self, addr: Addr):
+        self.channel.send(ChannelMessageType.SESSION_OPEN, addr)
+
+    def on_session_close(self, addr: Addr):
+        self.channel.send(ChannelMessageType.SESSION_CLOSE, addr)
+
+    def on_chat(self, addr: Addr, message: bytes):
+        self.channel.send(ChannelMessageType.CHAT, addr, message)
+
+    def _on_record(self, kind: str, addr: Addr, message: bytes):
+        if kind == ChannelMessageType.CONNECT:
+            try:
+                self.chat_manager.start_new_connection(addr)
+            except OSError as e:
+                print(f"connect exception: {e}")
+                self.on_session_close(addr)
+        elif kind == ChannelMessageType.SEND:
+            self.sends += 1
+            sent = self.chat_manager.send_message(addr, message)
+            self.channel.send(
+                ChannelMessageType.SENT, addr, SENT_RESULT.pack(self.sends, sent)
+            )
+        elif kind == ChannelMessageType.CLOSE:
+            self.chat_manager.close_conn(addr)
+
+
+class WorkerHandle(NamedTuple):
+    pid: int
+    channel: Channel
+
+
+class Supervisor:
+    # forks workers that each accept on the same port, the kernel spreads
+    # incoming connections across them. the routing table remembers which
+    # worker owns a session so sends and closes reach the right process.
+    # exposes the same calls as ChatManager.
+    def __init__(
+        self,
+        host_addr: Addr,
+        chat_recv_observer: session.ProtocolContextChatObserver,
+        session_close_observer: session.SessionCloseObserver,
+        workers: int = os.cpu_count() or 1,
+        tick: float = 0.01,
+        key_pool_depth: int = 0,
+        coalesce_window: float = 0.0,
+    ) -> None:
+        self.chat_recv_observer: session.ProtocolContextChatObserver = (
+            chat_recv_observer
+        )
+        self.session_close_observer: session.SessionCloseObserver = (
+            session_close_observer
+        )
+        self.routes: Dict[Addr, int] = {}
+        self.poller = network.Poller()
+        self.conn_worker_mapping: Dict[socket.socket, int] = {}
+        self.workers: List[WorkerHandle] = []
+        # sends handed to each worker, to match its answers with
+        self.sends: List[int] = []
+        for index in range(workers):
+            self.workers.append(
+                self._fork_worker(host_addr, tick, key_pool_depth, coalesce_window)
+            )
+            self.conn_worker_mapping[self.workers[index].channel.conn] = index
+            self.sends.append(0)
+        self.next_worker = 0
+
+    def close_conn(self, addr: Addr):
+        owner = self.routes.get(addr, None)
+        if owner is not None:
+            self.workers[owner].channel.send(ChannelMessageType.CLOSE, addr)
+            self._flush(owner)
+
+    def retrieve_active_sessions(self) -> Iterable[Addr]:
+        return (addr for addr in self.routes.keys())
+
+    def run(self, timeout: Optional[float] = None):
+        for conn, mask in self.poller.poll_events(timeout=timeout):
+            index = self.conn_worker_mapping[conn]
+
+            if mask & selectors.EVENT_WRITE and not self._flush(index):
+                continue
+
+            if mask & selectors.EVENT_READ:
+                records = self.workers[index].channel.recv()
+
+                if records is None:
+                    self._on_worker_exit(index)
+                    continue
+
+                for record in records:
+                    self._on_record(index, *_decode(record))
+
+    def send_message(self, dest_addr: Addr, message: bytes) -> bool:
+        owner = self.routes.get(dest_addr, None)
+        if owner is None:
+            return False
+
+        self.workers[owner].channel.send(ChannelMessageType.SEND, dest_addr, message)
+        self.sends[owner] += 1
+        # False when the worker turns out to be gone, with the message
+        if not self._flush(owner):
+            return False
+        return self._wait_sent(owner, self.sends[owner])
+
+    def start_new_connection(self, dest_addr: Addr) -> None:
+        if dest_addr in self.routes:
+            return
+
+        # spread outbound sessions round robin, the route is claimed right away
+        # so messages sent before the worker reports back reach it and are
+        # answered, refused until its key exchange is through
+        alive = [index for index, worker in enumerate(self.workers) if worker.pid]
+        if not alive:
+            raise RuntimeError("no worker left to connect from")
+        owner = alive[self.next_worker % len(alive)]
+        self.next_worker += 1
+
+        self.routes[dest_addr] = owner
+        self.workers[owner].channel.send(ChannelMessageType.CONNECT, dest_addr)
+        self._flush(owner)
+
+    def stop(self):
+        for index, worker in enumerate(self.workers):
+            if worker.pid:
+                # workers exit once their channel is closed
+                self._reap_worker(index)
+
+    def _fork_worker(
+        self, host_addr: Addr, tick: float, key_pool_depth: int, coalesce_window: float
+    ) -> WorkerHandle:
+        parent_conn, child_conn = socket.socketpair()
+
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            for conn in self.conn_worker_mapping.keys():
+                conn.close()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                Worker(
+                    host_addr,
+                    Channel(child_conn),
+                    tick,
+                    key_pool_depth,
+                    coalesce_window,
+                ).loop()
+            except BaseException as e:
+                print(f"worker exception: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+
+        child_conn.close()
+        channel = Channel(parent_conn)
+        self.poller.register(channel.conn)
+        return WorkerHandle(pid=pid, channel=channel)
+
+    def _flush(self, index: int) -> bool:
+        # returns False once the worker is found dead, it has been reaped and
+        # its sessions reported closed by then
+        channel = self.workers[index].channel
+        try:
+            drained = channel.flush()
+        except OSError as e:
+            print(f"worker {self.workers[index].pid} channel: {e}")
+            self._on_worker_exit(index)
+            return False
+        self.poller.set_writable(channel.conn, not drained)
+        return True
+
+    def _wait_sent(self, index: int, number: int) -> bool:
+        # blocks until the worker answers send number, whatever else it
+        # reports meanwhile is handled as run() would
+        channel = self.workers[index].channel
+        deadline = time.monotonic() + SEND_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"worker {self.workers[index].pid} did not answer a send")
+                return False
+
+            writing = [channel.conn] if channel.outbound else []
+            readable, writable, _ = select.select(
+                [channel.conn], writing, [], remaining
+            )
+            if writable and not self._flush(index):
+                return False
+            if not readable:
+                continue
+
+            records = channel.recv()
+            if records is None:
+                self._on_worker_exit(index)
+                return False
+
+            result: Optional[bool] = None
+            for record in records:
+                kind, addr, message = _decode(record)
+                if kind == ChannelMessageType.SENT:
+                    answered, sent = SENT_RESULT.unpack(message)
+                    if answered == number:
+                        result = sent
+                    # answers to sends that timed out are dropped
+                    continue
+                self._on_record(index, kind, addr, message)
+            if result is not None:
+                return result
+
+    def _on_record(self, index: int, kind: str, addr: Addr, message: bytes):
+        if kind == ChannelMessageType.SESSION_OPEN:
+            self.routes[addr] = index
+        elif kind == ChannelMessageType.SESSION_CLOSE:
+            if self.routes.get(addr, None) == index:
+                del self.routes[addr]
+            self.session_close_observer.on_session_close(addr)
+        elif kind == ChannelMessageType.CHAT:
+            self.chat_recv_observer.on_chat(addr, message)
+
+    def _reap_worker(self, index: int):
+        worker = self.workers[index]
+        del self.conn_worker_mapping[worker.channel.conn]
+        self.poller.unregister(worker.channel.conn)
+        worker.channel.conn.close()
+        os.waitpid(worker.pid, 0)
+        self.workers[index] = WorkerHandle(pid=0, channel=worker.channel)
+
+    def _on_worker_exit(self, index: int):
+        print(f"worker {self.workers[index].pid} exited")
+        self._reap_worker(index)
+
+        for addr, owner in list(self.routes.items()):
+            if owner == index:
+                del self.routes[addr]
+                self.session_close_observer.on_session_close(addr)
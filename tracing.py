@@ -0,0 +1,202 @@
+import json
+import os
+import signal
+import time
+from collections import deque
+from types import FrameType
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+)
+
+from network import Addr, format_addr
+from state.base import ProtocolContextChatObserver
+
+
+class TraceRecord(NamedTuple):
+    timestamp: float
+    addr: str
+    # recv for a record handed to the state, send for one produced by it
+    direction: str
+    state: str
+    # the state after the call, differs from state on a transition
+    next_state: str
+    # plaintext size on send, wire size on recv
+    size: int
+    # wire bytes produced, the reply on recv
+    wire_size: int
+    duration: float
+    # part of duration spent in the chat observer
+    observer: float
+    status: str
+
+
+class TraceHook(Protocol):
+    def on_trace(self, record: TraceRecord):
+        pass
+
+
+class Tracer:
+    # sessions only build trace records while a hook is installed, checking
+    # for one is all tracing costs otherwise
+    def __init__(self) -> None:
+        self.hooks: List[TraceHook] = []
+
+    def add_hook(self, hook: TraceHook):
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook: TraceHook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def emit(self, record: TraceRecord):
+        for hook in self.hooks:
+            hook.on_trace(record)
+
+
+class TimedChatObserver:
+    # stands in for the chat observer of one record to time the callback
+    def __init__(self, chat_observer: ProtocolContextChatObserver) -> None:
+        self.chat_observer = chat_observer
+        self.elapsed = 0.0
+
+    def on_chat(self, addr: Addr, message: bytes):
+        started = time.perf_counter()
+        try:
+            self.chat_observer.on_chat(addr, message)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+
+def trace_record(
+    addr: Addr,
+    direction: str,
+    state: object,
+    next_state: object,
+    size: int,
+    wire_size: int,
+    duration: float,
+    observer: float = 0.0,
+    status: str = "",
+) -> TraceRecord:
+    return TraceRecord(
+        timestamp=time.time(),
+        addr=format_addr(addr),
+        direction=direction,
+        state=type(state).__name__,
+        next_state=type(next_state).__name__,
+        size=size,
+        wire_size=wire_size,
+        duration=duration,
+        observer=observer,
+        status=status,
+    )
+
+
+class TraceBuffer:
+    # keeps the last capacity records, older ones fall off the front
+    def __init__(self, capacity: int = 10000) -> None:
+        self.records: Deque[TraceRecord] = deque(maxlen=capacity)
+
+    def on_trace(self, record: TraceRecord):
+        self.records.append(record)
+
+    def dump(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        records = list(self.records)
+        if limit is not None:
+            records = records[-limit:]
+        return [record._asdict() for record in records]
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for record in self.dump():
+                f.write(json.dumps(record) + "\n")
+
+
+class SamplingProfiler:
+    # samples the stack of the main thread every interval seconds of cpu
+    # time from a SIGPROF timer. the poll loop runs there, stopped or idle it
+    # costs nothing
+    def __init__(self, interval: float = 0.005, max_depth: int = 64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Dict[Tuple[str, ...], int] = {}
+        self.samples = 0
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def clear(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def top(self, limit: int = 20) -> List[Tuple[str, float]]:
+        # share of samples each function was on the stack for, the caller of
+        # the hot spot shows up as well as the hot spot itself
+        inclusive: Dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            for function in set(stack):
+                inclusive[function] = inclusive.get(function, 0) + count
+        ranked = sorted(inclusive.items(), key=lambda item: item[1], reverse=True)
+        return [(function, count / self.samples) for function, count in ranked[:limit]]
+
+    def folded(self) -> str:
+        # one "outer;...;inner count" line per stack, the flamegraph input
+        return "".join(
+            f"{';'.join(stack)} {count}\n"
+            for stack, count in sorted(self.stacks.items())
+        )
+
+    def _sample(self, signum: int, frame: Optional[FrameType]):
+        stack: List[str] = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                f"{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        stack.reverse()
+        key = tuple(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+
+def install_signal_handlers(
+    profiler: SamplingProfiler, dump: Optional[Callable[[], None]] = None
+) -> None:
+    # SIGUSR1 starts and stops the profiler, SIGUSR2 calls dump. both have to
+    # be installed from the main thread
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+    if dump is not None:
+        signal.signal(signal.SIGUSR2, lambda signum, frame: dump())
+
+
+# the process wide tracer sessions report to
+TRACER = Tracer()
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Optional, Tuple
+
+CHUNK_SIZE = 64 * 1024
+# every chunk carries its file offset so a dropped or replayed chunk is caught
+CHUNK_HEADER = struct.Struct("!Q")
+
+
+class TransferKind:
+    OFFER = "offer"
+    CHUNK = "chunk"
+    DIGEST = "digest"
+    CANCEL = "cancel"
+    # sent back once the file is in place and its digest matched
+    RECEIVED = "received"
+
+
+TRANSFER_KINDS = (
+    TransferKind.OFFER,
+    TransferKind.CHUNK,
+    TransferKind.DIGEST,
+    TransferKind.CANCEL,
+    TransferKind.RECEIVED,
+)
+
+
+TRANSFER_ID_BYTES = 8
+
+
+def new_transfer_id() -> str:
+    return os.urandom(TRANSFER_ID_BYTES).hex()
+
+
+def valid_transfer_id(transfer_id: str) -> bool:
+    # ids come from the peer, only ever the hex new_transfer_id makes
+    return len(transfer_id) == TRANSFER_ID_BYTES * 2 and all(
+        c in "0123456789abcdef" for c in transfer_id
+    )
+
+
+class OutgoingTransfer:
+    # maps the file read only and hands out one record at a time, an offer,
+    # fixed size chunks and a closing sha256 digest. only the chunk about to
+    # be encrypted is copied out of the mapping
+    def __init__(self, transfer_id: str, path: str, chunk_size: int = CHUNK_SIZE):
+        self.transfer_id = transfer_id
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map: Optional[mmap.mmap] = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.map, "madvise"):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.offset = 0
+        self.offered = False
+        self.done = False
+        self.digest = hashlib.sha256()
+
+    def next_record(self) -> Tuple[str, bytes]:
+        if not self.offered:
+            self.offered = True
+            offer = {"name": os.path.basename(self.path), "size": self.size}
+            return TransferKind.OFFER, json.dumps(offer).encode()
+
+        if self.offset < self.size:
+            assert self.map is not None
+            end = min(self.offset + self.chunk_size, self.size)
+            data = self.map[self.offset : end]
+            chunk = CHUNK_HEADER.pack(self.offset) + data
+            self.digest.update(data)
+            self.offset = end
+            return TransferKind.CHUNK, chunk
+
+        self.done = True
+        return TransferKind.DIGEST, self.digest.digest()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class IncomingTransfer:
+    # writes chunks straight to a .part file next to the destination, renamed
+    # into place once the digest matches
+    def __init__(self, transfer_id: str, directory: str, offer: bytes) -> None:
+        meta = json.loads(offer.decode())
+        # never trust the peer with anything but the last path component, and
+        # nothing it sends at all for the names made up here
+        local_id = new_transfer_id()
+        name = os.path.basename(str(meta["name"])).lstrip(".") or f"file-{local_id}"
+
+        self.transfer_id = transfer_id
+        self.size = int(meta["size"])
+        self.path = os.path.join(directory, name)
+        self.part_path = f"{self.path}.{local_id}.part"
+        self.file = open(self.part_path, "wb")
+        self.received = 0
+        self.digest = hashlib.sha256()
+
+    def write_chunk(self, chunk: bytes):
+        (offset,) = CHUNK_HEADER.unpack_from(chunk)
+        if offset != self.received:
+            raise RuntimeError(f"chunk at {offset}, expected {self.received}")
+
+        data = memoryview(chunk)[CHUNK_HEADER.size :]
+        if self.received + len(data) > self.size:
+            raise RuntimeError("chunk past the offered size")
+
+        self.file.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+
+    def finish(self, digest: bytes) -> str:
+        self.file.close()
+        if self.received != self.size:
+            raise RuntimeError(f"received {self.received} of {self.size} bytes")
+        if digest != self.digest.digest():
+            raise RuntimeError("file digest mismatch")
+
+        path = self.path
+        copy = 0
+        while os.path.exists(path):
+            copy += 1
+            root, ext = os.path.splitext(self.path)
+            path = f"{root} ({copy}){ext}"
+        os.replace(self.part_path, path)
+        return path
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.part_path)
+        except OSError:
+            pass